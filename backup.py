@@ -0,0 +1,186 @@
+import gzip
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+from migrations import ARCHIVE_MIGRATIONS, MIGRATIONS, migrate, schema_version
+
+# ============================================================
+# ONLINE BACKUP / RESTORE
+# ============================================================
+# Uses SQLite's online backup API, copying `pages_per_step` pages at a
+# time and sleeping between steps so handlers can keep writing while a
+# backup runs. Finished copies are gzip-compressed. The archive database
+# (finished rows moved out of the hot tables) is copied in a second pass
+# and restored together with the main one.
+
+BACKUP_SUFFIX = ".sqlite.gz"
+# the archive database is copied next to the main one, as
+# backup-<time>-archive.sqlite.gz
+ARCHIVE_SUFFIX = "-archive" + BACKUP_SUFFIX
+
+_backup_lock = threading.Lock()
+
+
+class BackupBusy(Exception):
+    pass
+
+
+def _copy(src, dst, pages_per_step, step_sleep, progress):
+    started = time.monotonic()
+    stats = {'pages': 0}
+
+    def on_step(status, remaining, total):
+        stats['pages'] = total
+        if progress:
+            progress(total - remaining, total)
+
+    src.backup(dst, pages=pages_per_step, progress=on_step, sleep=step_sleep)
+    return stats['pages'], time.monotonic() - started
+
+
+def _compress(raw_path, final_path):
+    started = time.monotonic()
+    with open(raw_path, "rb") as f_in, gzip.open(final_path + ".part", "wb", compresslevel=6) as f_out:
+        shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+    os.replace(final_path + ".part", final_path)
+    os.remove(raw_path)
+    return time.monotonic() - started
+
+
+def archive_backup_path(path):
+    """Name of the archive database copy that goes with backup `path`."""
+    return path[:-len(BACKUP_SUFFIX)] + ARCHIVE_SUFFIX
+
+
+def run_backup(db_path, backup_dir, pages_per_step=256, step_sleep=0.005, progress=None, archive_db_path=None):
+    """Copy the live database (and its archive database) into backup_dir and gzip it.
+
+    progress(done_pages, total_pages) is called after every step of each
+    pass. Returns a dict with path, archive_path (None without an archive),
+    pages, copy_seconds, compress_seconds, pages_per_second and the
+    compressed size in bytes of both files.
+    Raises BackupBusy if another backup or restore is running.
+    """
+    if not _backup_lock.acquire(blocking=False):
+        raise BackupBusy("a backup or restore is already running")
+    try:
+        os.makedirs(backup_dir, exist_ok=True)
+        name = "backup-" + datetime.utcnow().strftime("%Y%m%d-%H%M%S")
+        final_path = os.path.join(backup_dir, name + BACKUP_SUFFIX)
+        # main database first: rows archived between the two passes end up
+        # in both copies (the archive copy is idempotent) instead of neither
+        passes = [(db_path, "main", final_path)]
+        if archive_db_path and os.path.exists(archive_db_path):
+            passes.append((archive_db_path, "archive", archive_backup_path(final_path)))
+
+        pages = copy_seconds = compress_seconds = 0
+        for src_path, label, path in passes:
+            raw_path = os.path.join(backup_dir, f"{name}.{label}.sqlite.part")
+            src = sqlite3.connect(src_path)
+            dst = sqlite3.connect(raw_path)
+            try:
+                n, seconds = _copy(src, dst, pages_per_step, step_sleep, progress)
+            finally:
+                dst.close()
+                src.close()
+            pages += n
+            copy_seconds += seconds
+            compress_seconds += _compress(raw_path, path)
+
+        return {
+            'path': final_path,
+            'archive_path': passes[1][2] if len(passes) > 1 else None,
+            'pages': pages,
+            'copy_seconds': copy_seconds,
+            'compress_seconds': compress_seconds,
+            'pages_per_second': pages / copy_seconds if copy_seconds else float(pages),
+            'bytes': sum(os.path.getsize(p[2]) for p in passes),
+        }
+    finally:
+        _backup_lock.release()
+
+
+def list_backups(backup_dir):
+    if not os.path.isdir(backup_dir):
+        return []
+    return sorted(
+        n for n in os.listdir(backup_dir)
+        if n.endswith(BACKUP_SUFFIX) and not n.endswith(ARCHIVE_SUFFIX)
+    )
+
+
+def _unpack(path):
+    raw_path = path[:-len(".gz")] + ".restore"
+    with gzip.open(path, "rb") as f_in, open(raw_path, "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+    return raw_path
+
+
+def _migrate(db_path, archive_db_path):
+    # an older backup is restored with its own user_version; bring it up
+    # to the schema the running code expects
+    conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    try:
+        applied = migrate(conn)
+        if archive_db_path:
+            conn.execute("ATTACH DATABASE ? AS archive", (archive_db_path,))
+            applied += migrate(conn, ARCHIVE_MIGRATIONS, "archive")
+    finally:
+        conn.close()
+    return applied
+
+
+def restore_backup(backup_path, db_path, pages_per_step=256, step_sleep=0.005, progress=None, archive_db_path=None):
+    """Replace the live database contents with a backup.
+
+    The archive database is restored too when the backup has a copy of it.
+    Both copies are decompressed and integrity-checked before either live
+    database is touched; each copy then goes through the backup API, which
+    holds the write lock so readers never see a half-restored file.
+    A backup from a newer schema than this code is rejected; an older one
+    is migrated after the copy. Returns pages, seconds, archive (whether
+    the archive database was restored) and the migrations applied.
+    """
+    if not _backup_lock.acquire(blocking=False):
+        raise BackupBusy("a backup or restore is already running")
+    try:
+        passes = [(backup_path, db_path, MIGRATIONS)]
+        if archive_db_path and os.path.exists(archive_backup_path(backup_path)):
+            passes.append((archive_backup_path(backup_path), archive_db_path, ARCHIVE_MIGRATIONS))
+        raw_paths = []
+        sources = []
+        try:
+            for path, _, migrations in passes:
+                raw_paths.append(_unpack(path))
+                src = sqlite3.connect(raw_paths[-1])
+                sources.append(src)
+                check = src.execute("PRAGMA integrity_check").fetchone()[0]
+                if check != "ok":
+                    raise ValueError(f"{os.path.basename(path)} failed integrity check: {check}")
+                version = schema_version(src)
+                if version > migrations[-1][0]:
+                    raise ValueError(
+                        f"{os.path.basename(path)} has schema version {version}, newer than this code's {migrations[-1][0]}"
+                    )
+            pages = seconds = 0
+            for src, (_, live_path, _) in zip(sources, passes):
+                dst = sqlite3.connect(live_path, timeout=30)
+                try:
+                    n, s = _copy(src, dst, pages_per_step, step_sleep, progress)
+                finally:
+                    dst.close()
+                pages += n
+                seconds += s
+            applied = _migrate(db_path, archive_db_path)
+        finally:
+            for src in sources:
+                src.close()
+            for raw_path in raw_paths:
+                os.remove(raw_path)
+        return {'pages': pages, 'seconds': seconds, 'archive': len(passes) > 1, 'migrations': applied}
+    finally:
+        _backup_lock.release()
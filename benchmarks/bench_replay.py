@@ -0,0 +1,437 @@
+"""Replay benchmark: synthetic Telegram updates through the Flask webhook.
+
+Run from the repository root:
+
+    python benchmarks/bench_replay.py --dataset 1k [--updates 20000]
+    python benchmarks/bench_replay.py --dataset 100k --compare old.json
+
+A realistic update stream (/start with referral, balance checks, task_gen
+clicks followed by done/cancel, withdraw conversations, admin approvals)
+is generated up front, the database is seeded with the chosen number of
+users, and the stream is posted to /webhook/<token> through the Flask test
+client. The Telegram API is stubbed (optionally with --api-latency-ms), so
+the numbers cover decoding, queueing, handlers and SQLite only.
+
+Latency is measured per update from the webhook POST to the end of its
+handler (queue wait included). Results are written as JSON; --compare
+prints the change against an earlier result file.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+from migrations import migrate  # noqa: E402
+from router import encode_callback  # noqa: E402
+
+DATASETS = {"1k": 1_000, "100k": 100_000, "1m": 1_000_000}
+TOKEN = "123456:BENCH"
+ADMIN = 999
+BASE_UID = 10_000_000
+NEW_UID = 90_000_000
+
+# callback action codes, same as main.py
+CB_DONE_TASK, CB_CANCEL_TASK, CB_APPROVE_TASK, CB_APPROVE_WD = "dt", "ct", "at", "aw"
+
+# scenario -> weight; each scenario is one user's sequence of updates
+SCENARIOS = {
+    "start_referral": 10,
+    "balance": 30,
+    "task_done": 20,
+    "task_cancel": 10,
+    "withdraw": 10,
+    "help": 5,
+    "approve_task": 10,
+    "approve_withdraw": 5,
+}
+
+
+# ------------------------------------------------------------
+# Update stream
+# ------------------------------------------------------------
+
+class StreamBuilder:
+    """Builds update dicts, interleaving sessions but keeping each user's order."""
+
+    def __init__(self, users, seed):
+        self.users = users
+        self.rng = random.Random(seed)
+        self.update_id = 0
+        self.next_task_id = {}  # uid -> next task_id cb_task_gen will hand out
+        self.new_users = 0
+        self.pending_tasks = 0      # seeded pending_admin tasks consumed
+        self.pending_withdraws = 0  # seeded pending withdraws consumed
+
+    def _update(self, body):
+        self.update_id += 1
+        body["update_id"] = self.update_id
+        return body
+
+    def message(self, uid, text):
+        msg = {
+            "message_id": self.update_id + 1, "date": 0, "text": text,
+            "chat": {"id": uid, "type": "private"},
+            "from": {"id": uid, "is_bot": False, "first_name": "u"},
+        }
+        if text.startswith("/"):
+            msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return self._update({"message": msg})
+
+    def callback(self, uid, data):
+        return self._update({"callback_query": {
+            "id": str(self.update_id + 1), "chat_instance": "bench", "data": data,
+            "from": {"id": uid, "is_bot": False, "first_name": "u"},
+            "message": {"message_id": 1, "date": 0, "chat": {"id": uid, "type": "private"}, "text": "menu"},
+        }})
+
+    def rich_user(self):
+        # every 4th seeded user has enough balance to withdraw repeatedly
+        return BASE_UID + self.rng.randrange(0, self.users, 4)
+
+    def session(self, kind):
+        if kind == "start_referral":
+            self.new_users += 1
+            uid = NEW_UID + self.new_users
+            referrer = BASE_UID + self.rng.randrange(self.users)
+            return uid, [lambda: self.message(uid, f"/start {referrer}"), lambda: self.message(uid, "💼 Balance")]
+        if kind in ("approve_task", "approve_withdraw"):
+            if kind == "approve_task":
+                self.pending_tasks += 1
+                data = encode_callback(CB_APPROVE_TASK, self.pending_tasks)
+            else:
+                self.pending_withdraws += 1
+                data = encode_callback(CB_APPROVE_WD, self.pending_withdraws)
+            return ADMIN, [lambda: self.callback(ADMIN, data)]
+
+        uid = self.rich_user() if kind == "withdraw" else BASE_UID + self.rng.randrange(self.users)
+        if kind == "balance":
+            return uid, [lambda: self.message(uid, "💼 Balance")]
+        if kind == "help":
+            return uid, [lambda: self.message(uid, "❓ Help")]
+        if kind in ("task_done", "task_cancel"):
+            task_id = self.next_task_id.get(uid, 1)
+            self.next_task_id[uid] = task_id + 1
+            action = CB_DONE_TASK if kind == "task_done" else CB_CANCEL_TASK
+            return uid, [
+                lambda: self.callback(uid, "task_gen"),
+                lambda: self.callback(uid, encode_callback(action, uid, task_id)),
+            ]
+        method = self.rng.choice(("easypaisa", "jazzcash", "bank"))
+        return uid, [
+            lambda: self.message(uid, "💰 Withdraw"),
+            lambda: self.callback(uid, f"wd_{method}"),
+            lambda: self.message(uid, "200"),
+            lambda: self.message(uid, "Bench User"),
+            lambda: self.message(uid, "03001234567"),
+        ]
+
+    def build(self, n_updates, concurrency=64):
+        """Return [(scenario, update dict)] of length n_updates."""
+        kinds = list(SCENARIOS)
+        weights = [SCENARIOS[k] for k in kinds]
+        active = []  # [uid, scenario, remaining steps]
+        busy = set()
+        out = []
+        while len(out) < n_updates:
+            while len(active) < concurrency:
+                kind = self.rng.choices(kinds, weights)[0]
+                if kind in ("approve_task", "approve_withdraw") and ADMIN in busy:
+                    kind = "balance"
+                uid, steps = self.session(kind)
+                if uid in busy:
+                    continue
+                busy.add(uid)
+                active.append([uid, kind, steps])
+            i = self.rng.randrange(len(active))
+            uid, kind, steps = active[i]
+            out.append((kind, steps.pop(0)()))
+            if not steps:
+                busy.discard(uid)
+                active.pop(i)
+        return out
+
+
+# ------------------------------------------------------------
+# Dataset
+# ------------------------------------------------------------
+
+def seed_database(path, users, pending_tasks, pending_withdraws, seed):
+    rng = random.Random(seed)
+    now = int(time.time())
+    conn = sqlite3.connect(path)
+    migrate(conn)
+    conn.execute("BEGIN")
+    conn.executemany(
+        "INSERT INTO users (id, balance, hold, tasks_completed, referrer, referrals_count, referral_earned, next_task_id) "
+        "VALUES (?, ?, 0, 0, NULL, 0, 0, 1)",
+        ((BASE_UID + i, 100_000 if i % 4 == 0 else rng.randrange(0, 500)) for i in range(users)),
+    )
+    conn.executemany(
+        "INSERT INTO tasks (id, user_id, task_id, type, email, password, reward, status, created_at) "
+        "VALUES (?, ?, ?, 'generated', 'bench@gmail.com', 'x', 40, 'pending_admin', CAST(strftime('%s', 'now') AS INTEGER))",
+        ((i + 1, BASE_UID + rng.randrange(users), 1_000_000 + i) for i in range(pending_tasks)),
+    )
+    # each pending withdraw sits on one user's hold, as state_account_number leaves it
+    wd_users = rng.sample(range(users), min(users, pending_withdraws))
+    conn.executemany(
+        "INSERT INTO withdraws (id, user_id, method, account_name, account_number, pkr_amount, usd_amount, status, created_at) "
+        "VALUES (?, ?, 'easypaisa', 'Bench User', '03001234567', 200, NULL, 'pending', CAST(strftime('%s', 'now') AS INTEGER))",
+        ((i + 1, BASE_UID + wd_users[i % len(wd_users)]) for i in range(pending_withdraws)),
+    )
+    conn.execute(
+        "UPDATE users SET hold = hold + 200 * (SELECT COUNT(*) FROM withdraws w WHERE w.user_id = users.id) "
+        "WHERE id IN (SELECT user_id FROM withdraws)"
+    )
+    conn.execute(
+        "INSERT INTO ledger (user_id, delta_balance, delta_hold, reason, ref_id, created_at) "
+        "SELECT id, balance, hold, 'opening', NULL, ? FROM users WHERE balance != 0 OR hold != 0",
+        (now,),
+    )
+    conn.commit()
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.close()
+
+
+def db_bytes(path):
+    return sum(os.path.getsize(p) for p in (path, path + "-wal") if os.path.exists(p))
+
+
+# ------------------------------------------------------------
+# Telegram stub
+# ------------------------------------------------------------
+
+class FakeResponse:
+    status_code = 200
+    reason = "OK"
+
+    def __init__(self, result):
+        self._body = {"ok": True, "result": result}
+        self.text = json.dumps(self._body)
+
+    def json(self):
+        return self._body
+
+
+def install_telegram_stub(latency):
+    from telebot import apihelper
+
+    calls = {}
+    lock = threading.Lock()
+
+    def sender(method, url, **kwargs):
+        name = url.rsplit("/", 1)[1]
+        with lock:
+            calls[name] = calls.get(name, 0) + 1
+        if latency:
+            time.sleep(latency)
+        if name == "getMe":
+            return FakeResponse({"id": 1, "is_bot": True, "first_name": "bench", "username": "benchbot"})
+        if name == "sendMessage":
+            chat_id = int((kwargs.get("params") or {}).get("chat_id", 0))
+            return FakeResponse({"message_id": 1, "date": 0, "chat": {"id": chat_id, "type": "private"}, "text": ""})
+        return FakeResponse(True)
+
+    apihelper.CUSTOM_REQUEST_SENDER = sender
+    return calls
+
+
+# ------------------------------------------------------------
+# Run
+# ------------------------------------------------------------
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    k = min(len(sorted_values) - 1, max(0, int(round(p / 100 * len(sorted_values))) - 1))
+    return sorted_values[k]
+
+
+def summarize(latencies):
+    values = sorted(latencies)
+    return {
+        "count": len(values),
+        "p50_ms": percentile(values, 50) * 1000,
+        "p95_ms": percentile(values, 95) * 1000,
+        "p99_ms": percentile(values, 99) * 1000,
+        "max_ms": (values[-1] if values else 0.0) * 1000,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except Exception:
+        return None
+
+
+def run(args):
+    users = DATASETS.get(args.dataset) or int(args.dataset)
+    workdir = args.workdir or tempfile.mkdtemp(prefix="bench-replay-")
+    os.makedirs(workdir, exist_ok=True)
+    db_path = os.path.join(workdir, "bench.sqlite")
+    for p in (db_path, db_path + "-wal", db_path + "-shm"):
+        if os.path.exists(p):
+            os.remove(p)
+
+    os.environ.update({
+        "BOT_TOKEN": TOKEN,
+        "WEBHOOK_URL": "http://bench.invalid",
+        "ADMIN_CHAT_ID": str(ADMIN),
+        "BOT_USERNAME": "benchbot",
+        "SQLITE_DB": db_path,
+        "OUTBOUND_GLOBAL_RATE": "1000000",
+        "OUTBOUND_CHAT_RATE": "1000000",
+        "OUTBOUND_CHAT_BURST": "1000000",
+    })
+    os.chdir(workdir)
+    calls = install_telegram_stub(args.api_latency_ms / 1000)
+    import main
+
+    builder = StreamBuilder(users, args.seed)
+    stream = builder.build(args.updates)
+    print(f"dataset {users} users, {len(stream)} updates, db {db_path}")
+
+    started = time.perf_counter()
+    seed_database(db_path, users, builder.pending_tasks, builder.pending_withdraws, args.seed)
+    seed_seconds = time.perf_counter() - started
+    db_before = db_bytes(db_path)
+    print(f"seeded in {seed_seconds:.1f}s ({db_before / 1e6:.1f} MB)")
+
+    bodies = [(kind, u["update_id"], json.dumps(u).encode()) for kind, u in stream]
+    posted = {}
+    done = {}
+    process = main.bot.process_new_updates
+
+    def timed_process(updates):
+        process(updates)
+        t = time.perf_counter()
+        for u in updates:
+            done[u.update_id] = t
+
+    main.bot.process_new_updates = timed_process
+    client = main.app.test_client()
+    path = f"/webhook/{TOKEN}"
+    ack = []
+    rejected = 0
+
+    started = time.perf_counter()
+    for kind, update_id, body in bodies:
+        t = time.perf_counter()
+        posted[update_id] = t
+        r = client.post(path, data=body)
+        ack.append(time.perf_counter() - t)
+        if r.status_code != 200:
+            rejected += 1
+    main.UPDATE_DISPATCHER.join()
+    handled_at = time.perf_counter()
+    main.OUTBOUND.join()
+    elapsed = handled_at - started
+
+    by_kind = {}
+    latencies = []
+    for kind, update_id, _ in bodies:
+        if update_id in done:
+            lat = done[update_id] - posted[update_id]
+            latencies.append(lat)
+            by_kind.setdefault(kind, []).append(lat)
+
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    counts = {t: conn.execute(f"SELECT COUNT(*) FROM {t}").fetchone()[0] for t in ("users", "tasks", "withdraws", "ledger")}
+    conn.close()
+    db_after = db_bytes(db_path)
+
+    result = {
+        "benchmark": "replay",
+        "git_revision": git_revision(),
+        "timestamp": int(time.time()),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "dataset_users": users,
+        "updates": len(bodies),
+        "seed": args.seed,
+        "api_latency_ms": args.api_latency_ms,
+        "update_workers": main.UPDATE_WORKERS,
+        "seed_seconds": seed_seconds,
+        "elapsed_seconds": elapsed,
+        "throughput_updates_per_s": len(latencies) / elapsed if elapsed else 0.0,
+        "rejected": rejected,
+        "latency": summarize(latencies),
+        "webhook_ack": summarize(ack),
+        "latency_by_scenario": {k: summarize(v) for k, v in sorted(by_kind.items())},
+        "telegram_calls": dict(sorted(calls.items())),
+        "rows": counts,
+        "db_bytes_before": db_before,
+        "db_bytes_after": db_after,
+        "db_bytes_growth": db_after - db_before,
+        "db_bytes_per_update": (db_after - db_before) / len(bodies) if bodies else 0.0,
+    }
+    return result
+
+
+def print_result(r):
+    lat = r["latency"]
+    print(f"\n{r['updates']} updates in {r['elapsed_seconds']:.2f}s: {r['throughput_updates_per_s']:.0f} updates/s"
+          f" ({r['rejected']} rejected)")
+    print(f"latency p50 {lat['p50_ms']:.2f} ms  p95 {lat['p95_ms']:.2f} ms  p99 {lat['p99_ms']:.2f} ms  max {lat['max_ms']:.2f} ms")
+    print(f"webhook ack p99 {r['webhook_ack']['p99_ms']:.2f} ms")
+    for kind, s in r["latency_by_scenario"].items():
+        print(f"  {kind:<18} n={s['count']:<6} p50 {s['p50_ms']:7.2f}  p99 {s['p99_ms']:7.2f} ms")
+    print(f"db {r['db_bytes_before'] / 1e6:.2f} MB -> {r['db_bytes_after'] / 1e6:.2f} MB"
+          f" ({r['db_bytes_per_update']:.0f} bytes/update)")
+
+
+def compare(new, old_path):
+    with open(old_path) as f:
+        old = json.load(f)
+
+    def delta(label, a, b, lower_is_better=True):
+        change = (b - a) / a * 100 if a else 0.0
+        worse = change > 0 if lower_is_better else change < 0
+        flag = "  <-- regression" if worse and abs(change) > 10 else ""
+        print(f"  {label:<22} {a:10.2f} -> {b:10.2f}  ({change:+.1f}%){flag}")
+
+    print(f"\ncompared with {old_path} ({old.get('git_revision')}, {old.get('dataset_users')} users):")
+    delta("throughput upd/s", old["throughput_updates_per_s"], new["throughput_updates_per_s"], lower_is_better=False)
+    for p in ("p50_ms", "p95_ms", "p99_ms"):
+        delta(f"latency {p}", old["latency"][p], new["latency"][p])
+    delta("db bytes/update", old["db_bytes_per_update"], new["db_bytes_per_update"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--dataset", default="1k", help="1k, 100k, 1m or a user count")
+    parser.add_argument("--updates", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--api-latency-ms", type=float, default=0.0, help="simulated Telegram API latency")
+    parser.add_argument("--workdir", help="where the benchmark database is created (default: temp dir)")
+    parser.add_argument("--out", help="result JSON path (default: benchmarks/results/replay-<dataset>-<time>.json)")
+    parser.add_argument("--compare", help="earlier result JSON to compare against")
+    args = parser.parse_args()
+
+    out = os.path.abspath(args.out or os.path.join(
+        ROOT, "benchmarks", "results", f"replay-{args.dataset}-{time.strftime('%Y%m%d-%H%M%S')}.json"))
+    compare_path = os.path.abspath(args.compare) if args.compare else None
+
+    result = run(args)
+    print_result(result)
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(result, f, indent=2)
+    print(f"\nresults written to {out}")
+    if compare_path:
+        compare(result, compare_path)
+
+
+if __name__ == "__main__":
+    main()
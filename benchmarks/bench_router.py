@@ -0,0 +1,163 @@
+"""Micro-benchmark: table-driven routing vs the old if/startswith chain.
+
+Run from the repository root:
+
+    python benchmarks/bench_router.py [iterations]
+
+Only routing and argument parsing are measured; handlers are no-ops.
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from router import CallbackRouter, TextRouter, encode_callback  # noqa: E402
+
+ADMIN = 999
+
+
+def _noop(*args):
+    return args
+
+
+# ------------------------------------------------------------
+# The routing logic callback_query / handle_text used before
+# ------------------------------------------------------------
+
+def legacy_callback(data, caller):
+    if data == "task_gen" and caller != ADMIN:
+        return _noop(caller)
+    if data == "task_own" and caller != ADMIN:
+        return _noop(caller)
+    if data == "task_fb" and caller != ADMIN:
+        return _noop(caller)
+    if data == "help":
+        return _noop(caller)
+    if data.startswith("wd_") and caller is not None and caller != ADMIN:
+        return _noop(caller, data.split("_", 1)[1])
+    if data.startswith("done_task_"):
+        parts = data.split("_")
+        return _noop(caller, int(parts[2]), int(parts[3]))
+    if data.startswith("cancel_task_"):
+        parts = data.split("_")
+        return _noop(caller, int(parts[2]), int(parts[3]))
+    if data.startswith("approve_task_") and caller == ADMIN:
+        return _noop(caller, int(data.split("_")[2]))
+    if data.startswith("reject_task_") and caller == ADMIN:
+        return _noop(caller, int(data.split("_")[2]))
+    if data.startswith("approve_wd_") and caller == ADMIN:
+        return _noop(caller, int(data.split("_")[2]))
+    if data.startswith("reject_wd_") and caller == ADMIN:
+        return _noop(caller, int(data.split("_")[2]))
+    return None
+
+
+def legacy_text(text):
+    if text.lower() in ["💼 balance", "balance"]:
+        return _noop()
+    if text.lower() in ["💰 withdraw", "withdraw"]:
+        return _noop()
+    if text.lower() in ["📝 tasks", "tasks"]:
+        return _noop()
+    if text.lower() in ["🔗 referral link", "referral", "/referral"]:
+        return _noop()
+    if text.lower() in ["❓ help", "/help", "help"]:
+        return _noop()
+    return None
+
+
+# ------------------------------------------------------------
+# Table-driven equivalents (same registrations as main.py)
+# ------------------------------------------------------------
+
+def build_callback_router():
+    r = CallbackRouter()
+    for data in ("task_gen", "task_own", "task_fb"):
+        r.exact(data, _noop, "user")
+    r.exact("help", _noop)
+    for method in ("easypaisa", "jazzcash", "bank", "binance"):
+        r.exact(f"wd_{method}", _noop, "user", method)
+    r.action("dt", _noop, 2, legacy_prefix="done_task")
+    r.action("ct", _noop, 2, legacy_prefix="cancel_task")
+    r.action("at", _noop, 1, "admin", legacy_prefix="approve_task")
+    r.action("rt", _noop, 1, "admin", legacy_prefix="reject_task")
+    r.action("aw", _noop, 1, "admin", legacy_prefix="approve_wd")
+    r.action("rw", _noop, 1, "admin", legacy_prefix="reject_wd")
+    return r
+
+
+def build_text_router():
+    r = TextRouter()
+    r.command(_noop, "💼 balance", "balance")
+    r.command(_noop, "💰 withdraw", "withdraw")
+    r.command(_noop, "📝 tasks", "tasks")
+    r.command(_noop, "🔗 referral link", "referral", "/referral")
+    r.command(_noop, "❓ help", "/help", "help")
+    return r
+
+
+def routed_callback(router, data, caller):
+    route = router.resolve(data)
+    if route is None:
+        return None
+    handler, who, args = route
+    if who == "admin" and caller != ADMIN:
+        return None
+    if who == "user" and (caller is None or caller == ADMIN):
+        return None
+    return handler(caller, *args)
+
+
+def routed_text(router, text):
+    handler = router.resolve_command(text)
+    return handler() if handler else None
+
+
+# Mix weighted towards what users actually press
+USER_ID, TASK_ID, ROW_ID = 5123456789, 4821, 1048576
+LEGACY_CALLS = [
+    ("task_gen", USER_ID),
+    (f"done_task_{USER_ID}_{TASK_ID}", USER_ID),
+    (f"cancel_task_{USER_ID}_{TASK_ID}", USER_ID),
+    ("wd_easypaisa", USER_ID),
+    (f"approve_task_{ROW_ID}", ADMIN),
+    (f"reject_wd_{ROW_ID}", ADMIN),
+]
+CODEC_CALLS = [
+    ("task_gen", USER_ID),
+    (encode_callback("dt", USER_ID, TASK_ID), USER_ID),
+    (encode_callback("ct", USER_ID, TASK_ID), USER_ID),
+    ("wd_easypaisa", USER_ID),
+    (encode_callback("at", ROW_ID), ADMIN),
+    (encode_callback("rw", ROW_ID), ADMIN),
+]
+TEXTS = ["💼 Balance", "Tasks", "❓ Help", "🔗 Referral Link", "500", "Ali Khan"]
+
+
+def bench(label, fn, n):
+    seconds = min(timeit.repeat(fn, number=n, repeat=5))
+    per_op = seconds / (n * 6) * 1e9
+    print(f"{label:<38} {per_op:8.1f} ns/op")
+    return per_op
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    cb_router = build_callback_router()
+    text_router = build_text_router()
+
+    print(f"{n} iterations x 6 inputs, best of 5\n")
+    old_cb = bench("callback: if/startswith chain", lambda: [legacy_callback(d, c) for d, c in LEGACY_CALLS], n)
+    new_cb = bench("callback: router, codec data", lambda: [routed_callback(cb_router, d, c) for d, c in CODEC_CALLS], n)
+    bench("callback: router, legacy data", lambda: [routed_callback(cb_router, d, c) for d, c in LEGACY_CALLS], n)
+    old_tx = bench("text: `in [...]` chain", lambda: [legacy_text(t) for t in TEXTS], n)
+    new_tx = bench("text: dict lookup", lambda: [routed_text(text_router, t) for t in TEXTS], n)
+
+    print(f"\ncallback speed-up: {old_cb / new_cb:.2f}x   text speed-up: {old_tx / new_tx:.2f}x")
+    sizes = [(len(a), len(b)) for (a, _), (b, _) in zip(LEGACY_CALLS, CODEC_CALLS)]
+    print("callback data bytes (legacy -> codec):", ", ".join(f"{a}->{b}" for a, b in sizes))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+"""Local stand-in for the Telegram Bot API, for offline load tests.
+
+Run it, then start the bot pointed at it:
+
+    python benchmarks/fake_bot_api.py --port 8081 --latency-ms 40 --chat-rate 1
+    TELEGRAM_API_URL=http://127.0.0.1:8081 gunicorn main:app ...
+
+Implements sendMessage, answerCallbackQuery, sendDocument, getMe,
+setWebhook and deleteWebhook. Every call waits --latency-ms (+/- jitter).
+A random --error-rate fraction of calls is answered with 429. Calls over the
+--chat-rate / --global-rate limits are also answered with 429, with a
+retry_after computed from the bucket, like the real API. GET /stats returns
+per-method counts and 429 totals; POST /reset clears them.
+"""
+import argparse
+import math
+import random
+import threading
+import time
+
+from flask import Flask, jsonify, request
+
+app = Flask(__name__)
+CONFIG = {
+    'latency': 0.0,
+    'jitter': 0.0,
+    'error_rate': 0.0,
+    'retry_after': 1,
+    'chat_rate': 0.0,
+    'chat_burst': 3,
+    'global_rate': 0.0,
+    'username': "fakebot",
+}
+
+
+class Bucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        """Return 0 if a token was taken, else seconds until one is available."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.calls = {}
+        self.limited = {'injected': 0, 'chat': 0, 'global': 0}
+        self.chats = set()
+        self.webhook = None
+        self.started = time.time()
+        self.last_call = None
+        self.chat_buckets = {}
+        self.global_bucket = None
+
+    def snapshot(self):
+        with self.lock:
+            elapsed = (self.last_call or time.time()) - self.started
+            total = sum(self.calls.values())
+            return {
+                'calls': dict(self.calls),
+                'total': total,
+                'rate_limited': dict(self.limited),
+                'chats': len(self.chats),
+                'webhook': self.webhook,
+                'started': self.started,
+                'last_call': self.last_call,
+                'calls_per_second': total / elapsed if elapsed > 0 else 0.0,
+            }
+
+
+STATS = Stats()
+
+
+def _params():
+    params = request.values.to_dict()
+    body = request.get_json(silent=True)
+    if isinstance(body, dict):
+        params.update(body)
+    return params
+
+
+def _too_many(kind, retry_after):
+    with STATS.lock:
+        STATS.limited[kind] += 1
+    body = {
+        'ok': False,
+        'error_code': 429,
+        'description': f"Too Many Requests: retry after {retry_after}",
+        'parameters': {'retry_after': retry_after},
+    }
+    return jsonify(body), 429
+
+
+def _rate_limit(chat_id):
+    """Return the retry_after to answer with, as (kind, seconds), or None."""
+    with STATS.lock:
+        if CONFIG['global_rate']:
+            if STATS.global_bucket is None:
+                STATS.global_bucket = Bucket(CONFIG['global_rate'], CONFIG['global_rate'])
+            wait = STATS.global_bucket.take()
+            if wait:
+                return 'global', max(1, math.ceil(wait))
+        if CONFIG['chat_rate'] and chat_id is not None:
+            bucket = STATS.chat_buckets.get(chat_id)
+            if bucket is None:
+                bucket = STATS.chat_buckets[chat_id] = Bucket(CONFIG['chat_rate'], CONFIG['chat_burst'])
+            wait = bucket.take()
+            if wait:
+                return 'chat', max(1, math.ceil(wait))
+    return None
+
+
+def _message(chat_id, text):
+    return {
+        'message_id': random.randrange(1, 2 ** 31),
+        'date': int(time.time()),
+        'chat': {'id': chat_id, 'type': 'private'},
+        'text': text or "",
+    }
+
+
+METHODS = {
+    'getme': lambda p: {'id': 1, 'is_bot': True, 'first_name': "Fake", 'username': CONFIG['username']},
+    'sendmessage': lambda p: _message(int(p.get('chat_id', 0)), p.get('text')),
+    'senddocument': lambda p: _message(int(p.get('chat_id', 0)), p.get('caption')),
+    'answercallbackquery': lambda p: True,
+    'deletewebhook': lambda p: True,
+}
+
+
+@app.route('/bot<token>/<method>', methods=['GET', 'POST'])
+def bot_method(token, method):
+    params = _params()
+    name = method.lower()
+    now = time.time()
+    with STATS.lock:
+        STATS.calls[method] = STATS.calls.get(method, 0) + 1
+        STATS.last_call = now
+
+    if CONFIG['latency'] or CONFIG['jitter']:
+        time.sleep(max(0.0, CONFIG['latency'] + random.uniform(-CONFIG['jitter'], CONFIG['jitter'])))
+
+    if name == 'setwebhook':
+        with STATS.lock:
+            STATS.webhook = params.get('url')
+        return jsonify({'ok': True, 'result': True, 'description': "Webhook was set"})
+    handler = METHODS.get(name)
+    if handler is None:
+        return jsonify({'ok': False, 'error_code': 404, 'description': "Not Found"}), 404
+
+    if name.startswith('send'):
+        chat_id = int(params.get('chat_id', 0))
+        with STATS.lock:
+            STATS.chats.add(chat_id)
+        if CONFIG['error_rate'] and random.random() < CONFIG['error_rate']:
+            return _too_many('injected', CONFIG['retry_after'])
+        limited = _rate_limit(chat_id)
+        if limited:
+            return _too_many(*limited)
+    return jsonify({'ok': True, 'result': handler(params)})
+
+
+@app.route('/stats')
+def stats():
+    return jsonify(STATS.snapshot())
+
+
+@app.route('/reset', methods=['POST'])
+def reset():
+    with STATS.lock:
+        STATS.reset()
+    return jsonify({'ok': True})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Telegram Bot API server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of send* calls answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after for injected 429s")
+    parser.add_argument("--chat-rate", type=float, default=0.0, help="per-chat messages/s before 429 (0 = off)")
+    parser.add_argument("--chat-burst", type=int, default=3)
+    parser.add_argument("--global-rate", type=float, default=0.0, help="messages/s across all chats before 429 (0 = off)")
+    parser.add_argument("--username", default="fakebot")
+    args = parser.parse_args()
+
+    CONFIG.update(
+        latency=args.latency_ms / 1000,
+        jitter=args.jitter_ms / 1000,
+        error_rate=args.error_rate,
+        retry_after=args.retry_after,
+        chat_rate=args.chat_rate,
+        chat_burst=args.chat_burst,
+        global_rate=args.global_rate,
+        username=args.username,
+    )
+    app.run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""Load generator: posts synthetic updates to a running bot's webhook.
+
+End-to-end capacity test against the real deployment, offline:
+
+    python benchmarks/fake_bot_api.py --port 8081 --latency-ms 40 &
+    TELEGRAM_API_URL=http://127.0.0.1:8081 BOT_TOKEN=123:LOAD WEBHOOK_URL=http://x \\
+        ADMIN_CHAT_ID=999 SQLITE_DB=/tmp/load.sqlite gunicorn --preload -w 4 main:app &
+    python benchmarks/load_webhook.py --url http://127.0.0.1:8000 --token 123:LOAD \\
+        --seed-db /tmp/load.sqlite --users 100000 --updates 50000 --concurrency 32 \\
+        --api-stats http://127.0.0.1:8081
+
+Updates come from the same stream as bench_replay.py. Each chat's updates
+are always sent by the same connection, in order, which is how Telegram
+delivers them. With --api-stats, the fake API's counters are reset before
+the run. Afterwards the script waits for the bot to stop calling the API,
+so the report includes when the last reply went out, not only when the
+last webhook POST was acknowledged. Admin notifications all go to one
+chat and are paced by OUTBOUND_CHAT_RATE, so they usually drain last.
+"""
+import argparse
+import http.client
+import json
+import os
+import sys
+import threading
+import time
+import urllib.request
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from bench_replay import ADMIN, StreamBuilder, seed_database, summarize  # noqa: E402
+from outbound import TokenBucket  # noqa: E402
+
+
+def chat_of(update):
+    if "message" in update:
+        return update["message"]["chat"]["id"]
+    return update["callback_query"]["from"]["id"]
+
+
+class Poster:
+    """One keep-alive HTTP connection; reconnects when the server closes it."""
+
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == "https" else 80)
+        self.cls = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+        self.conn = None
+
+    def post(self, path, body):
+        for attempt in (1, 2):
+            if self.conn is None:
+                self.conn = self.cls(self.host, self.port, timeout=30)
+            try:
+                self.conn.request("POST", path, body, {"Content-Type": "application/json"})
+                resp = self.conn.getresponse()
+                resp.read()
+                if resp.getheader("Connection", "").lower() == "close":
+                    self.conn.close()
+                    self.conn = None
+                return resp.status
+            except (http.client.HTTPException, OSError):
+                self.conn.close()
+                self.conn = None
+                if attempt == 2:
+                    return 0
+        return 0
+
+
+def api_stats(base, reset=False):
+    if reset:
+        urllib.request.urlopen(urllib.request.Request(base.rstrip("/") + "/reset", data=b"", method="POST"), timeout=10).read()
+        return None
+    with urllib.request.urlopen(base.rstrip("/") + "/stats", timeout=10) as r:
+        return json.load(r)
+
+
+def wait_for_drain(base, quiet_seconds=2.0, timeout=600):
+    """Poll the fake API until no calls arrive for quiet_seconds."""
+    deadline = time.time() + timeout
+    last_total, last_change = None, time.time()
+    while time.time() < deadline:
+        stats = api_stats(base)
+        if stats["total"] != last_total:
+            last_total, last_change = stats["total"], time.time()
+        elif time.time() - last_change >= quiet_seconds:
+            return stats
+        time.sleep(0.25)
+    return api_stats(base)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent webhook load generator")
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="bot base URL")
+    parser.add_argument("--token", required=True, help="BOT_TOKEN of the bot under test")
+    parser.add_argument("--updates", type=int, default=10000)
+    parser.add_argument("--users", type=int, default=1000, help="user ids in the stream (and seeded with --seed-db)")
+    parser.add_argument("--concurrency", type=int, default=16, help="parallel connections")
+    parser.add_argument("--rate", type=float, default=0.0, help="target updates/s (0 = as fast as possible)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--seed-db", help="seed this SQLite database with --users users before the run")
+    parser.add_argument("--api-stats", help="fake_bot_api.py base URL, to measure time until replies drain")
+    parser.add_argument("--out", help="write the result as JSON")
+    args = parser.parse_args()
+
+    builder = StreamBuilder(args.users, args.seed)
+    stream = builder.build(args.updates)
+    if args.seed_db:
+        started = time.perf_counter()
+        seed_database(args.seed_db, args.users, builder.pending_tasks, builder.pending_withdraws, args.seed)
+        print(f"seeded {args.users} users into {args.seed_db} in {time.perf_counter() - started:.1f}s")
+
+    lanes = [[] for _ in range(args.concurrency)]
+    for _, update in stream:
+        chat = chat_of(update)
+        # admin callbacks form one long ordered lane, like the real admin chat
+        lanes[0 if chat == ADMIN else 1 + chat % max(1, args.concurrency - 1)].append(json.dumps(update).encode())
+
+    if args.api_stats:
+        api_stats(args.api_stats, reset=True)
+
+    path = f"/webhook/{args.token}"
+    bucket = TokenBucket(args.rate, max(1, args.concurrency)) if args.rate else None
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+
+    def run_lane(bodies):
+        poster = Poster(args.url)
+        mine, codes = [], {}
+        for body in bodies:
+            if bucket is not None:
+                wait = bucket.reserve()
+                if wait > 0:
+                    time.sleep(wait)
+            t = time.perf_counter()
+            status = poster.post(path, body)
+            mine.append(time.perf_counter() - t)
+            codes[status] = codes.get(status, 0) + 1
+        with lock:
+            latencies.extend(mine)
+            for status, n in codes.items():
+                statuses[status] = statuses.get(status, 0) + n
+
+    started = time.perf_counter()
+    started_wall = time.time()
+    threads = [threading.Thread(target=run_lane, args=(lane,)) for lane in lanes if lane]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    sent_seconds = time.perf_counter() - started
+
+    result = {
+        "benchmark": "load_webhook",
+        "url": args.url,
+        "updates": len(stream),
+        "users": args.users,
+        "concurrency": args.concurrency,
+        "target_rate": args.rate,
+        "send_seconds": sent_seconds,
+        "webhook_updates_per_s": len(stream) / sent_seconds if sent_seconds else 0.0,
+        "status_codes": {str(k): v for k, v in sorted(statuses.items())},
+        "webhook_ack": summarize(latencies),
+    }
+    print(f"{len(stream)} updates posted in {sent_seconds:.2f}s: {result['webhook_updates_per_s']:.0f} updates/s")
+    print(f"status codes: {result['status_codes']}")
+    ack = result["webhook_ack"]
+    print(f"webhook ack p50 {ack['p50_ms']:.2f} ms  p95 {ack['p95_ms']:.2f} ms  p99 {ack['p99_ms']:.2f} ms")
+
+    if args.api_stats:
+        stats = wait_for_drain(args.api_stats)
+        drained = (stats["last_call"] or started_wall) - started_wall
+        result["api"] = stats
+        result["end_to_end_seconds"] = drained
+        result["end_to_end_updates_per_s"] = len(stream) / drained if drained > 0 else 0.0
+        print(f"last API call {drained:.2f}s after start: {result['end_to_end_updates_per_s']:.0f} updates/s end to end")
+        print(f"API calls: {stats['calls']}  rate limited: {stats['rate_limited']}")
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"results written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
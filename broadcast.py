@@ -0,0 +1,163 @@
+import os
+import threading
+import time
+import uuid
+
+from telebot.apihelper import ApiTelegramException
+
+import database
+import metrics
+from database import db_read, db_write
+from outbound import TokenBucket
+
+# ============================================================
+# BROADCAST ENGINE
+# ============================================================
+# Sends one text to every user. User ids are read in keyset chunks
+# (id > last ORDER BY id LIMIT chunk_size) rather than through one cursor
+# kept open for hours, which would pin a read snapshot and stop WAL
+# checkpoints. Each chunk is paced by a token bucket, queued on the
+# outbound dispatcher behind all interactive traffic, awaited and then
+# checkpointed. After a crash, only the chunk in flight can be sent twice.
+
+BROADCAST_MESSAGES = metrics.Counter("bot_broadcast_messages_total", "Broadcast messages by outcome", ("outcome",))
+
+
+def is_blocked(error):
+    # 403: the user blocked the bot or deleted their account
+    return isinstance(error, ApiTelegramException) and error.error_code == 403
+
+
+def describe(error):
+    if isinstance(error, ApiTelegramException):
+        return f"{error.error_code}: {error.description}"
+    return str(error)[:200]
+
+
+class Broadcaster:
+    """Runs broadcasts on background threads of this process.
+
+    `send(chat_id, text, on_done)` queues one message and later calls
+    on_done(error) with the final exception or None; `report(row, rate)`
+    gets the broadcast row and this run's messages/s every `report_every`
+    seconds and once at the end.
+    """
+
+    def __init__(self, send, report, rate=20, chunk_size=200, report_every=60, stale_after=120):
+        self.send = send
+        self.report = report
+        self.rate = rate
+        self.chunk_size = chunk_size
+        self.report_every = report_every
+        self.stale_after = stale_after
+        self._owner = (None, None)
+
+    def owner(self):
+        # fresh token per process: a forked child never inherits a broadcast
+        if self._owner[0] != os.getpid():
+            self._owner = (os.getpid(), f"{os.getpid()}-{uuid.uuid4().hex[:8]}")
+        return self._owner[1]
+
+    def start(self, broadcast_id):
+        """Start sending a draft; False if it is not a draft."""
+        owner = self.owner()
+        with db_write() as cur:
+            if not database.start_broadcast(cur, broadcast_id, owner, time.time()):
+                return False
+        self._spawn(broadcast_id, owner)
+        return True
+
+    def resume_stale(self):
+        """Take over running broadcasts whose sender went away; returns how many."""
+        owner = self.owner()
+        now = time.time()
+        with db_write() as cur:
+            ids = [
+                broadcast_id for broadcast_id in database.stale_broadcasts(cur, now - self.stale_after)
+                if database.claim_broadcast(cur, broadcast_id, owner, now, now - self.stale_after)
+            ]
+        for broadcast_id in ids:
+            self._spawn(broadcast_id, owner)
+        return len(ids)
+
+    def _spawn(self, broadcast_id, owner):
+        threading.Thread(target=self._run, args=(broadcast_id, owner), name=f"broadcast-{broadcast_id}", daemon=True).start()
+
+    def _run(self, broadcast_id, owner):
+        try:
+            self.run(broadcast_id, owner)
+        except Exception as e:
+            # the heartbeat stops, so the scheduler resumes it later
+            print(f"Broadcast {broadcast_id} failed:", e)
+
+    def run(self, broadcast_id, owner):
+        bucket = TokenBucket(self.rate, 1)
+        with db_read() as cur:
+            row = database.get_broadcast(cur, broadcast_id)
+        text, last_id = row['text'], row['last_user_id']
+        started = last_report = time.monotonic()
+        handled = 0
+        while True:
+            with db_read() as cur:
+                ids = database.user_ids_after(cur, last_id, self.chunk_size)
+            if not ids:
+                break
+            failures = self._send_chunk(ids, text, bucket)
+            blocked = sum(1 for f in failures if f[1])
+            with db_write() as cur:
+                running = database.checkpoint_broadcast(
+                    cur, broadcast_id, owner, ids[-1],
+                    len(ids) - len(failures), blocked, len(failures) - blocked, failures, time.time()
+                )
+            if not running:
+                return
+            last_id = ids[-1]
+            handled += len(ids)
+            if time.monotonic() - last_report >= self.report_every:
+                last_report = time.monotonic()
+                self._report(broadcast_id, handled / (last_report - started))
+        with db_write() as cur:
+            finished = database.finish_broadcast(cur, broadcast_id, owner, 'done', time.time())
+        if finished:
+            self._report(broadcast_id, handled / max(time.monotonic() - started, 1e-6))
+
+    def _send_chunk(self, ids, text, bucket):
+        """Send to `ids` and wait for every result; returns [(uid, blocked, error)]."""
+        results = []
+        cond = threading.Condition()
+
+        def on_done_for(uid):
+            def on_done(error):
+                with cond:
+                    results.append((uid, error))
+                    cond.notify()
+            return on_done
+
+        for uid in ids:
+            wait = bucket.reserve()
+            if wait > 0:
+                time.sleep(wait)
+            self.send(uid, text, on_done_for(uid))
+        with cond:
+            while len(results) < len(ids):
+                cond.wait()
+
+        failures = []
+        for uid, error in results:
+            if error is None:
+                BROADCAST_MESSAGES.inc("sent")
+            elif is_blocked(error):
+                BROADCAST_MESSAGES.inc("blocked")
+                failures.append((uid, True, describe(error)))
+            else:
+                BROADCAST_MESSAGES.inc("failed")
+                failures.append((uid, False, describe(error)))
+        return failures
+
+    def _report(self, broadcast_id, rate):
+        with db_read() as cur:
+            row = database.get_broadcast(cur, broadcast_id)
+        try:
+            self.report(row, rate)
+        except Exception as e:
+            print("Broadcast report failed:", e)
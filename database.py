@@ -1,58 +1,873 @@
-import sqlite3
 import os
+import queue
+import sqlite3
+import time
+from contextlib import contextmanager
+
+import metrics
+from migrations import ARCHIVE_MIGRATIONS, STATS_RECOUNT, migrate
+
+# ============================================================
+# DATA ACCESS
+# ============================================================
+# The bot's one SQLite database: connection pool, transaction helpers and
+# every query the bot runs, including those behind ledger.py and
+# state_store.py. Query functions take a cursor from db_read() /
+# db_write(), so the caller decides what shares a transaction. Their SQL is constant text: each statement is
+# prepared once per pooled connection and then served from sqlite3's
+# statement cache. Rows come back as sqlite3.Row; timestamps are integer
+# epoch seconds.
+
+DB_PATH = os.environ.get("SQLITE_DB", "bot.sqlite")
+# Cold storage for finished tasks / withdraws, ATTACHed as "archive" to
+# every connection (see ARCHIVE below)
+ARCHIVE_DB_PATH = os.environ.get("SQLITE_ARCHIVE_DB") or os.path.splitext(DB_PATH)[0] + "-archive.sqlite"
+
+# Connections are long-lived and pooled: opening sqlite3 connections per call
+# (and re-applying PRAGMAs / re-preparing statements) was a measurable share
+# of per-update latency. Tune via environment variables if needed.
+DB_POOL_SIZE = int(os.environ.get("SQLITE_POOL_SIZE", "8"))
+DB_STATEMENT_CACHE_SIZE = int(os.environ.get("SQLITE_STATEMENT_CACHE", "256"))
+DB_BUSY_TIMEOUT_MS = int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+
+SQLITE_PRAGMAS = (
+    ("journal_mode", "WAL"),
+    ("synchronous", "NORMAL"),
+    ("cache_size", int(os.environ.get("SQLITE_CACHE_KB", "16000")) * -1),
+    ("mmap_size", int(os.environ.get("SQLITE_MMAP_BYTES", str(256 * 1024 * 1024)))),
+    ("busy_timeout", DB_BUSY_TIMEOUT_MS),
+    ("temp_store", "MEMORY"),
+)
+
+SQL_SECONDS = metrics.Histogram("bot_sql_statement_seconds", "SQLite statement execute time by statement type", ("statement",))
+DB_WRITE_WAIT_SECONDS = metrics.Histogram("bot_db_write_wait_seconds", "Wait for the SQLite write lock (BEGIN IMMEDIATE)")
+DB_WRITE_HOLD_SECONDS = metrics.Histogram("bot_db_write_hold_seconds", "Write transaction time from BEGIN IMMEDIATE to commit/rollback")
+
+# ============================================================
+# CONNECTION POOL
+# ============================================================
+
+def _statement_kind(sql):
+    head = sql.lstrip()[:8].split(None, 1)
+    return head[0].upper() if head else "?"
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor recording execute() time (up to the first row) in SQL_SECONDS."""
+
+    def execute(self, sql, params=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, params)
+        finally:
+            SQL_SECONDS.observe(time.perf_counter() - started, _statement_kind(sql))
+
+    def executemany(self, sql, seq_of_params):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_params)
+        finally:
+            SQL_SECONDS.observe(time.perf_counter() - started, _statement_kind(sql))
+
+
+class PooledConnection(sqlite3.Connection):
+    """sqlite3 connection whose close() hands it back to the pool.
+
+    Call sites keep the familiar get_db_conn() / conn.close() pattern; any
+    transaction left open is rolled back before the connection is reused.
+    """
+
+    pool = None
+    pid = None
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+    def close(self):
+        if self.in_transaction and self.pid in (None, os.getpid()):
+            self.rollback()
+        if self.pool is None or not self.pool.release(self):
+            super().close()
+
+
+class ConnectionPool:
+    """LIFO pool of connections, private to the process that opened them.
+
+    SQLite connections must not cross fork(): the child would share the
+    parent's file handles but not its POSIX locks, and closing one there
+    can checkpoint and delete the WAL under the other processes. The pool
+    is emptied before every fork (see register_at_fork below) and, should
+    a connection still be inherited, it is parked unused, never closed.
+    """
+
+    def __init__(self, path, size, archive_path):
+        self.path = path
+        self.archive_path = archive_path
+        self.size = size
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._pid = os.getpid()
+        self._inherited = []
+
+    def _open(self):
+        conn = sqlite3.connect(
+            self.path,
+            check_same_thread=False,
+            timeout=DB_BUSY_TIMEOUT_MS / 1000,
+            cached_statements=DB_STATEMENT_CACHE_SIZE,
+            factory=PooledConnection,
+        )
+        conn.row_factory = sqlite3.Row
+        for name, value in SQLITE_PRAGMAS:
+            conn.execute(f"PRAGMA {name} = {value}")
+        conn.execute("ATTACH DATABASE ? AS archive", (self.archive_path,))
+        conn.execute("PRAGMA archive.journal_mode = WAL")
+        conn.execute("PRAGMA archive.synchronous = NORMAL")
+        conn.pool = self
+        conn.pid = self._pid
+        return conn
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            self._park(self._idle)
+            self._idle = queue.LifoQueue(maxsize=self.size)
+            self._pid = os.getpid()
+
+    def _park(self, idle):
+        while True:
+            try:
+                self._inherited.append(idle.get_nowait())
+            except queue.Empty:
+                return
+
+    def acquire(self):
+        self._check_pid()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self._open()
+
+    def release(self, conn):
+        self._check_pid()
+        if conn.pid != self._pid:
+            self._inherited.append(conn)
+            return True
+        try:
+            self._idle.put_nowait(conn)
+            return True
+        except queue.Full:
+            conn.pool = None
+            return False
+
+    def close_all(self):
+        self._check_pid()
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            conn.pool = None
+            conn.close()
+
+
+DB_POOL = ConnectionPool(DB_PATH, DB_POOL_SIZE, ARCHIVE_DB_PATH)
+# gunicorn --preload imports (and migrates) in the master, then forks
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(before=DB_POOL.close_all)
+
+
+def get_db_conn():
+    # borrow a pooled connection; conn.close() returns it to the pool
+    return DB_POOL.acquire()
+
+
+@contextmanager
+def db_read():
+    # plain reads run concurrently under WAL; no lock, no write transaction
+    conn = get_db_conn()
+    cur = conn.cursor()
+    try:
+        yield cur
+    finally:
+        cur.close()
+        conn.close()
+
+
+@contextmanager
+def db_write():
+    # BEGIN IMMEDIATE takes the write lock up front so check-then-update
+    # sequences inside the block cannot interleave with other writers
+    conn = get_db_conn()
+    started = time.perf_counter()
+    locked = None
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        locked = time.perf_counter()
+        DB_WRITE_WAIT_SECONDS.observe(locked - started)
+        cur = conn.cursor()
+        yield cur
+        # close explicitly: a half-read SELECT kept alive by another
+        # reference (e.g. a profiler-held frame) would block the commit
+        cur.close()
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        if locked is not None:
+            DB_WRITE_HOLD_SECONDS.observe(time.perf_counter() - locked)
+        conn.close()
 
-DB_PATH = "data.db"
 
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            balance INTEGER DEFAULT 0,
-            hold INTEGER DEFAULT 0,
-            clicks INTEGER DEFAULT 0,
-            invited_by INTEGER
+    """Migrate to the current schema; returns the migrations applied."""
+    conn = get_db_conn()
+    try:
+        applied = migrate(conn)
+        archive_applied = migrate(conn, ARCHIVE_MIGRATIONS, "archive")
+    finally:
+        conn.close()
+    for version, name in applied:
+        print(f"Applied schema migration {version}: {name}")
+    for version, name in archive_applied:
+        print(f"Applied archive migration {version}: {name}")
+    return applied + archive_applied
+
+# ============================================================
+# USERS
+# ============================================================
+
+def get_user(cur, uid):
+    cur.execute("SELECT * FROM users WHERE id = ?", (uid,))
+    return cur.fetchone()
+
+
+def create_user(cur, uid, referrer=None):
+    """Insert a new user (crediting the referrer's count); False if it exists."""
+    cur.execute(
+        "INSERT OR IGNORE INTO users (id, balance, hold, tasks_completed, referrer, referrals_count, referral_earned, next_task_id) VALUES (?, 0, 0, 0, ?, 0, 0, 1)",
+        (uid, referrer)
+    )
+    if not cur.rowcount:
+        return False
+    if referrer:
+        cur.execute("UPDATE users SET referrals_count = referrals_count + 1 WHERE id = ?", (referrer,))
+    return True
+
+
+def take_next_task_id(cur, uid):
+    """Reserve the user's next per-user task number; call inside db_write()."""
+    cur.execute("SELECT next_task_id FROM users WHERE id = ?", (uid,))
+    row = cur.fetchone()
+    if row is None:
+        return None
+    cur.execute("UPDATE users SET next_task_id = next_task_id + 1 WHERE id = ?", (uid,))
+    return row[0]
+
+
+def add_tasks_completed(cur, uid, n=1):
+    cur.execute("UPDATE users SET tasks_completed = tasks_completed + ? WHERE id = ?", (n, uid))
+
+
+def add_referral_earned(cur, uid, amount):
+    cur.execute("UPDATE users SET referral_earned = referral_earned + ? WHERE id = ?", (amount, uid))
+
+# ============================================================
+# TASKS
+# ============================================================
+
+def insert_task(cur, uid, task_id, type, reward, created_at, email=None, password=None, fb_id=None, twofa=None, status='draft'):
+    cur.execute(
+        "INSERT INTO tasks (user_id, task_id, type, email, password, fb_id, twofa, reward, status, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (uid, task_id, type, email, password, fb_id, twofa, reward, status, created_at)
+    )
+    return cur.lastrowid
+
+
+def get_task(cur, row_id):
+    cur.execute("SELECT * FROM tasks WHERE id = ?", (row_id,))
+    return cur.fetchone()
+
+
+def task_owner(cur, row_id):
+    cur.execute("SELECT user_id FROM tasks WHERE id = ?", (row_id,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def submit_draft_task(cur, uid, task_id):
+    """Move a user's draft to pending_admin; returns the task row or None."""
+    cur.execute("SELECT * FROM tasks WHERE user_id = ? AND task_id = ? AND status = 'draft'", (uid, task_id))
+    task = cur.fetchone()
+    if task:
+        cur.execute("UPDATE tasks SET status = 'pending_admin' WHERE id = ?", (task['id'],))
+    return task
+
+
+def delete_draft_task(cur, uid, task_id):
+    cur.execute("DELETE FROM tasks WHERE user_id = ? AND task_id = ? AND status = 'draft'", (uid, task_id))
+    return cur.rowcount
+
+
+def set_task_status(cur, row_id, status):
+    cur.execute("UPDATE tasks SET status = ? WHERE id = ?", (status, row_id))
+
+
+def delete_stale_drafts(cur, cutoff, limit):
+    """Delete up to `limit` drafts created before `cutoff`; returns rows deleted."""
+    cur.execute(
+        "DELETE FROM tasks WHERE id IN ("
+        " SELECT id FROM tasks WHERE status = 'draft' AND created_at < ? ORDER BY created_at LIMIT ?)",
+        (cutoff, limit)
+    )
+    return cur.rowcount
+
+# ============================================================
+# WITHDRAWS
+# ============================================================
+
+def insert_withdraw(cur, uid, method, account_name, account_number, pkr_amount, usd_amount, created_at, status='pending'):
+    cur.execute(
+        "INSERT INTO withdraws (user_id, method, account_name, account_number, pkr_amount, usd_amount, status, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        (uid, method, account_name, account_number, pkr_amount, usd_amount, status, created_at)
+    )
+    return cur.lastrowid
+
+
+def get_withdraw(cur, row_id):
+    cur.execute("SELECT * FROM withdraws WHERE id = ?", (row_id,))
+    return cur.fetchone()
+
+
+def withdraw_owner(cur, row_id):
+    cur.execute("SELECT user_id FROM withdraws WHERE id = ?", (row_id,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def set_withdraw_status(cur, row_id, status):
+    cur.execute("UPDATE withdraws SET status = ? WHERE id = ?", (status, row_id))
+
+
+def overdue_withdraws(cur, cutoff, limit):
+    """Pending withdraws created before `cutoff`: (count, total PKR, oldest `limit` rows)."""
+    cur.execute(
+        "SELECT COUNT(*), COALESCE(SUM(pkr_amount), 0) FROM withdraws WHERE status = 'pending' AND created_at < ?",
+        (cutoff,)
+    )
+    count, total = cur.fetchone()
+    cur.execute(
+        "SELECT * FROM withdraws WHERE status = 'pending' AND created_at < ? ORDER BY id LIMIT ?",
+        (cutoff, limit)
+    )
+    return count, total, cur.fetchall()
+
+
+def select_pending_withdraws(cur, method=None, ids=None):
+    """Fill temp.bulk_wd with pending withdraw ids (by ids, method or all)
+    and return their (id, user_id, pkr_amount) rows."""
+    cur.execute("CREATE TEMP TABLE IF NOT EXISTS bulk_wd (id INTEGER PRIMARY KEY)")
+    cur.execute("DELETE FROM temp.bulk_wd")
+    if ids is not None:
+        cur.executemany(
+            "INSERT OR IGNORE INTO temp.bulk_wd SELECT id FROM withdraws WHERE id = ? AND status = 'pending'",
+            [(i,) for i in ids]
         )
-    """)
-    conn.commit()
-    conn.close()
-
-def get_user(user_id):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT * FROM users WHERE user_id=?", (user_id,))
-    user = c.fetchone()
-    conn.close()
-    return user
-
-def create_user(user_id, invited_by=None):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("""
-        INSERT OR IGNORE INTO users (user_id, balance, hold, clicks, invited_by) 
-        VALUES (?, 0, 0, 0, ?)
-    """, (user_id, invited_by))
-    conn.commit()
-    conn.close()
-
-def update_balance(user_id, balance):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("UPDATE users SET balance=? WHERE user_id=?", (balance, user_id))
-    conn.commit()
-    conn.close()
-
-def update_hold(user_id, hold):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("UPDATE users SET hold=? WHERE user_id=?", (hold, user_id))
-    conn.commit()
-    conn.close()
-
-def update_clicks(user_id, clicks):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("UPDATE users SET clicks=? WHERE user_id=?", (clicks, user_id))
-    conn.commit()
-    conn.close()
+    elif method is not None:
+        cur.execute("INSERT INTO temp.bulk_wd SELECT id FROM withdraws WHERE status = 'pending' AND method = ?", (method,))
+    else:
+        cur.execute("INSERT INTO temp.bulk_wd SELECT id FROM withdraws WHERE status = 'pending'")
+    cur.execute(
+        "SELECT w.id, w.user_id, COALESCE(w.pkr_amount, 0) AS pkr_amount FROM withdraws w "
+        "JOIN temp.bulk_wd b ON b.id = w.id ORDER BY w.id"
+    )
+    return cur.fetchall()
+
+
+def settle_selected_withdraws(cur, status, refund, reason, now):
+    """Settle every withdraw in temp.bulk_wd with set-based UPDATEs.
+
+    Holds are released per user; `refund` (0 or 1) also credits the amount
+    back to the balance. Ledger rows are written for each withdraw.
+    """
+    # per-user totals keyed by user_id, so the users UPDATE is one
+    # primary-key probe per affected user
+    cur.execute("CREATE TEMP TABLE IF NOT EXISTS bulk_wd_user (user_id INTEGER PRIMARY KEY, total INTEGER NOT NULL)")
+    cur.execute("DELETE FROM temp.bulk_wd_user")
+    cur.execute(
+        "INSERT INTO temp.bulk_wd_user SELECT w.user_id, SUM(COALESCE(w.pkr_amount, 0)) FROM withdraws w "
+        "JOIN temp.bulk_wd b ON b.id = w.id GROUP BY w.user_id"
+    )
+    total_sql = "(SELECT total FROM temp.bulk_wd_user WHERE user_id = users.id)"
+    cur.execute(
+        f"UPDATE users SET hold = hold - {total_sql}, balance = balance + ? * {total_sql} "
+        "WHERE id IN (SELECT user_id FROM temp.bulk_wd_user)",
+        (refund,)
+    )
+    cur.execute(
+        "INSERT INTO ledger (user_id, delta_balance, delta_hold, reason, ref_id, created_at) "
+        "SELECT w.user_id, ? * COALESCE(w.pkr_amount, 0), -COALESCE(w.pkr_amount, 0), ?, w.id, ? "
+        "FROM withdraws w JOIN temp.bulk_wd b ON b.id = w.id",
+        (refund, reason, now)
+    )
+    cur.execute("UPDATE withdraws SET status = ? WHERE id IN (SELECT id FROM temp.bulk_wd)", (status,))
+
+# ============================================================
+# LEDGER
+# ============================================================
+# Storage for ledger.py, which owns the rules (every balance / hold change
+# is an entry; checkpoints fold entries into ledger_snapshot).
+
+def insert_ledger_entry(cur, uid, delta_balance, delta_hold, reason, ref_id, now):
+    cur.execute(
+        "INSERT INTO ledger (user_id, delta_balance, delta_hold, reason, ref_id, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+        (uid, delta_balance, delta_hold, reason, ref_id, now)
+    )
+
+
+def apply_balance_delta(cur, uid, delta_balance, delta_hold):
+    cur.execute(
+        "UPDATE users SET balance = balance + ?, hold = hold + ? WHERE id = ?",
+        (delta_balance, delta_hold, uid)
+    )
+
+
+def last_ledger_checkpoint(cur):
+    """Id of the last entry folded into ledger_snapshot (0 if none)."""
+    cur.execute("SELECT COALESCE(MAX(last_entry_id), 0) FROM ledger_checkpoints")
+    return cur.fetchone()[0]
+
+
+def last_ledger_entry(cur):
+    cur.execute("SELECT COALESCE(MAX(id), 0) FROM ledger")
+    return cur.fetchone()[0]
+
+
+def fold_ledger_entries(cur, since, upto, now):
+    """Add entries in (since, upto] to ledger_snapshot and record the checkpoint."""
+    cur.execute(
+        "INSERT INTO ledger_snapshot (user_id, balance, hold) "
+        "SELECT user_id, SUM(delta_balance), SUM(delta_hold) FROM ledger "
+        "WHERE id > ? AND id <= ? GROUP BY user_id "
+        "ON CONFLICT(user_id) DO UPDATE SET balance = balance + excluded.balance, hold = hold + excluded.hold",
+        (since, upto)
+    )
+    cur.execute(
+        "INSERT INTO ledger_checkpoints (last_entry_id, entries, created_at) VALUES (?, ?, ?)",
+        (upto, upto - since, now)
+    )
+
+
+def ledger_snapshot(cur, uid):
+    """(balance, hold) as of the last checkpoint, or None."""
+    cur.execute("SELECT balance, hold FROM ledger_snapshot WHERE user_id = ?", (uid,))
+    return cur.fetchone()
+
+
+def ledger_deltas_after(cur, uid, since):
+    """Summed (delta_balance, delta_hold) of one user's entries after `since`."""
+    cur.execute(
+        "SELECT COALESCE(SUM(delta_balance), 0), COALESCE(SUM(delta_hold), 0) FROM ledger WHERE user_id = ? AND id > ?",
+        (uid, since)
+    )
+    return cur.fetchone()
+
+
+def ledger_mismatches(cur, since, limit):
+    cur.execute(
+        "SELECT u.id, u.balance, u.hold,"
+        " COALESCE(s.balance, 0) + COALESCE(d.db, 0) AS ledger_balance,"
+        " COALESCE(s.hold, 0) + COALESCE(d.dh, 0) AS ledger_hold "
+        "FROM users u "
+        "LEFT JOIN ledger_snapshot s ON s.user_id = u.id "
+        "LEFT JOIN (SELECT user_id, SUM(delta_balance) AS db, SUM(delta_hold) AS dh"
+        "           FROM ledger WHERE id > ? GROUP BY user_id) d ON d.user_id = u.id "
+        "WHERE u.balance != COALESCE(s.balance, 0) + COALESCE(d.db, 0)"
+        "   OR u.hold != COALESCE(s.hold, 0) + COALESCE(d.dh, 0) "
+        "LIMIT ?",
+        (since, limit)
+    )
+    return cur.fetchall()
+
+
+def ledger_history(cur, uid, limit):
+    cur.execute(
+        "SELECT id, delta_balance, delta_hold, reason, ref_id, created_at FROM ledger "
+        "WHERE user_id = ? ORDER BY id DESC LIMIT ?",
+        (uid, limit)
+    )
+    return cur.fetchall()
+
+# ============================================================
+# CONVERSATION STATE
+# ============================================================
+# user_state rows behind state_store.SQLiteStateStore; temp is JSON text.
+
+def get_state(cur, uid, now):
+    cur.execute("SELECT state, temp FROM user_state WHERE user_id = ? AND expires_at > ?", (uid, now))
+    return cur.fetchone()
+
+
+def set_state(cur, uid, state, temp, expires_at):
+    cur.execute(
+        "INSERT OR REPLACE INTO user_state (user_id, state, temp, expires_at) VALUES (?, ?, ?, ?)",
+        (uid, state, temp, expires_at)
+    )
+
+
+def delete_state(cur, uid):
+    cur.execute("DELETE FROM user_state WHERE user_id = ?", (uid,))
+
+
+def expire_states(cur, now):
+    """Delete expired rows; returns rows deleted."""
+    cur.execute("DELETE FROM user_state WHERE expires_at <= ?", (now,))
+    return max(cur.rowcount, 0)
+
+
+def trim_states(cur, max_entries):
+    """Delete all but the `max_entries` latest-expiring rows; returns rows deleted."""
+    cur.execute(
+        "DELETE FROM user_state WHERE user_id IN ("
+        " SELECT user_id FROM user_state ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+        (max_entries,)
+    )
+    return max(cur.rowcount, 0)
+
+
+def count_states(cur):
+    cur.execute("SELECT COUNT(*) FROM user_state")
+    return cur.fetchone()[0]
+
+# ============================================================
+# RESTORE GENERATION
+# ============================================================
+# A restore replaces the database under every worker's caches; each
+# worker compares this value with the one it last saw (migration 11).
+
+def restore_generation(cur):
+    cur.execute("SELECT value FROM restore_generation WHERE id = 1")
+    row = cur.fetchone()
+    return row[0] if row else 0
+
+
+def set_restore_generation(cur, value):
+    cur.execute("INSERT OR REPLACE INTO restore_generation (id, value) VALUES (1, ?)", (value,))
+
+# ============================================================
+# STATS / ROLLUPS
+# ============================================================
+# Counters kept current by triggers (migration 5): users, referrals,
+# balance_total, hold_total, tasks_<status>, withdraws_<status> and
+# withdraws_<status>_pkr. Reading them never scans the big tables.
+
+def get_stat(cur, key):
+    cur.execute("SELECT value FROM stats WHERE key = ?", (key,))
+    row = cur.fetchone()
+    return row[0] if row else 0
+
+
+def get_stats(cur):
+    cur.execute("SELECT key, value FROM stats")
+    return dict(cur.fetchall())
+
+
+def recount_stats(cur):
+    """Rebuild every counter from the tables; call inside db_write()."""
+    for sql in STATS_RECOUNT:
+        cur.execute(sql)
+    for sql in ARCHIVE_STATS_RECOUNT:
+        cur.execute(sql)
+
+
+def rollup_since(cur, first_day):
+    """daily_rollup rows (day, metric, dim, value) from `first_day` on.
+
+    Days are UTC days since the epoch; kept current by the rollup triggers
+    of migration 6.
+    """
+    cur.execute("SELECT day, metric, dim, value FROM daily_rollup WHERE day >= ? ORDER BY day", (first_day,))
+    return cur.fetchall()
+
+
+# ============================================================
+# ARCHIVE
+# ============================================================
+# Approved / rejected rows older than a cutoff move to archive.tasks /
+# archive.withdraws, so the hot tables stay small. A batch is two
+# transactions: copy (INSERT OR REPLACE) and then delete the hot rows that
+# match their archived copy. With WAL, a transaction spanning two database
+# files is atomic per file only, so this order can at worst leave a row in
+# both places (fixed by the next batch), never in neither.
+
+FINISHED = "('approved', 'rejected')"
+_ARCHIVE_COLUMNS = {
+    "tasks": "id, user_id, task_id, type, email, password, fb_id, twofa, reward, status, created_at",
+    "withdraws": "id, user_id, method, account_name, account_number, pkr_amount, usd_amount, status, created_at",
+}
+
+
+def _archive_statements(table):
+    cols = _ARCHIVE_COLUMNS[table]
+    return {
+        'select': f"SELECT id FROM {table} WHERE created_at < ? AND status IN {FINISHED} ORDER BY created_at LIMIT ?",
+        'copy': f"INSERT OR REPLACE INTO archive.{table} ({cols}, archived_at) SELECT {cols}, ? FROM {table} WHERE id = ?",
+        'delete': f"DELETE FROM {table} WHERE id = ? AND status = (SELECT status FROM archive.{table} WHERE id = ?)",
+        'get': f"SELECT * FROM archive.{table} WHERE id = ?",
+    }
+
+
+ARCHIVE_SQL = {table: _archive_statements(table) for table in _ARCHIVE_COLUMNS}
+
+# archived rows stay in the stats counters (migration 7)
+ARCHIVE_STATS_RECOUNT = [
+    "INSERT INTO stats (key, value) SELECT 'tasks_' || status, COUNT(*) FROM archive.tasks WHERE true GROUP BY status "
+    "ON CONFLICT(key) DO UPDATE SET value = value + excluded.value",
+    "INSERT INTO stats (key, value) SELECT 'withdraws_' || status, COUNT(*) FROM archive.withdraws WHERE true GROUP BY status "
+    "ON CONFLICT(key) DO UPDATE SET value = value + excluded.value",
+    "INSERT INTO stats (key, value) SELECT 'withdraws_' || status || '_pkr', COALESCE(SUM(pkr_amount), 0) FROM archive.withdraws WHERE true GROUP BY status "
+    "ON CONFLICT(key) DO UPDATE SET value = value + excluded.value",
+]
+
+
+def archive_copy(cur, table, cutoff, limit, now):
+    """Copy up to `limit` finished rows created before `cutoff` to the
+    archive; returns their ids. Call inside db_write()."""
+    sql = ARCHIVE_SQL[table]
+    cur.execute(sql['select'], (cutoff, limit))
+    ids = [r[0] for r in cur.fetchall()]
+    cur.executemany(sql['copy'], [(now, i) for i in ids])
+    return ids
+
+
+def archive_delete(cur, table, ids):
+    """Delete hot rows whose archived copy matches; returns rows deleted."""
+    cur.executemany(ARCHIVE_SQL[table]['delete'], [(i, i) for i in ids])
+    return cur.rowcount
+
+
+def get_archived(cur, table, row_id):
+    cur.execute(ARCHIVE_SQL[table]['get'], (row_id,))
+    return cur.fetchone()
+
+# ============================================================
+# PENDING QUEUES (keyset pages)
+# ============================================================
+# One fixed set of statements per table, so the table name is part of the
+# cached SQL text rather than formatted into it on every call. Queue sizes
+# come from the stats counters (<table>_<status>), not COUNT(*).
+
+def _pending_statements(table):
+    return {
+        'after': f"SELECT * FROM {table} WHERE status = ? AND id > ? ORDER BY id LIMIT ?",
+        'before': f"SELECT * FROM {table} WHERE status = ? AND id < ? ORDER BY id DESC LIMIT ?",
+        'any_upto': f"SELECT 1 FROM {table} WHERE status = ? AND id <= ? LIMIT 1",
+        'any_after': f"SELECT 1 FROM {table} WHERE status = ? AND id > ? LIMIT 1",
+    }
+
+
+PENDING_SQL = {table: _pending_statements(table) for table in ("tasks", "withdraws")}
+
+
+def pending_after(cur, table, status, after_id, limit):
+    cur.execute(PENDING_SQL[table]['after'], (status, after_id, limit))
+    return cur.fetchall()
+
+
+def pending_before(cur, table, status, before_id, limit):
+    """Rows just before `before_id`, newest first."""
+    cur.execute(PENDING_SQL[table]['before'], (status, before_id, limit))
+    return cur.fetchall()
+
+
+def pending_any_upto(cur, table, status, row_id):
+    cur.execute(PENDING_SQL[table]['any_upto'], (status, row_id))
+    return cur.fetchone() is not None
+
+
+def pending_any_after(cur, table, status, row_id):
+    cur.execute(PENDING_SQL[table]['any_after'], (status, row_id))
+    return cur.fetchone() is not None
+
+
+# ============================================================
+# SCHEDULER
+# ============================================================
+# scheduler.py elects one leader among the worker processes through the
+# single scheduler_lease row (migration 8); every job run is recorded in
+# scheduler_jobs. All calls go inside db_write(), except job_runs().
+
+def acquire_lease(cur, owner, now, ttl):
+    """Take the lease if free or expired, or renew it; True if `owner` holds it."""
+    cur.execute("INSERT OR IGNORE INTO scheduler_lease (id, owner, expires_at) VALUES (1, ?, ?)", (owner, now + ttl))
+    cur.execute(
+        "UPDATE scheduler_lease SET owner = ?, expires_at = ? WHERE id = 1 AND (owner = ? OR expires_at < ?)",
+        (owner, now + ttl, owner, now)
+    )
+    return cur.rowcount == 1
+
+
+def get_lease(cur):
+    cur.execute("SELECT owner, expires_at FROM scheduler_lease WHERE id = 1")
+    return cur.fetchone()
+
+
+def record_job_run(cur, name, started, seconds, rows, error, owner):
+    cur.execute(
+        "INSERT INTO scheduler_jobs (name, last_started, last_seconds, last_rows, last_error, runs, owner) "
+        "VALUES (?, ?, ?, ?, ?, 1, ?) "
+        "ON CONFLICT(name) DO UPDATE SET last_started = excluded.last_started, last_seconds = excluded.last_seconds, "
+        "last_rows = excluded.last_rows, last_error = excluded.last_error, runs = runs + 1, owner = excluded.owner",
+        (name, started, seconds, rows, error, owner)
+    )
+
+
+def job_runs(cur):
+    cur.execute("SELECT * FROM scheduler_jobs ORDER BY name")
+    return cur.fetchall()
+
+
+# ============================================================
+# BROADCASTS
+# ============================================================
+# A broadcast walks users in id order, one chunk at a time; after each
+# chunk its row records the last user id handled plus the counters, so a
+# restarted run carries on from there. `owner` / `heartbeat_at` tell
+# which process is sending it; a stale heartbeat lets another take over.
+
+def create_broadcast(cur, text, now):
+    cur.execute("INSERT INTO broadcasts (text, created_at) VALUES (?, ?)", (text, now))
+    return cur.lastrowid
+
+
+def get_broadcast(cur, broadcast_id=None):
+    """One broadcast, or the latest one if `broadcast_id` is None."""
+    if broadcast_id is None:
+        cur.execute("SELECT * FROM broadcasts ORDER BY id DESC LIMIT 1")
+    else:
+        cur.execute("SELECT * FROM broadcasts WHERE id = ?", (broadcast_id,))
+    return cur.fetchone()
+
+
+def start_broadcast(cur, broadcast_id, owner, now):
+    """Move a draft to running under `owner`; True if it was a draft."""
+    cur.execute("SELECT value FROM stats WHERE key = 'users'")
+    row = cur.fetchone()
+    cur.execute(
+        "UPDATE broadcasts SET status = 'running', owner = ?, heartbeat_at = ?, started_at = ?, total = ? "
+        "WHERE id = ? AND status = 'draft'",
+        (owner, now, int(now), row[0] if row else 0, broadcast_id)
+    )
+    return cur.rowcount == 1
+
+
+def claim_broadcast(cur, broadcast_id, owner, now, stale_before):
+    """Take over a running broadcast whose sender stopped heartbeating."""
+    cur.execute(
+        "UPDATE broadcasts SET owner = ?, heartbeat_at = ? "
+        "WHERE id = ? AND status = 'running' AND (heartbeat_at IS NULL OR heartbeat_at < ?)",
+        (owner, now, broadcast_id, stale_before)
+    )
+    return cur.rowcount == 1
+
+
+def stale_broadcasts(cur, stale_before):
+    cur.execute(
+        "SELECT id FROM broadcasts WHERE status = 'running' AND (heartbeat_at IS NULL OR heartbeat_at < ?)",
+        (stale_before,)
+    )
+    return [r[0] for r in cur.fetchall()]
+
+
+def user_ids_after(cur, after_id, limit):
+    cur.execute("SELECT id FROM users WHERE id > ? ORDER BY id LIMIT ?", (after_id, limit))
+    return [r[0] for r in cur.fetchall()]
+
+
+def checkpoint_broadcast(cur, broadcast_id, owner, last_user_id, sent, blocked, failed, failures, now):
+    """Record a finished chunk; False once the sender should stop.
+
+    That is when the broadcast was cancelled or another process took it
+    over. `failures` is a list of (user_id, blocked, error).
+    """
+    cur.execute(
+        "UPDATE broadcasts SET last_user_id = ?, sent = sent + ?, blocked = blocked + ?, failed = failed + ?, "
+        "heartbeat_at = ? WHERE id = ? AND owner = ?",
+        (last_user_id, sent, blocked, failed, now, broadcast_id, owner)
+    )
+    if cur.rowcount != 1:
+        return False
+    cur.executemany(
+        "INSERT OR REPLACE INTO broadcast_failures (broadcast_id, user_id, blocked, error) VALUES (?, ?, ?, ?)",
+        [(broadcast_id, uid, int(is_blocked), error) for uid, is_blocked, error in failures]
+    )
+    cur.execute("SELECT status FROM broadcasts WHERE id = ?", (broadcast_id,))
+    return cur.fetchone()[0] == 'running'
+
+
+def finish_broadcast(cur, broadcast_id, owner, status, now):
+    cur.execute(
+        "UPDATE broadcasts SET status = ?, finished_at = ?, owner = NULL WHERE id = ? AND owner = ? AND status = 'running'",
+        (status, int(now), broadcast_id, owner)
+    )
+    return cur.rowcount == 1
+
+
+def cancel_broadcast(cur, broadcast_id, now):
+    """Cancel a draft or running broadcast; its sender stops after the current chunk."""
+    cur.execute(
+        "UPDATE broadcasts SET status = 'cancelled', finished_at = ? WHERE id = ? AND status IN ('draft', 'running')",
+        (int(now), broadcast_id)
+    )
+    return cur.rowcount == 1
+
+
+# ============================================================
+# UPDATE DEDUPLICATION
+# ============================================================
+# Telegram redelivers an update when the webhook answer is slow or not
+# 2xx. update_window is a bitmap of recently seen update_ids shared by all
+# workers: row `block` = update_id >> 5 holds one bit per id, so a window
+# of 100k ids is about 3k rows. Webhook requests only read it
+# (update_seen); update workers mark ids in batches, one write
+# transaction per batch (update_queue.UpdateWindow).
+
+UPDATE_BLOCK_SHIFT = 5
+
+
+def _update_bit(update_id):
+    return update_id >> UPDATE_BLOCK_SHIFT, 1 << (update_id & ((1 << UPDATE_BLOCK_SHIFT) - 1))
+
+
+def mark_update(cur, update_id):
+    """Record `update_id` as seen; False if it already was (a redelivery)."""
+    block, bit = _update_bit(update_id)
+    cur.execute(
+        "INSERT INTO update_window (block, bits) VALUES (?, ?) "
+        "ON CONFLICT(block) DO UPDATE SET bits = bits | excluded.bits WHERE (bits & excluded.bits) = 0",
+        (block, bit)
+    )
+    return cur.rowcount == 1
+
+
+def prune_update_window(cur, update_id, window):
+    """Drop blocks more than `window` ids away from `update_id`.
+
+    update_ids are sequential but may jump after a long idle period, hence
+    pruning on both sides.
+    """
+    block, _ = _update_bit(update_id)
+    span = window >> UPDATE_BLOCK_SHIFT
+    cur.execute("DELETE FROM update_window WHERE block < ? OR block > ?", (block - span, block + span))
+
+
+def update_seen(cur, update_id):
+    block, bit = _update_bit(update_id)
+    cur.execute("SELECT bits & ? FROM update_window WHERE block = ?", (bit, block))
+    row = cur.fetchone()
+    return bool(row and row[0])
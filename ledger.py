@@ -0,0 +1,69 @@
+import time
+
+import database
+
+# ============================================================
+# BALANCE LEDGER
+# ============================================================
+# Every change to users.balance / users.hold is recorded as an append-only
+# ledger row (delta_balance, delta_hold, reason, ref_id) written in the same
+# transaction as the users UPDATE, so users.balance/hold are a materialised
+# projection of the ledger.
+#
+# checkpoint() folds entries since the previous checkpoint into
+# ledger_snapshot; recomputing a balance then only replays entries newer
+# than the last checkpoint. The SQL lives in database.py (LEDGER).
+
+# Reasons used by the bot
+OPENING = 'opening'
+ADJUSTMENT = 'adjustment'
+TASK_REWARD = 'task_reward'
+REFERRAL_BONUS = 'referral_bonus'
+WITHDRAW_HOLD = 'withdraw_hold'
+WITHDRAW_PAID = 'withdraw_paid'
+WITHDRAW_REFUND = 'withdraw_refund'
+
+
+def post(cur, uid, delta_balance, delta_hold, reason, ref_id=None):
+    """Record one movement and apply it to users; call inside db_write()."""
+    database.insert_ledger_entry(cur, uid, delta_balance, delta_hold, reason, ref_id, int(time.time()))
+    database.apply_balance_delta(cur, uid, delta_balance, delta_hold)
+
+
+def last_checkpoint(cur):
+    return database.last_ledger_checkpoint(cur)
+
+
+def checkpoint(cur):
+    """Fold new entries into ledger_snapshot; call inside db_write().
+
+    Returns (entries folded, last entry id).
+    """
+    since = last_checkpoint(cur)
+    upto = database.last_ledger_entry(cur)
+    if upto <= since:
+        return 0, since
+    database.fold_ledger_entries(cur, since, upto, int(time.time()))
+    return upto - since, upto
+
+
+def entries_since_checkpoint(cur):
+    return max(0, database.last_ledger_entry(cur) - last_checkpoint(cur))
+
+
+def recompute(cur, uid):
+    """(balance, hold) for one user from snapshot + entries after it."""
+    since = last_checkpoint(cur)
+    snap = database.ledger_snapshot(cur, uid)
+    d = database.ledger_deltas_after(cur, uid, since)
+    base_balance, base_hold = (snap[0], snap[1]) if snap else (0, 0)
+    return base_balance + d[0], base_hold + d[1]
+
+
+def mismatches(cur, limit=20):
+    """Users whose materialised balance/hold disagree with the ledger."""
+    return database.ledger_mismatches(cur, last_checkpoint(cur), limit)
+
+
+def history(cur, uid, limit=10):
+    return database.ledger_history(cur, uid, limit)
@@ -1,7 +1,6 @@
-from database import *
-init_db()
+import time
+_IMPORT_STARTED = time.perf_counter()
 import os
-import sqlite3
 import threading
 import telebot
 from telebot import types
@@ -9,6 +8,21 @@ import random
 import string
 from flask import Flask, request
 from datetime import datetime
+from update_queue import UpdateDispatcher, UpdateWindow, QueueFull
+from cache import LRUCache
+import database
+from database import db_read, db_write, get_db_conn
+import ledger
+from state_store import MemoryStateStore, SQLiteStateStore
+from router import CallbackRouter, TextRouter, encode_callback
+import backup
+import metrics
+from profiler import SamplingProfiler
+from outbound import OutboundDispatcher, PRIORITY_CALLBACK, PRIORITY_USER, PRIORITY_ADMIN, PRIORITY_BROADCAST
+from scheduler import Scheduler
+from broadcast import Broadcaster
+
+IMPORT_SECONDS = time.perf_counter() - _IMPORT_STARTED
 
 # ============================================================
 # CONFIGURATION
@@ -17,14 +31,138 @@ from datetime import datetime
 BOT_TOKEN = os.environ.get("BOT_TOKEN")
 ADMIN_CHAT_ID = int(os.environ.get("ADMIN_CHAT_ID", "0"))
 WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
-DB_PATH = os.environ.get("SQLITE_DB", "bot.sqlite")
+# Alternative Bot API base URL, e.g. a local Bot API server or
+# benchmarks/fake_bot_api.py for offline load tests
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL")
+
+# Webhook ingestion: updates are queued and handled by a worker pool
+UPDATE_WORKERS = int(os.environ.get("UPDATE_WORKERS", "8"))
+UPDATE_QUEUE_SIZE = int(os.environ.get("UPDATE_QUEUE_SIZE", "1000"))
+UPDATE_QUEUE_OVERFLOW = os.environ.get("UPDATE_QUEUE_OVERFLOW", "block")  # block | reject
+UPDATE_QUEUE_TIMEOUT = float(os.environ.get("UPDATE_QUEUE_TIMEOUT", "2"))
+# Redelivered updates (same update_id) are dropped before any handler runs;
+# the last UPDATE_DEDUP_WINDOW ids are remembered in SQLite, 0 disables.
+UPDATE_DEDUP_WINDOW = int(os.environ.get("UPDATE_DEDUP_WINDOW", "100000"))
+
+# Outbound Telegram calls: Bot API allows ~30 msg/s overall, ~1 msg/s per chat
+OUTBOUND_SENDERS = int(os.environ.get("OUTBOUND_SENDERS", "4"))
+OUTBOUND_GLOBAL_RATE = float(os.environ.get("OUTBOUND_GLOBAL_RATE", "30"))
+OUTBOUND_CHAT_RATE = float(os.environ.get("OUTBOUND_CHAT_RATE", "1"))
+OUTBOUND_CHAT_BURST = int(os.environ.get("OUTBOUND_CHAT_BURST", "3"))
+
+# User-row cache. Per process: the TTL bounds staleness when another
+# gunicorn worker changes a row this one has cached.
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", "50000"))
+USER_CACHE_TTL = float(os.environ.get("USER_CACHE_TTL", "30"))
+
+# Conversation state (withdraw steps, task inputs). "sqlite" is shared by
+# all worker processes; "memory" is only safe with a single worker.
+STATE_STORE = os.environ.get("STATE_STORE", "sqlite")
+STATE_TTL_SECONDS = int(os.environ.get("STATE_TTL_SECONDS", "3600"))
+STATE_MAX_ENTRIES = int(os.environ.get("STATE_MAX_ENTRIES", "100000"))
+
+# Cached bot identity (getMe); BOT_USERNAME skips the lookup entirely
+BOT_USERNAME = os.environ.get("BOT_USERNAME")
+BOT_INFO_REFRESH_SECONDS = int(os.environ.get("BOT_INFO_REFRESH_SECONDS", "3600"))
+
+# Ledger checkpoints: every LEDGER_CHECKPOINT_SECONDS, if at least
+# LEDGER_CHECKPOINT_MIN_ENTRIES entries were posted since the last one
+LEDGER_CHECKPOINT_SECONDS = int(os.environ.get("LEDGER_CHECKPOINT_SECONDS", "600"))
+LEDGER_CHECKPOINT_MIN_ENTRIES = int(os.environ.get("LEDGER_CHECKPOINT_MIN_ENTRIES", "1000"))
+
+# Online backups (admin "📁 Backup Data"): pages copied per step and the
+# pause between steps bound how long writers can be held up by a backup
+BACKUP_DIR = os.environ.get("BACKUP_DIR", "backups")
+BACKUP_PAGES_PER_STEP = int(os.environ.get("BACKUP_PAGES_PER_STEP", "256"))
+BACKUP_STEP_SLEEP = float(os.environ.get("BACKUP_STEP_SLEEP", "0.005"))
+BACKUP_SEND_MAX_BYTES = int(os.environ.get("BACKUP_SEND_MAX_BYTES", str(45 * 1024 * 1024)))
+# After /restore, every worker drops its caches (users, update_id window,
+# memory state, pooled connections) within RESTORE_CHECK_SECONDS; no
+# restart is needed
+RESTORE_CHECK_SECONDS = float(os.environ.get("RESTORE_CHECK_SECONDS", "2"))
+
+# Finished tasks / withdraws older than ARCHIVE_AFTER_DAYS are moved to the
+# archive database (SQLITE_ARCHIVE_DB) every ARCHIVE_INTERVAL_SECONDS, in
+# batches of ARCHIVE_BATCH_SIZE rows; 0 days disables the background job
+ARCHIVE_AFTER_DAYS = int(os.environ.get("ARCHIVE_AFTER_DAYS", "30"))
+ARCHIVE_BATCH_SIZE = int(os.environ.get("ARCHIVE_BATCH_SIZE", "500"))
+ARCHIVE_BATCH_PAUSE = float(os.environ.get("ARCHIVE_BATCH_PAUSE", "0.05"))
+ARCHIVE_INTERVAL_SECONDS = int(os.environ.get("ARCHIVE_INTERVAL_SECONDS", "3600"))
+
+# Background scheduler: one worker process at a time (the lease holder)
+# runs the maintenance jobs. Drafts untouched for DRAFT_TTL_HOURS are
+# deleted in batches of CLEANUP_BATCH_SIZE; pending withdraws older than
+# WITHDRAW_PROCESSING_HOURS are sent to the admin in one digest.
+SCHEDULER_TICK_SECONDS = float(os.environ.get("SCHEDULER_TICK_SECONDS", "5"))
+SCHEDULER_LEASE_SECONDS = float(os.environ.get("SCHEDULER_LEASE_SECONDS", "120"))
+DRAFT_TTL_HOURS = int(os.environ.get("DRAFT_TTL_HOURS", "24"))
+DRAFT_CLEANUP_SECONDS = int(os.environ.get("DRAFT_CLEANUP_SECONDS", "600"))
+STATE_EXPIRE_SECONDS = int(os.environ.get("STATE_EXPIRE_SECONDS", "300"))
+WITHDRAW_DIGEST_SECONDS = int(os.environ.get("WITHDRAW_DIGEST_SECONDS", "3600"))
+CLEANUP_BATCH_SIZE = int(os.environ.get("CLEANUP_BATCH_SIZE", "500"))
+CLEANUP_BATCH_PAUSE = float(os.environ.get("CLEANUP_BATCH_PAUSE", "0.05"))
+
+# Admin /broadcast: messages/s (below OUTBOUND_GLOBAL_RATE, so replies to
+# users still get through), users per checkpointed chunk and how often
+# progress is reported. A broadcast whose sender stopped heartbeating for
+# BROADCAST_STALE_SECONDS is resumed by the scheduler.
+BROADCAST_RATE = float(os.environ.get("BROADCAST_RATE", "20"))
+BROADCAST_CHUNK_SIZE = int(os.environ.get("BROADCAST_CHUNK_SIZE", "200"))
+BROADCAST_REPORT_SECONDS = int(os.environ.get("BROADCAST_REPORT_SECONDS", "60"))
+BROADCAST_STALE_SECONDS = int(os.environ.get("BROADCAST_STALE_SECONDS", "120"))
+
+# /metrics (Prometheus text format); if set, scrapers must send
+# "Authorization: Bearer <METRICS_TOKEN>"
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+
+# Admin /profile: stack sampling interval and where dumps are written
+PROFILE_INTERVAL_MS = float(os.environ.get("PROFILE_INTERVAL_MS", "1"))
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
 
 if not BOT_TOKEN or not WEBHOOK_URL:
     raise RuntimeError("BOT_TOKEN and WEBHOOK_URL must be set in environment variables")
 
+# ============================================================
+# METRICS
+# ============================================================
+
+UPDATE_SECONDS = metrics.Histogram("bot_update_seconds", "Update processing time in a worker", ("kind",))
+HANDLER_SECONDS = metrics.Histogram("bot_handler_seconds", "Time spent in each registered bot handler", ("handler",))
+ROUTE_SECONDS = metrics.Histogram("bot_route_seconds", "Time spent in each routed text/state/callback handler", ("route",))
+USER_LOCK_WAIT_SECONDS = metrics.Histogram("bot_user_lock_wait_seconds", "Wait for a per-user lock")
+USER_LOCK_HOLD_SECONDS = metrics.Histogram("bot_user_lock_hold_seconds", "Time a per-user lock is held")
+TELEGRAM_SECONDS = metrics.Histogram("bot_telegram_call_seconds", "Outbound Telegram API call latency", ("method",))
+TELEGRAM_CALLS = metrics.Counter("bot_telegram_calls_total", "Outbound Telegram API calls by outcome", ("method", "outcome"))
+ARCHIVE_ROWS = metrics.Counter("bot_archive_rows_total", "Finished rows moved to the archive database", ("table",))
+ARCHIVE_BATCH_SECONDS = metrics.Histogram("bot_archive_batch_seconds", "Archive batch time (copy + delete)", ("table",))
+DUPLICATE_UPDATES = metrics.Counter("bot_updates_duplicate_total", "Redelivered updates dropped by update_id")
+JOB_SECONDS = metrics.Histogram("bot_job_seconds", "Scheduled job run time", ("job",))
+JOB_ROWS = metrics.Counter("bot_job_rows_total", "Rows affected by scheduled jobs", ("job",))
+JOB_FAILURES = metrics.Counter("bot_job_failures_total", "Scheduled job runs that raised", ("job",))
+
+
+def observe_telegram_call(fn, seconds, outcome):
+    method = getattr(fn, "__name__", "call")
+    TELEGRAM_SECONDS.observe(seconds, method)
+    TELEGRAM_CALLS.inc(method, outcome)
+
+
 bot = telebot.TeleBot(BOT_TOKEN, threaded=False)
+if TELEGRAM_API_URL:
+    telebot.apihelper.API_URL = TELEGRAM_API_URL.rstrip("/") + "/bot{0}/{1}"
+    telebot.apihelper.FILE_URL = TELEGRAM_API_URL.rstrip("/") + "/file/bot{0}/{1}"
 app = Flask(__name__)
 
+OUTBOUND = OutboundDispatcher(
+    senders=OUTBOUND_SENDERS,
+    global_rate=OUTBOUND_GLOBAL_RATE,
+    chat_rate=OUTBOUND_CHAT_RATE,
+    chat_burst=OUTBOUND_CHAT_BURST,
+    observer=observe_telegram_call,
+)
+
+PROFILER = SamplingProfiler(interval=PROFILE_INTERVAL_MS / 1000)
+
 # ============================================================
 # CONSTANTS
 # ============================================================
@@ -34,6 +172,7 @@ GEN_TASK_REWARD = 40
 OWN_TASK_REWARD = 40
 FB_TASK_REWARD = 12
 
+WITHDRAW_METHODS = ("easypaisa", "jazzcash", "bank", "binance")
 WITHDRAW_MIN_PKR = 200
 BINANCE_PKR_PER_USD = 300
 BINANCE_MIN_USD = 1
@@ -41,83 +180,53 @@ BINANCE_MIN_USD = 1
 TASK_USER_PROCESSING_MINUTES = 30
 WITHDRAW_PROCESSING_HOURS = 5
 
-DB_LOCK = threading.Lock()
+# Per-user striped locks. SQLite transactions guard data integrity; these
+# only keep multi-step flows for the same user (withdraw hold, approvals)
+# ordered without serialising unrelated users.
+USER_LOCK_STRIPES = 64
+_USER_LOCKS = tuple(threading.Lock() for _ in range(USER_LOCK_STRIPES))
 
 # ============================================================
-# In-memory minimal state for composing tasks and withdraw steps
-# This is small transient state only; core data persists to SQLite
+# DATABASE / USER LOCKS
 # ============================================================
-users_state = {}  # {uid: {state: 'awaiting_own_gmail' or withdraw steps, temp: {...}}}
+# Connections, transactions and all SQL live in database.py.
 
-# ============================================================
-# DATABASE HELPERS
-# ============================================================
+class _TimedLock:
+    # one per `with user_lock(uid):`, recording wait and hold times
+    __slots__ = ("lock", "locked")
 
-def get_db_conn():
-    # create a new connection for each thread/call
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
-    return conn
+    def __init__(self, lock):
+        self.lock = lock
 
+    def __enter__(self):
+        started = time.perf_counter()
+        self.lock.acquire()
+        self.locked = time.perf_counter()
+        USER_LOCK_WAIT_SECONDS.observe(self.locked - started)
+        return self
 
-def init_db():
-    with DB_LOCK:
-        conn = get_db_conn()
-        cur = conn.cursor()
+    def __exit__(self, *exc):
+        USER_LOCK_HOLD_SECONDS.observe(time.perf_counter() - self.locked)
+        self.lock.release()
 
-        # users table
-        cur.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY,
-            balance INTEGER NOT NULL DEFAULT 0,
-            hold INTEGER NOT NULL DEFAULT 0,
-            tasks_completed INTEGER NOT NULL DEFAULT 0,
-            referrer INTEGER,
-            referrals_count INTEGER NOT NULL DEFAULT 0,
-            referral_earned INTEGER NOT NULL DEFAULT 0,
-            next_task_id INTEGER NOT NULL DEFAULT 1
-        )
-        ''')
-
-        # tasks table
-        cur.execute('''
-        CREATE TABLE IF NOT EXISTS tasks (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            task_id INTEGER NOT NULL,
-            type TEXT NOT NULL,
-            email TEXT,
-            password TEXT,
-            fb_id TEXT,
-            twofa TEXT,
-            reward INTEGER NOT NULL,
-            status TEXT NOT NULL,
-            created_at TEXT NOT NULL,
-            FOREIGN KEY(user_id) REFERENCES users(id)
-        )
-        ''')
-
-        # withdraws table
-        cur.execute('''
-        CREATE TABLE IF NOT EXISTS withdraws (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            method TEXT NOT NULL,
-            account_name TEXT,
-            account_number TEXT,
-            pkr_amount INTEGER,
-            usd_amount REAL,
-            status TEXT NOT NULL,
-            created_at TEXT NOT NULL,
-            FOREIGN KEY(user_id) REFERENCES users(id)
-        )
-        ''')
 
-        conn.commit()
-        conn.close()
+def user_lock(uid):
+    return _TimedLock(_USER_LOCKS[hash(uid) % USER_LOCK_STRIPES])
 
 
-init_db()
+_schema_started = time.perf_counter()
+SCHEMA_MIGRATIONS_APPLIED = database.init_db()
+SCHEMA_SECONDS = time.perf_counter() - _schema_started
+
+# ============================================================
+# Conversation state for composing tasks and withdraw steps
+# {uid: {state: 'awaiting_own_gmail' or withdraw steps, temp: {...}}}
+# ============================================================
+
+if STATE_STORE == "memory":
+    users_state = MemoryStateStore(ttl=STATE_TTL_SECONDS, max_entries=STATE_MAX_ENTRIES)
+else:
+    users_state = SQLiteStateStore(get_db_conn, ttl=STATE_TTL_SECONDS, max_entries=STATE_MAX_ENTRIES)
 
 # ============================================================
 # HELP TEXT
@@ -146,75 +255,180 @@ HELP_TEXT = (
 # DB OPERATIONS
 # ============================================================
 
+USER_CACHE = LRUCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+
+
 def ensure_user_db(uid, start_referrer=None):
-    with DB_LOCK:
-        conn = get_db_conn()
-        cur = conn.cursor()
-        cur.execute("SELECT * FROM users WHERE id = ?", (uid,))
-        row = cur.fetchone()
-        if not row:
-            cur.execute(
-                "INSERT INTO users (id, balance, hold, tasks_completed, referrer, referrals_count, referral_earned, next_task_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-                (uid, 0, 0, 0, start_referrer if start_referrer and start_referrer != uid else None, 0, 0, 1)
-            )
-            if start_referrer and start_referrer != uid:
-                cur.execute("SELECT * FROM users WHERE id = ?", (start_referrer,))
-                r = cur.fetchone()
-                if r:
-                    cur.execute("UPDATE users SET referrals_count = referrals_count + 1 WHERE id = ?", (start_referrer,))
-        conn.commit()
-        conn.close()
+    # known users are the common case: usually answered from USER_CACHE
+    if get_user_db(uid):
+        return
+    referrer = start_referrer if start_referrer and start_referrer != uid else None
+    with db_write() as cur:
+        database.create_user(cur, uid, referrer)
+    USER_CACHE.invalidate(uid, referrer)
+
+
+def _load_user_row(uid):
+    with db_read() as cur:
+        return database.get_user(cur, uid)
 
 
 def get_user_db(uid):
-    with DB_LOCK:
-        conn = get_db_conn()
-        cur = conn.cursor()
-        cur.execute("SELECT * FROM users WHERE id = ?", (uid,))
-        r = cur.fetchone()
-        conn.close()
-        return r
-
-
-def update_user_balance(uid, delta_balance=0, delta_hold=0, inc_tasks_completed=0):
-    with DB_LOCK:
-        conn = get_db_conn()
-        cur = conn.cursor()
-        if delta_balance != 0:
-            cur.execute("UPDATE users SET balance = balance + ? WHERE id = ?", (delta_balance, uid))
-        if delta_hold != 0:
-            cur.execute("UPDATE users SET hold = hold + ? WHERE id = ?", (delta_hold, uid))
+    return USER_CACHE.get_or_load(uid, _load_user_row)
+
+
+def update_user_balance(uid, delta_balance=0, delta_hold=0, inc_tasks_completed=0, reason=ledger.ADJUSTMENT, ref_id=None):
+    with db_write() as cur:
+        if delta_balance or delta_hold:
+            ledger.post(cur, uid, delta_balance, delta_hold, reason, ref_id)
         if inc_tasks_completed:
-            cur.execute("UPDATE users SET tasks_completed = tasks_completed + ? WHERE id = ?", (inc_tasks_completed, uid))
-        conn.commit()
-        conn.close()
+            database.add_tasks_completed(cur, uid, inc_tasks_completed)
+    USER_CACHE.invalidate(uid)
+
+
+def adjust_user_balance(uid, delta):
+    """Admin adjustment posted to the ledger; returns the new balance, or
+    None if the user does not exist or the balance would go negative."""
+    with user_lock(uid), db_write() as cur:
+        u = database.get_user(cur, uid)
+        if not u or u['balance'] + delta < 0:
+            return None
+        ledger.post(cur, uid, delta, 0, ledger.ADJUSTMENT)
+    USER_CACHE.invalidate(uid)
+    return u['balance'] + delta
 
 
 def get_and_inc_next_task_id(uid):
-    with DB_LOCK:
-        conn = get_db_conn()
-        cur = conn.cursor()
-        cur.execute("SELECT next_task_id FROM users WHERE id = ?", (uid,))
-        row = cur.fetchone()
-        if not row:
-            ensure_user_db(uid)
-            cur.execute("SELECT next_task_id FROM users WHERE id = ?", (uid,))
-            row = cur.fetchone()
-        task_id = row['next_task_id']
-        cur.execute("UPDATE users SET next_task_id = next_task_id + 1 WHERE id = ?", (uid,))
-        conn.commit()
-        conn.close()
-        return task_id
-
-# ============================================================
-# ADMIN NOTIFY
-# ============================================================
-
-def admin_notify(text, markup=None):
-    try:
-        bot.send_message(ADMIN_CHAT_ID, text, reply_markup=markup, parse_mode="Markdown")
-    except Exception as e:
-        print("Failed to notify admin:", e)
+    ensure_user_db(uid)
+    with db_write() as cur:
+        task_id = database.take_next_task_id(cur, uid)
+    USER_CACHE.invalidate(uid)
+    return task_id
+
+
+def checkpoint_ledger(min_entries=0):
+    """Fold recent ledger entries into the snapshot; returns entries folded."""
+    with db_write() as cur:
+        if ledger.entries_since_checkpoint(cur) < max(min_entries, 1):
+            return 0
+        folded, _ = ledger.checkpoint(cur)
+        return folded
+
+
+def archive_finished(older_than_days, batch_size=ARCHIVE_BATCH_SIZE, pause=ARCHIVE_BATCH_PAUSE):
+    """Move finished rows older than `older_than_days` to the archive.
+
+    Returns {table: {'rows', 'batches', 'slowest', 'seconds'}}.
+    """
+    cutoff = int(time.time()) - older_than_days * 86400
+    report = {}
+    for table in ("tasks", "withdraws"):
+        r = report[table] = {'rows': 0, 'batches': 0, 'slowest': 0.0, 'seconds': 0.0}
+        while True:
+            started = time.perf_counter()
+            with db_write() as cur:
+                ids = database.archive_copy(cur, table, cutoff, batch_size, int(time.time()))
+            if not ids:
+                break
+            with db_write() as cur:
+                moved = database.archive_delete(cur, table, ids)
+            seconds = time.perf_counter() - started
+            ARCHIVE_BATCH_SECONDS.observe(seconds, table)
+            ARCHIVE_ROWS.inc(table, amount=moved)
+            r['rows'] += moved
+            r['batches'] += 1
+            r['slowest'] = max(r['slowest'], seconds)
+            r['seconds'] += seconds
+            if len(ids) < batch_size:
+                break
+            # let queued writers in between batches
+            time.sleep(pause)
+    return report
+
+
+def delete_stale_drafts(max_age_seconds, batch_size=CLEANUP_BATCH_SIZE, pause=CLEANUP_BATCH_PAUSE):
+    """Delete drafts older than `max_age_seconds` in short transactions."""
+    cutoff = int(time.time()) - max_age_seconds
+    deleted = 0
+    while True:
+        with db_write() as cur:
+            n = database.delete_stale_drafts(cur, cutoff, batch_size)
+        deleted += n
+        if n < batch_size:
+            return deleted
+        time.sleep(pause)
+
+
+OVERDUE_DIGEST_ROWS = 20
+
+
+def format_overdue_digest(count, total, rows, now):
+    lines = [f"⏰ {count} withdraws pending longer than {WITHDRAW_PROCESSING_HOURS} hours ({total} PKR):", ""]
+    for w in rows:
+        hours = (now - w['created_at']) // 3600
+        lines.append(f"WDID: `{w['id']}`  User: `{w['user_id']}`  Amount(PKR): `{w['pkr_amount']}`  {w['method']}, {hours}h")
+    if count > len(rows):
+        lines.append(f"…and {count - len(rows)} more.")
+    lines.append("\nSee /pending or settle with /bulkwd.")
+    return "\n".join(lines)
+
+
+def notify_overdue_withdraws():
+    """Send the admin one digest of overdue withdraws; returns how many."""
+    now = int(time.time())
+    with db_read() as cur:
+        count, total, rows = database.overdue_withdraws(cur, now - WITHDRAW_PROCESSING_HOURS * 3600, OVERDUE_DIGEST_ROWS)
+    if count:
+        admin_notify(format_overdue_digest(count, total, rows, now))
+    return count
+
+
+def format_archive_report(report, days):
+    lines = [f"🗄 Archived finished rows older than {days} days:"]
+    for table, r in report.items():
+        lines.append(
+            f"{table}: {r['rows']} rows in {r['batches']} batches "
+            f"({r['seconds'] * 1000:.1f} ms, slowest batch {r['slowest'] * 1000:.1f} ms)"
+        )
+    return "\n".join(lines)
+
+
+def task_owner(row_id):
+    # user_id owning a tasks/withdraws row, used to pick the per-user lock
+    with db_read() as cur:
+        return database.task_owner(cur, row_id)
+
+
+def withdraw_owner(row_id):
+    with db_read() as cur:
+        return database.withdraw_owner(cur, row_id)
+
+
+def missing_row_error(table, row_id):
+    # buttons on old admin messages can point at rows already archived
+    with db_read() as cur:
+        row = database.get_archived(cur, table, row_id)
+    label = "Task" if table == "tasks" else "Withdraw"
+    return f"{label} already {row['status']} (archived)." if row else f"{label} not found."
+
+# ============================================================
+# OUTBOUND MESSAGES / ADMIN NOTIFY
+# ============================================================
+# Handlers never call the Telegram API directly: calls are queued on
+# OUTBOUND and sent by its rate-limited sender threads.
+
+def send_message(chat_id, text, priority=PRIORITY_USER, **kwargs):
+    fn = PROFILER.wrap("telegram", bot.send_message) if PROFILER.enabled else bot.send_message
+    OUTBOUND.submit(chat_id, fn, chat_id, text, priority=priority, **kwargs)
+
+
+def answer_callback(call, text=None):
+    fn = PROFILER.wrap("telegram", bot.answer_callback_query) if PROFILER.enabled else bot.answer_callback_query
+    OUTBOUND.submit(None, fn, call.id, text, priority=PRIORITY_CALLBACK)
+
+
+def admin_notify(text, markup=None, parse_mode="Markdown"):
+    send_message(ADMIN_CHAT_ID, text, priority=PRIORITY_ADMIN, reply_markup=markup, parse_mode=parse_mode)
 
 # ============================================================
 # FLASK ROUTES (WEBHOOK)
@@ -225,14 +439,147 @@ def home():
     return "Bot is running!", 200
 
 
+def update_chat_id(update):
+    # ordering key: the user whose users_state the update touches
+    if update.message:
+        return update.message.chat.id
+    if update.callback_query:
+        call = update.callback_query
+        if call.from_user:
+            return call.from_user.id
+        if call.message:
+            return call.message.chat.id
+    return 0
+
+
+# ============================================================
+# BACKGROUND JOBS
+# ============================================================
+# Every worker runs the scheduler; only the lease holder runs the jobs.
+# Started on the first webhook request of each worker process (threads
+# started before a gunicorn fork would not survive it).
+
+def _elect(owner):
+    with db_write() as cur:
+        return database.acquire_lease(cur, owner, time.time(), SCHEDULER_LEASE_SECONDS)
+
+
+def _last_job_runs():
+    with db_read() as cur:
+        return {r['name']: r['last_started'] for r in database.job_runs(cur)}
+
+
+def _record_job_run(name, started, seconds, rows, error, owner):
+    with db_write() as cur:
+        database.record_job_run(cur, name, started, seconds, rows, error, owner)
+
+
+def _observe_job(name, seconds, rows, error):
+    JOB_SECONDS.observe(seconds, name)
+    JOB_ROWS.inc(name, amount=rows)
+    if error:
+        JOB_FAILURES.inc(name)
+
+
+def _archive_job():
+    report = archive_finished(ARCHIVE_AFTER_DAYS)
+    return sum(r['rows'] for r in report.values())
+
+
+SCHEDULER = Scheduler(_elect, _last_job_runs, _record_job_run, tick=SCHEDULER_TICK_SECONDS, observer=_observe_job)
+SCHEDULER.add("stale_drafts", DRAFT_CLEANUP_SECONDS, lambda: delete_stale_drafts(DRAFT_TTL_HOURS * 3600))
+SCHEDULER.add("expire_state", STATE_EXPIRE_SECONDS, users_state.expire)
+SCHEDULER.add("overdue_withdraws", WITHDRAW_DIGEST_SECONDS, notify_overdue_withdraws)
+SCHEDULER.add("ledger_checkpoint", LEDGER_CHECKPOINT_SECONDS, lambda: checkpoint_ledger(LEDGER_CHECKPOINT_MIN_ENTRIES))
+if ARCHIVE_AFTER_DAYS > 0:
+    SCHEDULER.add("archive", ARCHIVE_INTERVAL_SECONDS, _archive_job)
+SCHEDULER.add("resume_broadcasts", BROADCAST_STALE_SECONDS, lambda: BROADCASTER.resume_stale())
+
+
+def start_background_jobs():
+    SCHEDULER.start()
+    start_bot_identity()
+    check_restore_generation()
+
+
+def process_update(update):
+    # the webhook only read the shared window; claiming the id here, once
+    # the update was queued, is what stops two workers both handling it
+    if UPDATE_DEDUP_WINDOW and not UPDATE_WINDOW.claim(update.update_id):
+        DUPLICATE_UPDATES.inc()
+        return
+    kind = "message" if update.message else "callback_query" if update.callback_query else "other"
+    with UPDATE_SECONDS.time(kind):
+        if PROFILER.enabled:
+            with PROFILER.sample("update:" + kind):
+                bot.process_new_updates([update])
+        else:
+            bot.process_new_updates([update])
+
+
+UPDATE_DISPATCHER = UpdateDispatcher(
+    process_update,
+    workers=UPDATE_WORKERS,
+    queue_size=UPDATE_QUEUE_SIZE,
+    overflow=UPDATE_QUEUE_OVERFLOW,
+    block_timeout=UPDATE_QUEUE_TIMEOUT,
+)
+
+
+def decode_update():
+    return telebot.types.Update.de_json(request.get_data().decode("utf-8"))
+
+
+def _update_seen(update_id):
+    with db_read() as cur:
+        return database.update_seen(cur, update_id)
+
+
+def _claim_updates(update_ids):
+    with db_write() as cur:
+        claimed = {u for u in update_ids if database.mark_update(cur, u)}
+        database.prune_update_window(cur, update_ids[-1], UPDATE_DEDUP_WINDOW)
+    return claimed
+
+
+UPDATE_WINDOW = UpdateWindow(UPDATE_DEDUP_WINDOW, _update_seen, _claim_updates)
+
+
 @app.route(f"/webhook/{BOT_TOKEN}", methods=["POST"])
 def webhook_receiver():
-    json_str = request.get_data().decode("utf-8")
-    update = telebot.types.Update.de_json(json_str)
-    bot.process_new_updates([update])
+    start_background_jobs()
+    try:
+        if PROFILER.enabled:
+            with PROFILER.sample("webhook"):
+                update = decode_update()
+        else:
+            update = decode_update()
+    except Exception:
+        return "Bad update", 400
+    if update is None:
+        return "Bad update", 400
+    if UPDATE_DEDUP_WINDOW and not UPDATE_WINDOW.first_delivery(update.update_id):
+        DUPLICATE_UPDATES.inc()
+        return "OK", 200
+
+    try:
+        UPDATE_DISPATCHER.submit(update_chat_id(update), update)
+    except QueueFull:
+        # Telegram retries non-2xx responses, which is our backpressure;
+        # the retry must not be mistaken for a duplicate
+        if UPDATE_DEDUP_WINDOW:
+            UPDATE_WINDOW.forget(update.update_id)
+        return "Busy", 503
     return "OK", 200
 
 
+@app.route('/metrics')
+def metrics_endpoint():
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        return "Forbidden", 403
+    return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+
 @app.route('/setwebhook')
 def set_webhook():
     bot.delete_webhook()
@@ -244,7 +591,10 @@ def set_webhook():
 # KEYBOARDS
 # ============================================================
 
-def main_menu():
+# Keyboards never change at runtime, so they are built and serialised to
+# JSON once at import; telebot passes a str reply_markup through as-is.
+
+def build_main_menu():
     markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
     markup.row("📝 Tasks", "💼 Balance")
     markup.row("💰 Withdraw", "🔗 Referral Link")
@@ -252,7 +602,7 @@ def main_menu():
     return markup
 
 
-def tasks_menu():
+def build_tasks_menu():
     markup = types.InlineKeyboardMarkup()
     markup.add(types.InlineKeyboardButton("1️⃣ Generated Gmail (40 PKR)", callback_data="task_gen"))
     markup.add(types.InlineKeyboardButton("2️⃣ Provide your Gmail (40 PKR)", callback_data="task_own"))
@@ -261,7 +611,7 @@ def tasks_menu():
     return markup
 
 
-def withdraw_methods_markup():
+def build_withdraw_methods_markup():
     markup = types.InlineKeyboardMarkup()
     markup.add(types.InlineKeyboardButton("Easypaisa (PKR)", callback_data="wd_easypaisa"))
     markup.add(types.InlineKeyboardButton("JazzCash (PKR)", callback_data="wd_jazzcash"))
@@ -269,6 +619,80 @@ def withdraw_methods_markup():
     markup.add(types.InlineKeyboardButton("Binance (USD)", callback_data="wd_binance"))
     return markup
 
+
+MAIN_MENU_JSON = build_main_menu().to_json()
+TASKS_MENU_JSON = build_tasks_menu().to_json()
+WITHDRAW_METHODS_JSON = build_withdraw_methods_markup().to_json()
+
+
+def main_menu():
+    return MAIN_MENU_JSON
+
+
+def tasks_menu():
+    return TASKS_MENU_JSON
+
+
+def withdraw_methods_markup():
+    return WITHDRAW_METHODS_JSON
+
+# ============================================================
+# BOT IDENTITY (cached getMe)
+# ============================================================
+# The username only changes if the bot is renamed in BotFather, so getMe is
+# called when the worker starts (start_background_jobs) and then again in
+# the background every BOT_INFO_REFRESH_SECONDS. Handlers never wait for
+# it: until a fetch succeeds (e.g. during an API outage) the referral link
+# falls back to a placeholder, and a failed fetch is only retried after
+# BOT_INFO_REFRESH_SECONDS.
+
+_bot_username = {'value': None, 'fetched_at': None, 'refreshing': False, 'pid': None}
+_bot_username_lock = threading.Lock()
+
+
+def _refresh_bot_username():
+    try:
+        username = bot.get_me().username
+    except Exception as e:
+        print("Failed to fetch bot username:", e)
+        username = None
+    with _bot_username_lock:
+        if username:
+            _bot_username['value'] = username
+        _bot_username['fetched_at'] = time.monotonic()
+        _bot_username['refreshing'] = False
+
+
+def _start_username_refresh(force=False):
+    with _bot_username_lock:
+        fetched_at = _bot_username['fetched_at']
+        due = force or fetched_at is None or time.monotonic() - fetched_at > BOT_INFO_REFRESH_SECONDS
+        if not due or _bot_username['refreshing']:
+            return False
+        _bot_username['refreshing'] = True
+    threading.Thread(target=_refresh_bot_username, name="getme", daemon=True).start()
+    return True
+
+
+def start_bot_identity():
+    if BOT_USERNAME or _bot_username['pid'] == os.getpid():
+        return
+    with _bot_username_lock:
+        if _bot_username['pid'] == os.getpid():
+            return
+        # a refresh thread of the parent does not survive fork()
+        _bot_username['pid'] = os.getpid()
+        _bot_username['refreshing'] = False
+    _start_username_refresh(force=_bot_username['value'] is None)
+
+
+def get_bot_username():
+    """The bot's username, or None until a getMe has succeeded."""
+    if BOT_USERNAME:
+        return BOT_USERNAME
+    _start_username_refresh()
+    return _bot_username['value']
+
 # ============================================================
 # Small helper: generate a random email + password
 # ============================================================
@@ -295,614 +719,1343 @@ def handle_start(message):
             ref = None
 
     ensure_user_db(message.chat.id, start_referrer=ref)
-    bot.send_message(message.chat.id, "Welcome! Choose an option:", reply_markup=main_menu())
+    send_message(message.chat.id, "Welcome! Choose an option:", reply_markup=main_menu())
 
     if message.chat.id == ADMIN_CHAT_ID:
         # show counts (example admin notice)
-        with DB_LOCK:
-            conn = get_db_conn()
-            cur = conn.cursor()
-            cur.execute("SELECT COUNT(*) as c FROM users")
-            total = cur.fetchone()['c']
-            conn.close()
-        bot.send_message(message.chat.id, f"Admin Panel Loaded — {total} users")
+        with db_read() as cur:
+            total = database.get_stat(cur, 'users')
+        send_message(message.chat.id, f"Admin Panel Loaded — {total} users")
 
 
 @bot.message_handler(commands=['help'])
 def cmd_help(message):
-    bot.send_message(message.chat.id, HELP_TEXT)
+    send_message(message.chat.id, HELP_TEXT)
 
 
-@bot.message_handler(commands=['pending'])
-def cmd_pending(message):
-    # admin-only: show pending tasks and withdraws
+@bot.message_handler(commands=['cachestats'])
+def cmd_cachestats(message):
     if message.chat.id != ADMIN_CHAT_ID:
-        bot.reply_to(message, "You are not authorized to use this command.")
         return
+    s = USER_CACHE.stats()
+    send_message(message.chat.id, f"User cache: {s['size']} rows, {s['hits']} hits, {s['misses']} misses ({s['hit_ratio']:.1%} hit ratio)")
+
 
-    with DB_LOCK:
-        conn = get_db_conn()
-        cur = conn.cursor()
-        cur.execute("SELECT * FROM tasks WHERE status = 'pending_admin'")
-        tasks = cur.fetchall()
-        cur.execute("SELECT * FROM withdraws WHERE status = 'pending'")
-        wds = cur.fetchall()
-        conn.close()
+# /pending shows one page per queue; Prev/Next buttons carry the first/last
+# row id of the page (keyset pagination), so each page costs one indexed
+# range scan of PENDING_PAGE_SIZE rows no matter how long the queue is.
+PENDING_PAGE_SIZE = 30
+PENDING_TASKS = 0
+PENDING_WITHDRAWS = 1
 
-    msg = (
-        f"📌 Pending Tasks: {len(tasks)}\n"
-        f"📌 Pending Withdrawals: {len(wds)}\n\n"
+
+def format_pending_task(t):
+    return (
+        f"TaskID: `{t['task_id']}`  "
+        f"User: `{t['user_id']}`  "
+        f"Reward: `{t['reward']}`  "
+        f"Type: `{t['type']}`\n"
     )
 
-    for t in tasks[:30]:
-        msg += (
-            f"TaskID: `{t['task_id']}`  "
-            f"User: `{t['user_id']}`  "
-            f"Reward: `{t['reward']}`  "
-            f"Type: `{t['type']}`\n"
-        )
 
-    msg += "\n"
+def format_pending_withdraw(w):
+    return (
+        f"WDID: `{w['id']}`  "
+        f"User: `{w['user_id']}`  "
+        f"Amount(PKR): `{w['pkr_amount']}`  "
+        f"Method: `{w['method']}`\n"
+    )
 
-    for w in wds[:30]:
-        msg += (
-            f"WDID: `{w['id']}`  "
-            f"User: `{w['user_id']}`  "
-            f"Amount(PKR): `{w['pkr_amount']}`  "
-            f"Method: `{w['method']}`\n"
-        )
 
-    bot.send_message(ADMIN_CHAT_ID, msg)
+PENDING_QUEUES = {
+    PENDING_TASKS: ("tasks", "pending_admin", "📌 Pending Tasks", format_pending_task),
+    PENDING_WITHDRAWS: ("withdraws", "pending", "📌 Pending Withdrawals", format_pending_withdraw),
+}
 
-# text / command handlers for help/menu
-@bot.message_handler(func=lambda m: m.text == "❓ Help")
-def button_help(message):
-    bot.send_message(message.chat.id, HELP_TEXT)
 
+def pending_page(kind, after_id=0, before_id=None):
+    """Render one page of a pending queue; returns (text, markup)."""
+    table, status, title, fmt = PENDING_QUEUES[kind]
+    with db_read() as cur:
+        total = database.get_stat(cur, f"{table}_{status}")
+        if before_id is None:
+            rows = database.pending_after(cur, table, status, after_id, PENDING_PAGE_SIZE + 1)
+            has_next = len(rows) > PENDING_PAGE_SIZE
+            rows = rows[:PENDING_PAGE_SIZE]
+            has_prev = database.pending_any_upto(cur, table, status, after_id)
+        else:
+            rows = database.pending_before(cur, table, status, before_id, PENDING_PAGE_SIZE + 1)
+            has_prev = len(rows) > PENDING_PAGE_SIZE
+            rows = rows[:PENDING_PAGE_SIZE][::-1]
+            # rows after this page may have been settled since it was left
+            has_next = bool(rows) and database.pending_any_after(cur, table, status, rows[-1]['id'])
 
-@bot.message_handler(func=lambda m: m.text == "📝 Tasks")
-def show_tasks(message):
-    ensure_user_db(message.chat.id)
-    bot.send_message(message.chat.id, "Choose a task type:", reply_markup=tasks_menu())
+    parts = [f"{title}: {total}\n\n"]
+    parts.extend(fmt(r) for r in rows)
+    if not rows:
+        parts.append("Nothing here.\n")
+
+    markup = types.InlineKeyboardMarkup()
+    buttons = []
+    if has_prev and rows:
+        buttons.append(types.InlineKeyboardButton("◀ Prev", callback_data=encode_callback(CB_PENDING_PREV, kind, rows[0]['id'])))
+    if has_next and rows:
+        buttons.append(types.InlineKeyboardButton("Next ▶", callback_data=encode_callback(CB_PENDING_NEXT, kind, rows[-1]['id'])))
+    if buttons:
+        markup.row(*buttons)
+    return "".join(parts), markup
+
+
+@bot.message_handler(commands=['pending'])
+def cmd_pending(message):
+    # admin-only: show pending tasks and withdraws
+    if message.chat.id != ADMIN_CHAT_ID:
+        send_message(message.chat.id, "You are not authorized to use this command.", reply_to_message_id=message.message_id)
+        return
+
+    for kind in (PENDING_TASKS, PENDING_WITHDRAWS):
+        text, markup = pending_page(kind)
+        send_message(ADMIN_CHAT_ID, text, reply_markup=markup)
 
 # ============================================================
-# MAIN TEXT HANDLER
+# BULK WITHDRAW SETTLEMENT (admin)
 # ============================================================
+# /bulkwd approve|reject all|<method>|<id> [<id> ...]
+# All selected pending withdraws are settled in one transaction with
+# set-based UPDATEs; user notifications then go out through OUTBOUND.
+
+BULK_WD_USAGE = (
+    "Usage:\n"
+    "/bulkwd approve all\n"
+    "/bulkwd reject easypaisa\n"
+    "/bulkwd approve 12 13 14"
+)
 
-@bot.message_handler(func=lambda m: True)
-def handle_text(message):
-    uid = message.chat.id
-    ensure_user_db(uid)
-    user_row = get_user_db(uid)
-    text = (message.text or "").strip()
 
-    # BALANCE
-    if text.lower() in ["💼 balance", "balance"]:
-        user_row = get_user_db(uid)
-        msg = f"💼 Balance: {user_row['balance']} PKR\n🔒 Hold: {user_row['hold']} PKR"
-        bot.send_message(uid, msg)
-        return
+def settle_withdraws(action, method=None, ids=None):
+    """Approve or reject pending withdraws in a single transaction.
 
-    # WITHDRAW
-    if text.lower() in ["💰 withdraw", "withdraw"]:
-        users_state.pop(uid, None)
-        users_state[uid] = {'state': None}
-        bot.send_message(uid, "Select withdrawal method:", reply_markup=withdraw_methods_markup())
-        return
+    Selects by method (None = every method) or by explicit ids; only rows
+    still 'pending' are touched. Returns the settled (id, user_id, pkr_amount)
+    rows.
+    """
+    status = 'approved' if action == 'approve' else 'rejected'
+    refund = 1 if action == 'reject' else 0
+    reason = ledger.WITHDRAW_REFUND if refund else ledger.WITHDRAW_PAID
+    with db_write() as cur:
+        rows = database.select_pending_withdraws(cur, method=method, ids=ids)
+        if not rows:
+            return rows
+        database.settle_selected_withdraws(cur, status, refund, reason, int(time.time()))
+    USER_CACHE.invalidate(*{r['user_id'] for r in rows})
+    return rows
 
-    # TASKS
-    if text.lower() in ["📝 tasks", "tasks"]:
-        bot.send_message(uid, "Choose a task:", reply_markup=tasks_menu())
-        return
 
-    # REFERRAL
-    if text.lower() in ["🔗 referral link", "referral", "/referral"]:
-        try:
-            username = bot.get_me().username
-            link = f"https://t.me/{username}?start={uid}"
-        except Exception:
-            link = f"t.me/<bot_username>?start={uid}"
-        bot.send_message(uid, f"Your Referral Link:\n{link}")
+@bot.message_handler(commands=['bulkwd'])
+def cmd_bulk_withdraw(message):
+    if message.chat.id != ADMIN_CHAT_ID:
+        send_message(message.chat.id, "You are not authorized to use this command.", reply_to_message_id=message.message_id)
         return
 
-    # HELP
-    if text.lower() in ["❓ help", "/help", "help"]:
-        bot.send_message(uid, HELP_TEXT)
+    args = (message.text or "").split()[1:]
+    if len(args) < 2 or args[0] not in ('approve', 'reject'):
+        send_message(ADMIN_CHAT_ID, BULK_WD_USAGE)
         return
+    action, target = args[0], args[1:]
 
-    # Handle withdraw steps in users_state
-    state = users_state.get(uid, {})
-    if state and state.get('state') and state['state'].startswith('awaiting_withdraw_'):
-        method = state['state'].split('_', 2)[2]
+    method, ids = None, None
+    if target[0].isdigit():
         try:
-            amt = float(text)
-        except:
-            bot.send_message(uid, "❌ Invalid amount. Send a number (e.g. 500).")
+            ids = [int(x) for x in target]
+        except ValueError:
+            send_message(ADMIN_CHAT_ID, BULK_WD_USAGE)
+            return
+    elif target[0] != 'all':
+        method = target[0].lower()
+        if method not in WITHDRAW_METHODS:
+            send_message(ADMIN_CHAT_ID, f"Unknown method. Use one of: {', '.join(WITHDRAW_METHODS)}")
             return
 
-        if method == 'binance':
-            if amt < BINANCE_MIN_USD:
-                bot.send_message(uid, f"Minimum is {BINANCE_MIN_USD} USD")
-                return
-            required_pkr = int(amt * BINANCE_PKR_PER_USD)
-            user_row = get_user_db(uid)
-            if not user_row or user_row['balance'] < required_pkr:
-                bot.send_message(uid, f"❌ Not enough balance. You need {required_pkr} PKR.")
-                return
-            state['temp'] = {'method': method, 'usd_amount': amt, 'pkr_amount': required_pkr}
+    started = time.perf_counter()
+    rows = settle_withdraws(action, method=method, ids=ids)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+
+    for r in rows:
+        if action == 'approve':
+            send_message(r['user_id'], f"✅ Withdraw approved: {r['pkr_amount']} PKR")
         else:
-            if amt < WITHDRAW_MIN_PKR:
-                bot.send_message(uid, f"Minimum is {WITHDRAW_MIN_PKR} PKR")
-                return
-            user_row = get_user_db(uid)
-            if not user_row or user_row['balance'] < amt:
-                bot.send_message(uid, "❌ Insufficient balance.")
-                return
-            state['temp'] = {'method': method, 'pkr_amount': int(amt)}
+            send_message(r['user_id'], f"❌ Withdraw rejected. {r['pkr_amount']} PKR refunded.")
+
+    verb = "Approved" if action == 'approve' else "Rejected"
+    total = sum(r['pkr_amount'] for r in rows)
+    send_message(
+        ADMIN_CHAT_ID,
+        f"{verb} {len(rows)} withdraws ({total} PKR, {len({r['user_id'] for r in rows})} users) "
+        f"in {elapsed_ms:.1f} ms. {len(rows)} user notifications queued."
+    )
 
-        state['state'] = f"awaiting_account_name_{method}"
-        users_state[uid] = state
-        bot.send_message(uid, "✔ Send Account Holder Name:")
+@bot.message_handler(commands=['reconcile'])
+def cmd_reconcile(message):
+    # admin-only: /reconcile -> all users, /reconcile <uid> -> one user + history
+    if message.chat.id != ADMIN_CHAT_ID:
+        send_message(message.chat.id, "You are not authorized to use this command.", reply_to_message_id=message.message_id)
         return
+    args = (message.text or "").split()[1:]
 
-    if state and state.get('state') and state['state'].startswith('awaiting_account_name_'):
-        method = state['state'].split('_', 3)[3]
-        if 'temp' not in state:
-            bot.send_message(uid, "❌ Error: No withdraw in progress. Start again.")
-            users_state.pop(uid, None)
-            return
-        state['temp']['account_name'] = text
-        state['state'] = f"awaiting_account_number_{method}"
-        users_state[uid] = state
-        bot.send_message(uid, "✔ Now send Account Number:")
-        return
-
-    if state and state.get('state') and state['state'].startswith('awaiting_account_number_'):
-        method = state['state'].split('_', 3)[3]
-        temp = state.get('temp')
-        if not temp:
-            bot.send_message(uid, "❌ Error: No withdraw temp found. Start again.")
-            users_state.pop(uid, None)
+    if args:
+        try:
+            uid = int(args[0])
+        except ValueError:
+            send_message(ADMIN_CHAT_ID, "Usage: /reconcile [user_id]")
             return
-        temp['account_number'] = text
-
-        # create withdraw row in DB
-        with DB_LOCK:
-            conn = get_db_conn()
-            cur = conn.cursor()
-            now = datetime.utcnow().isoformat()
-            cur.execute(
-                "INSERT INTO withdraws (user_id, method, account_name, account_number, pkr_amount, usd_amount, status, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-                (uid, temp.get('method'), temp.get('account_name'), temp.get('account_number'), temp.get('pkr_amount'), temp.get('usd_amount'), 'pending', now)
-            )
-            wd_id = cur.lastrowid
-            pkr_hold = temp.get('pkr_amount', 0)
-            cur.execute("SELECT balance, hold FROM users WHERE id = ?", (uid,))
-            ur = cur.fetchone()
-            if not ur or ur['balance'] < pkr_hold:
-                conn.rollback()
-                conn.close()
-                bot.send_message(uid, "❌ Unexpected error: insufficient balance.")
-                users_state.pop(uid, None)
+        with db_read() as cur:
+            u = database.get_user(cur, uid)
+            if not u:
+                send_message(ADMIN_CHAT_ID, "User not found.")
                 return
-            cur.execute("UPDATE users SET balance = balance - ?, hold = hold + ? WHERE id = ?", (pkr_hold, pkr_hold, uid))
-            conn.commit()
-            conn.close()
-
-        # notify admin
-        admin_markup = types.InlineKeyboardMarkup()
-        admin_markup.add(
-            types.InlineKeyboardButton("Approve", callback_data=f"approve_wd_{wd_id}"),
-            types.InlineKeyboardButton("Reject", callback_data=f"reject_wd_{wd_id}")
-        )
+            ledger_balance, ledger_hold = ledger.recompute(cur, uid)
+            entries = ledger.history(cur, uid)
+        ok = "✅" if (ledger_balance, ledger_hold) == (u['balance'], u['hold']) else "❌"
+        lines = [
+            f"{ok} User {uid}",
+            f"Balance: {u['balance']} (ledger {ledger_balance})",
+            f"Hold: {u['hold']} (ledger {ledger_hold})",
+            "",
+            "Recent entries:",
+        ]
+        for e in entries:
+            ts = datetime.utcfromtimestamp(e['created_at']).strftime('%Y-%m-%d %H:%M')
+            lines.append(f"#{e['id']} {ts} {e['reason']} ref={e['ref_id']} bal {e['delta_balance']:+} hold {e['delta_hold']:+}")
+        send_message(ADMIN_CHAT_ID, "\n".join(lines))
+        return
 
-        admin_text = (
-            f"💸 *New Withdraw Request*\n"
-            f"WDID: `{wd_id}`\n"
-            f"User: `{uid}`\n"
-            f"Method: *{temp.get('method')}*\n"
-            f"Account Name: `{temp.get('account_name')}`\n"
-            f"Account Number: `{temp.get('account_number')}`\n"
-            f"Amount (PKR): `{temp.get('pkr_amount')}`\n"
-            f"Amount (USD): `{temp.get('usd_amount')}`\n"
-            f"Processing Time: {WITHDRAW_PROCESSING_HOURS} hours\n"
+    started = time.perf_counter()
+    folded = checkpoint_ledger()
+    with db_read() as cur:
+        bad = ledger.mismatches(cur)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    msg = f"Checkpointed {folded} ledger entries. Reconciled in {elapsed_ms:.1f} ms: "
+    if not bad:
+        msg += "all balances match the ledger."
+    else:
+        msg += f"{len(bad)} mismatches (showing up to 20):\n"
+        msg += "\n".join(
+            f"User {r['id']}: balance {r['balance']} vs {r['ledger_balance']}, hold {r['hold']} vs {r['ledger_hold']}"
+            for r in bad
         )
+    send_message(ADMIN_CHAT_ID, msg)
 
-        admin_notify(admin_text, admin_markup)
-        bot.send_message(uid, f"⏳ Your withdraw request is under review. Processing time: {WITHDRAW_PROCESSING_HOURS} hours.")
-        users_state.pop(uid, None)
-        return
 
-    # TASK INPUTS (own gmail / fb) - storing as draft then submit
-    if state and state.get('state') == 'awaiting_own_gmail':
-        parts = text.split()
-        if len(parts) < 2:
-            bot.send_message(uid, "Send: email password")
-            return
-        task_id = get_and_inc_next_task_id(uid)
-        now = datetime.utcnow().isoformat()
-        with DB_LOCK:
-            conn = get_db_conn()
-            cur = conn.cursor()
-            cur.execute(
-                "INSERT INTO tasks (user_id, task_id, type, email, password, reward, status, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-                (uid, task_id, 'own', parts[0], ' '.join(parts[1:]), OWN_TASK_REWARD, 'draft', now)
-            )
-            conn.commit()
-            conn.close()
+# ============================================================
+# ADMIN STATS / REPORTS
+# ============================================================
+# /stats reads the trigger-maintained counters (database.get_stats), a few
+# dozen rows whatever the table sizes; "/stats rebuild" recounts them with
+# full scans and reports any drift.
+
+TASK_STATUSES = ("draft", "pending_admin", "approved", "rejected")
+WITHDRAW_STATUSES = ("pending", "approved", "rejected")
 
-        users_state.pop(uid, None)
-        markup = types.InlineKeyboardMarkup()
-        markup.add(types.InlineKeyboardButton("Done", callback_data=f"done_task_{uid}_{task_id}"))
-        markup.add(types.InlineKeyboardButton("Cancel", callback_data=f"cancel_task_{uid}_{task_id}"))
-        bot.send_message(uid, "Credentials saved. Press *Done* when finished.", reply_markup=markup, parse_mode="Markdown")
+
+def format_stats(s):
+    tasks = ", ".join(f"{status} {s.get('tasks_' + status, 0)}" for status in TASK_STATUSES)
+    withdraws = "\n".join(
+        f"  {status}: {s.get('withdraws_' + status, 0)} ({s.get(f'withdraws_{status}_pkr', 0)} PKR)"
+        for status in WITHDRAW_STATUSES
+    )
+    return (
+        "📊 Stats\n"
+        f"Users: {s.get('users', 0)} ({s.get('referrals', 0)} referred)\n"
+        f"Balances: {s.get('balance_total', 0)} PKR, on hold: {s.get('hold_total', 0)} PKR\n"
+        f"Tasks: {tasks}\n"
+        f"Withdraws:\n{withdraws}"
+    )
+
+
+@bot.message_handler(commands=['stats'])
+def cmd_stats(message):
+    if message.chat.id != ADMIN_CHAT_ID:
+        send_message(message.chat.id, "You are not authorized to use this command.", reply_to_message_id=message.message_id)
+        return
+    args = (message.text or "").split()[1:]
+
+    started = time.perf_counter()
+    if args[:1] == ["rebuild"]:
+        with db_write() as cur:
+            before = database.get_stats(cur)
+            database.recount_stats(cur)
+            after = database.get_stats(cur)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        drift = [f"{k}: {before.get(k, 0)} -> {after.get(k, 0)}" for k in sorted(set(before) | set(after)) if before.get(k, 0) != after.get(k, 0)]
+        note = "no drift." if not drift else "drift:\n" + "\n".join(drift)
+        send_message(ADMIN_CHAT_ID, f"{format_stats(after)}\n\nRecounted in {elapsed_ms:.1f} ms, {note}")
         return
 
-    if state and state.get('state') == 'awaiting_fb_details':
-        parts = text.split()
-        if len(parts) < 4:
-            bot.send_message(uid, "Send: fb_id fb_email fb_password 2fa")
-            return
-        task_id = get_and_inc_next_task_id(uid)
-        now = datetime.utcnow().isoformat()
-        with DB_LOCK:
-            conn = get_db_conn()
-            cur = conn.cursor()
-            cur.execute(
-                "INSERT INTO tasks (user_id, task_id, type, fb_id, email, password, twofa, reward, status, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                (uid, task_id, 'facebook', parts[0], parts[1], parts[2], parts[3], FB_TASK_REWARD, 'draft', now)
+    with db_read() as cur:
+        s = database.get_stats(cur)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    send_message(ADMIN_CHAT_ID, f"{format_stats(s)}\n\nRead in {elapsed_ms:.2f} ms")
+
+# /report [days] reads the per-day rollups (database.rollup_since): a few
+# rows per active day, however much history the tables hold.
+
+REPORT_DEFAULT_DAYS = 30
+REPORT_MAX_DAYS = 366
+
+
+def _day(day):
+    return datetime.utcfromtimestamp(day * 86400).strftime('%Y-%m-%d')
+
+
+def format_report(rows, first_day, last_day):
+    totals = {}   # metric -> value
+    by_dim = {}   # (metric, dim) -> value
+    days = {}     # day -> {metric: value}
+    for r in rows:
+        totals[r['metric']] = totals.get(r['metric'], 0) + r['value']
+        key = (r['metric'], r['dim'])
+        by_dim[key] = by_dim.get(key, 0) + r['value']
+        per_day = days.setdefault(r['day'], {})
+        per_day[r['metric']] = per_day.get(r['metric'], 0) + r['value']
+
+    t = totals.get
+    task_types = sorted({dim for metric, dim in by_dim if metric.startswith('tasks_')})
+    methods = sorted({dim for metric, dim in by_dim if metric.startswith('withdraws_')})
+    lines = [
+        f"📈 Report {_day(first_day)} – {_day(last_day)}",
+        f"Tasks: submitted {t('tasks_submitted', 0)}, approved {t('tasks_approved', 0)}, rejected {t('tasks_rejected', 0)}",
+    ]
+    lines.extend(
+        f"  {dim}: {by_dim.get(('tasks_submitted', dim), 0)} / {by_dim.get(('tasks_approved', dim), 0)} / "
+        f"{by_dim.get(('tasks_rejected', dim), 0)}, {by_dim.get(('rewards_paid', dim), 0)} PKR paid"
+        for dim in task_types
+    )
+    lines.append(f"Rewards paid: {t('rewards_paid', 0)} PKR")
+    lines.append(
+        f"Withdraws: requested {t('withdraws_requested', 0)} ({t('withdraws_requested_pkr', 0)} PKR), "
+        f"approved {t('withdraws_approved', 0)} ({t('withdraws_approved_pkr', 0)} PKR), "
+        f"rejected {t('withdraws_rejected', 0)} ({t('withdraws_rejected_pkr', 0)} PKR)"
+    )
+    lines.extend(
+        f"  {dim}: requested {by_dim.get(('withdraws_requested_pkr', dim), 0)} PKR, "
+        f"paid {by_dim.get(('withdraws_approved_pkr', dim), 0)} PKR"
+        for dim in methods
+    )
+    if days:
+        lines.append("")
+        lines.append("Day: submitted / approved / rewards PKR / paid out PKR")
+        for day in sorted(days, reverse=True):
+            d = days[day]
+            lines.append(
+                f"{_day(day)}: {d.get('tasks_submitted', 0)} / {d.get('tasks_approved', 0)} / "
+                f"{d.get('rewards_paid', 0)} / {d.get('withdraws_approved_pkr', 0)}"
             )
-            conn.commit()
-            conn.close()
+    return "\n".join(lines)
 
-        users_state.pop(uid, None)
-        markup = types.InlineKeyboardMarkup()
-        markup.add(types.InlineKeyboardButton("Done", callback_data=f"done_task_{uid}_{task_id}"))
-        markup.add(types.InlineKeyboardButton("Cancel", callback_data=f"cancel_task_{uid}_{task_id}"))
-        bot.send_message(uid, "Facebook info saved. Press *Done* when finished.", reply_markup=markup)
+
+@bot.message_handler(commands=['report'])
+def cmd_report(message):
+    if message.chat.id != ADMIN_CHAT_ID:
+        send_message(message.chat.id, "You are not authorized to use this command.", reply_to_message_id=message.message_id)
+        return
+    args = (message.text or "").split()[1:]
+    try:
+        n_days = min(max(int(args[0]), 1), REPORT_MAX_DAYS) if args else REPORT_DEFAULT_DAYS
+    except ValueError:
+        send_message(ADMIN_CHAT_ID, "Usage: /report [days]")
         return
 
-    # FALLBACK
-    bot.send_message(uid, "Use menu options.", reply_markup=main_menu())
+    started = time.perf_counter()
+    last_day = int(time.time()) // 86400
+    first_day = last_day - n_days + 1
+    with db_read() as cur:
+        rows = database.rollup_since(cur, first_day)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    send_message(ADMIN_CHAT_ID, f"{format_report(rows, first_day, last_day)}\n\n{len(rows)} rollup rows read in {elapsed_ms:.2f} ms")
 
 # ============================================================
-# CALLBACKS: single handler for all callbacks
+# ADMIN PANEL / ONLINE BACKUP
 # ============================================================
 
-@bot.callback_query_handler(func=lambda call: True)
-def callback_query(call):
-    data = call.data or ""
-    caller = call.from_user.id if call.from_user else (call.message.chat.id if call.message else None)
+@bot.message_handler(commands=['admin'])
+def admin_panel(message):
+    if message.chat.id != ADMIN_CHAT_ID:
+        send_message(message.chat.id, "❌ You are not authorized.")
+        return
 
-    # TASK menu (user asking for tasks)
-    if data == "task_gen" and caller != ADMIN_CHAT_ID:
-        uid = caller
-        ensure_user_db(uid)
-        email, password = generate_email()
-        task_id = get_and_inc_next_task_id(uid)
-        created_at = datetime.utcnow().isoformat()
-        with DB_LOCK:
-            conn = get_db_conn()
-            cur = conn.cursor()
-            cur.execute(
-                "INSERT INTO tasks (user_id, task_id, type, email, password, reward, status, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-                (uid, task_id, 'generated', email, password, GEN_TASK_REWARD, 'draft', created_at)
-            )
-            conn.commit()
-            conn.close()
-
-        text = (
-            "✅ *Generated Gmail Task*\n\n"
-            "Use the credentials below to create a Gmail account:\n\n"
-            f"📧 `{email}`\n"
-            f"🔐 `{password}`\n\n"
-            f"Reward: {GEN_TASK_REWARD} PKR\n\n"
-            "Press *Done* when you finish to submit this task for review."
-        )
+    markup = telebot.types.ReplyKeyboardMarkup(resize_keyboard=True)
+    markup.add("👤 User Balance", "➕ Add Balance", "➖ Reduce Balance")
+    markup.add("📊 Total Users", "📁 Backup Data")
+
+    send_message(message.chat.id, "🔐 Admin Panel:", reply_markup=markup)
+
+
+# Balance tools: each button starts a short conversation kept in users_state,
+# like the withdraw steps, and answered by the admin_* state routes below.
 
-        markup = types.InlineKeyboardMarkup()
-        markup.add(types.InlineKeyboardButton("✅ Done Task", callback_data=f"done_task_{uid}_{task_id}"))
-        markup.add(types.InlineKeyboardButton("❌ Cancel Task", callback_data=f"cancel_task_{uid}_{task_id}"))
-        bot.answer_callback_query(call.id)
-        bot.send_message(uid, text, reply_markup=markup, parse_mode="Markdown")
+@bot.message_handler(func=lambda m: m.text == "👤 User Balance")
+def admin_ask_balance(message):
+    if message.chat.id != ADMIN_CHAT_ID:
         return
+    users_state.set(ADMIN_CHAT_ID, 'admin_balance')
+    send_message(ADMIN_CHAT_ID, "Enter User ID:")
 
-    if data == "task_own" and caller != ADMIN_CHAT_ID:
-        uid = caller
-        ensure_user_db(uid)
-        users_state[uid] = {'state': 'awaiting_own_gmail'}
-        bot.answer_callback_query(call.id)
-        bot.send_message(uid, "Send:\nemail password", parse_mode="Markdown")
+
+@bot.message_handler(func=lambda m: m.text in ("➕ Add Balance", "➖ Reduce Balance"))
+def admin_ask_adjust(message):
+    if message.chat.id != ADMIN_CHAT_ID:
         return
+    action = 'add' if message.text == "➕ Add Balance" else 'reduce'
+    users_state.set(ADMIN_CHAT_ID, f'admin_target_{action}')
+    send_message(ADMIN_CHAT_ID, f"Enter User ID to {action} balance:")
 
-    if data == "task_fb" and caller != ADMIN_CHAT_ID:
-        uid = caller
-        ensure_user_db(uid)
-        users_state[uid] = {'state': 'awaiting_fb_details'}
-        bot.answer_callback_query(call.id)
-        bot.send_message(uid, "Send: fb_id fb_email fb_password 2fa_code", parse_mode="Markdown")
+
+@bot.message_handler(func=lambda m: m.text == "📊 Total Users")
+def admin_total_users(message):
+    if message.chat.id != ADMIN_CHAT_ID:
         return
+    with db_read() as cur:
+        total = database.get_stat(cur, 'users')
+    send_message(ADMIN_CHAT_ID, f"📊 Total Users: {total}")
 
-    if data == "help":
-        bot.answer_callback_query(call.id)
-        bot.send_message(caller, HELP_TEXT)
+
+def _admin_target(text):
+    # (id, user row) for an admin-typed id; row is None if unknown
+    try:
+        target = int(text)
+    except ValueError:
+        return None, None
+    return target, get_user_db(target)
+
+
+def state_admin_balance(uid, text, state, arg):
+    users_state.pop(uid)
+    if uid != ADMIN_CHAT_ID:
         return
+    target, row = _admin_target(text)
+    if not row:
+        send_message(uid, "User not found.")
+        return
+    send_message(uid, f"User {target} Balance: {row['balance']} PKR (hold {row['hold']} PKR)")
 
-    # USER selects withdraw method (callback data: wd_<method>)
-    if data.startswith("wd_") and caller is not None and caller != ADMIN_CHAT_ID:
-        method = data.split("_", 1)[1]
-        users_state[caller] = {'state': f'awaiting_withdraw_{method}'}
-        bot.answer_callback_query(call.id)
-        if method == 'binance':
-            bot.send_message(caller, "Enter amount in USD:")
-        else:
-            bot.send_message(caller, "Enter amount in PKR:")
+
+def state_admin_target(uid, text, state, action):
+    if uid != ADMIN_CHAT_ID:
+        users_state.pop(uid)
+        return
+    target, row = _admin_target(text)
+    if not row:
+        users_state.pop(uid)
+        send_message(uid, "User not found.")
         return
+    users_state.set(uid, f'admin_amount_{action}', {'target': target})
+    send_message(uid, f"Enter amount to {action} for {target} (balance {row['balance']} PKR):")
 
-    # USER: Done task -> change draft -> pending_admin and notify admin
-    if data.startswith("done_task_"):
-        parts = data.split("_")
-        # format: done_task_<uid>_<task_id>
-        try:
-            target = int(parts[2])
-            task_id = int(parts[3])
-        except Exception:
-            bot.answer_callback_query(call.id, "Invalid data.")
-            return
 
-        with DB_LOCK:
-            conn = get_db_conn()
-            cur = conn.cursor()
-            cur.execute("SELECT * FROM tasks WHERE user_id = ? AND task_id = ? AND status = 'draft'", (target, task_id))
-            t = cur.fetchone()
-            if not t:
-                conn.close()
-                bot.answer_callback_query(call.id, "Task not found or already submitted.")
-                return
-            cur.execute("UPDATE tasks SET status = 'pending_admin' WHERE id = ?", (t['id'],))
-            conn.commit()
-            cur.execute("SELECT * FROM tasks WHERE id = ?", (t['id'],))
-            t2 = cur.fetchone()
-            conn.close()
-
-        bot.answer_callback_query(call.id)
-        bot.send_message(target, "⏳ Task submitted. Admin reviewing. You can do other tasks while this is pending.")
-
-        details = (
-            "📥 *New Task Submitted*\n"
-            f"👤 User: `{target}`\n"
-            f"💰 Reward: `{t2['reward']}` PKR\n"
-            f"📌 Type: *{t2['type']}*\n"
-            f"🔢 TaskID: `{t2['task_id']}`\n\n"
+def state_admin_amount(uid, text, state, action):
+    users_state.pop(uid)
+    target = (state.get('temp') or {}).get('target')
+    if uid != ADMIN_CHAT_ID or target is None:
+        return
+    try:
+        amount = int(text)
+    except ValueError:
+        amount = 0
+    if amount <= 0:
+        send_message(uid, "Invalid amount.")
+        return
+
+    balance = adjust_user_balance(target, amount if action == 'add' else -amount)
+    if balance is None:
+        send_message(uid, f"❌ User {target} not found or balance too low.")
+        return
+    verb = "Added" if action == 'add' else "Reduced"
+    send_message(uid, f"{verb} {amount} PKR for {target}. New balance: {balance} PKR")
+
+
+def backup_progress_reporter(label):
+    # progress message to the admin at every 25% step
+    next_pct = [25]
+
+    def report(done, total):
+        pct = done * 100 // total if total else 100
+        if next_pct[0] <= pct < 100:
+            send_message(ADMIN_CHAT_ID, f"{label}: {pct}% ({done}/{total} pages)", priority=PRIORITY_ADMIN)
+            next_pct[0] = pct // 25 * 25 + 25
+    return report
+
+
+def _send_backup_document(path, caption):
+    with open(path, "rb") as f:
+        bot.send_document(ADMIN_CHAT_ID, f, caption=caption)
+
+
+def _run_backup_job():
+    try:
+        r = backup.run_backup(
+            database.DB_PATH, BACKUP_DIR,
+            pages_per_step=BACKUP_PAGES_PER_STEP,
+            step_sleep=BACKUP_STEP_SLEEP,
+            progress=backup_progress_reporter("Backup"),
+            archive_db_path=database.ARCHIVE_DB_PATH,
         )
-        if t2['type'] in ('generated', 'own'):
-            details += f"Email: `{t2['email']}`\nPassword: `{t2['password']}`\n"
-        elif t2['type'] == 'facebook':
-            details += (
-                f"FB ID: `{t2['fb_id']}`\n"
-                f"Email: `{t2['email']}`\n"
-                f"Password: `{t2['password']}`\n"
-                f"2FA: `{t2['twofa']}`\n"
-            )
+    except Exception as e:
+        print("Backup failed:", e)
+        send_message(ADMIN_CHAT_ID, f"❌ Backup failed: {e}", priority=PRIORITY_ADMIN)
+        return
+
+    name = os.path.basename(r['path'])
+    summary = (
+        f"✅ Backup {name}: {r['pages']} pages in {r['copy_seconds']:.2f}s "
+        f"({r['pages_per_second']:.0f} pages/s), compressed to {r['bytes'] / 1024:.0f} KiB "
+        f"in {r['compress_seconds']:.2f}s"
+    )
+    send_message(ADMIN_CHAT_ID, summary, priority=PRIORITY_ADMIN)
+    for path in (r['path'], r['archive_path']):
+        if path and os.path.getsize(path) <= BACKUP_SEND_MAX_BYTES:
+            OUTBOUND.submit(ADMIN_CHAT_ID, _send_backup_document, path, os.path.basename(path), priority=PRIORITY_ADMIN)
+
 
-        admin_markup = types.InlineKeyboardMarkup()
-        admin_markup.add(
-            types.InlineKeyboardButton("Approve", callback_data=f"approve_task_{t2['id']}"),
-            types.InlineKeyboardButton("Reject", callback_data=f"reject_task_{t2['id']}")
+@bot.message_handler(commands=['backup'])
+@bot.message_handler(func=lambda m: m.text == "📁 Backup Data")
+def cmd_backup(message):
+    if message.chat.id != ADMIN_CHAT_ID:
+        return
+    # the copy runs off the update worker so this chat's queue keeps moving
+    threading.Thread(target=_run_backup_job, name="backup", daemon=True).start()
+    send_message(ADMIN_CHAT_ID, "📁 Backup started…")
+
+
+@bot.message_handler(commands=['backups'])
+def cmd_list_backups(message):
+    if message.chat.id != ADMIN_CHAT_ID:
+        return
+    names = backup.list_backups(BACKUP_DIR)
+    if not names:
+        send_message(ADMIN_CHAT_ID, "No backups yet.")
+        return
+    send_message(ADMIN_CHAT_ID, "Backups:\n" + "\n".join(names[-20:]) + "\n\nRestore: /restore <name> confirm")
+
+
+_restore_generation = {'value': None, 'checked': 0.0}
+_restore_generation_lock = threading.Lock()
+
+
+def drop_restored_caches():
+    USER_CACHE.clear()
+    UPDATE_WINDOW.reset()
+    if isinstance(users_state, MemoryStateStore):
+        users_state.clear()
+    database.DB_POOL.close_all()
+
+
+def check_restore_generation():
+    """Drop this worker's caches if a /restore ran since the last check."""
+    now = time.monotonic()
+    if now - _restore_generation['checked'] < RESTORE_CHECK_SECONDS:
+        return False
+    with _restore_generation_lock:
+        if now - _restore_generation['checked'] < RESTORE_CHECK_SECONDS:
+            return False
+        _restore_generation['checked'] = now
+        with db_read() as cur:
+            value = database.restore_generation(cur)
+        seen, _restore_generation['value'] = _restore_generation['value'], value
+    if seen is None or seen == value:
+        return False
+    drop_restored_caches()
+    return True
+
+
+def _bump_restore_generation(generation):
+    # the restored copy carries the generation it was taken with
+    with db_write() as cur:
+        database.set_restore_generation(cur, generation + 1)
+    with _restore_generation_lock:
+        _restore_generation['value'] = generation + 1
+    drop_restored_caches()
+
+
+def _run_restore_job(name):
+    with db_read() as cur:
+        generation = database.restore_generation(cur)
+    try:
+        r = backup.restore_backup(
+            os.path.join(BACKUP_DIR, name), database.DB_PATH,
+            pages_per_step=BACKUP_PAGES_PER_STEP,
+            step_sleep=BACKUP_STEP_SLEEP,
+            progress=backup_progress_reporter("Restore"),
+            archive_db_path=database.ARCHIVE_DB_PATH,
         )
-        admin_notify(details, admin_markup)
+    except backup.BackupBusy as e:
+        send_message(ADMIN_CHAT_ID, f"❌ Restore failed: {e}", priority=PRIORITY_ADMIN)
+        return
+    except Exception as e:
+        print("Restore failed:", e)
+        send_message(ADMIN_CHAT_ID, f"❌ Restore failed: {e}", priority=PRIORITY_ADMIN)
+        # part of the data may have been replaced already
+        _bump_restore_generation(generation)
+        return
+    _bump_restore_generation(generation)
+    restored = "with its archive" if r['archive'] else "(no archive copy)"
+    migrated = f", {len(r['migrations'])} migrations applied" if r['migrations'] else ""
+    send_message(ADMIN_CHAT_ID, f"✅ Restored {name} {restored}: {r['pages']} pages in {r['seconds']:.2f}s{migrated}", priority=PRIORITY_ADMIN)
+
+
+@bot.message_handler(commands=['restore'])
+def cmd_restore(message):
+    if message.chat.id != ADMIN_CHAT_ID:
+        return
+    args = (message.text or "").split()[1:]
+    if not args or args[0] not in backup.list_backups(BACKUP_DIR):
+        send_message(ADMIN_CHAT_ID, "Usage: /restore <name> confirm (see /backups)")
+        return
+    if args[1:] != ["confirm"]:
+        send_message(ADMIN_CHAT_ID, f"This replaces ALL live data with {args[0]}. Send /restore {args[0]} confirm")
+        return
+
+    # the restore copies every page of both databases; run it off the
+    # update worker like /backup (backup.BackupBusy guards both)
+    send_message(ADMIN_CHAT_ID, f"♻️ Restore of {args[0]} started…")
+    threading.Thread(target=_run_restore_job, args=(args[0],), name="restore", daemon=True).start()
+
+
+def _run_archive_job(days):
+    try:
+        report = archive_finished(days)
+    except Exception as e:
+        print("Archival failed:", e)
+        send_message(ADMIN_CHAT_ID, f"❌ Archival failed: {e}", priority=PRIORITY_ADMIN)
         return
+    send_message(ADMIN_CHAT_ID, format_archive_report(report, days), priority=PRIORITY_ADMIN)
 
-    # USER: Cancel draft task
-    if data.startswith("cancel_task_"):
-        parts = data.split("_")
+
+@bot.message_handler(commands=['archive'])
+def cmd_archive(message):
+    # /archive [days]: run the archival job now (default ARCHIVE_AFTER_DAYS)
+    if message.chat.id != ADMIN_CHAT_ID:
+        return
+    args = (message.text or "").split()[1:]
+    try:
+        days = int(args[0]) if args else ARCHIVE_AFTER_DAYS
+    except ValueError:
+        days = -1
+    if days < 0:
+        send_message(ADMIN_CHAT_ID, "Usage: /archive [days]")
+        return
+    threading.Thread(target=_run_archive_job, args=(days,), name="archive-now", daemon=True).start()
+    send_message(ADMIN_CHAT_ID, f"🗄 Archiving finished rows older than {days} days…")
+
+
+def format_job_runs(rows, lease, now):
+    lines = ["🕒 Scheduled jobs"]
+    if lease:
+        state = "active" if lease['expires_at'] > now else "expired"
+        lines[0] += f" (leader {lease['owner']}, lease {state})"
+    for r in rows:
+        line = (
+            f"{r['name']}: {int(now - r['last_started'])}s ago, {r['last_seconds'] * 1000:.1f} ms, "
+            f"{r['last_rows']} rows, {r['runs']} runs"
+        )
+        if r['last_error']:
+            line += f"\n  ❌ {r['last_error']}"
+        lines.append(line)
+    if not rows:
+        lines.append("No job has run yet.")
+    return "\n".join(lines)
+
+
+@bot.message_handler(commands=['jobs'])
+def cmd_jobs(message):
+    # last run of each scheduled job, whichever worker ran it
+    if message.chat.id != ADMIN_CHAT_ID:
+        return
+    with db_read() as cur:
+        rows = database.job_runs(cur)
+        lease = database.get_lease(cur)
+    send_message(ADMIN_CHAT_ID, format_job_runs(rows, lease, time.time()))
+
+
+PROFILE_USAGE = (
+    "/profile on [fraction] — sample a fraction of updates (default 0.1)\n"
+    "/profile off — stop sampling\n"
+    "/profile — status and top functions\n"
+    "/profile dump — collapsed stacks for flame graphs\n"
+    "/profile reset — drop collected samples"
+)
+
+
+def profile_report():
+    p = PROFILER
+    lines = [
+        f"Profiler {'ON' if p.enabled else 'OFF'} in pid {os.getpid()}: sample rate {p.sample_rate:.0%}, "
+        f"{p.tracked} calls tracked, {p.samples} stack samples"
+    ]
+    top = p.top()
+    if top:
+        lines.append("")
+        lines.append("self / total samples:")
+        lines.extend(f"{own} / {total}  {name}" for name, own, total in top)
+    return "\n".join(lines)
+
+
+def _send_profile_document(path):
+    with open(path, "rb") as f:
+        bot.send_document(ADMIN_CHAT_ID, f, caption=os.path.basename(path))
+
+
+@bot.message_handler(commands=['profile'])
+def cmd_profile(message):
+    if message.chat.id != ADMIN_CHAT_ID:
+        return
+    args = (message.text or "").split()[1:]
+    action = args[0].lower() if args else "status"
+
+    if action == "on":
         try:
-            target = int(parts[2])
-            task_id = int(parts[3])
-        except Exception:
-            bot.answer_callback_query(call.id, "Invalid data.")
+            rate = float(args[1]) if len(args) > 1 else 0.1
+        except ValueError:
+            send_message(ADMIN_CHAT_ID, PROFILE_USAGE)
             return
-        with DB_LOCK:
-            conn = get_db_conn()
-            cur = conn.cursor()
-            cur.execute("SELECT * FROM tasks WHERE user_id = ? AND task_id = ? AND status = 'draft'", (target, task_id))
-            t = cur.fetchone()
-            if t:
-                cur.execute("DELETE FROM tasks WHERE id = ?", (t['id'],))
-                conn.commit()
-            conn.close()
-        bot.answer_callback_query(call.id, "Canceled.")
-        bot.send_message(target, "Task canceled.", reply_markup=main_menu())
-        return
-
-    # ADMIN: Approve task
-    if data.startswith("approve_task_") and caller == ADMIN_CHAT_ID:
-        parts = data.split("_")
-        try:
-            db_task_id = int(parts[2])
-        except Exception:
-            bot.answer_callback_query(call.id, "Invalid data.")
+        PROFILER.start(rate)
+        send_message(ADMIN_CHAT_ID, profile_report())
+    elif action == "off":
+        PROFILER.stop()
+        send_message(ADMIN_CHAT_ID, profile_report())
+    elif action == "reset":
+        PROFILER.reset()
+        send_message(ADMIN_CHAT_ID, "Profiler samples cleared.")
+    elif action == "dump":
+        data = PROFILER.collapsed()
+        if not data:
+            send_message(ADMIN_CHAT_ID, "No samples collected yet.")
             return
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, f"profile-{os.getpid()}-{datetime.utcnow():%Y%m%d-%H%M%S}.folded")
+        with open(path, "w") as f:
+            f.write(data)
+        OUTBOUND.submit(ADMIN_CHAT_ID, _send_profile_document, path, priority=PRIORITY_ADMIN)
+    elif action == "status":
+        send_message(ADMIN_CHAT_ID, profile_report())
+    else:
+        send_message(ADMIN_CHAT_ID, PROFILE_USAGE)
 
-        with DB_LOCK:
-            conn = get_db_conn()
-            cur = conn.cursor()
-            cur.execute("SELECT * FROM tasks WHERE id = ?", (db_task_id,))
-            t = cur.fetchone()
-            if not t:
-                conn.close()
-                bot.answer_callback_query(call.id, "Task not found.")
-                return
-            if t['status'] == 'approved':
-                conn.close()
-                bot.answer_callback_query(call.id, "Already approved.")
-                return
 
-            cur.execute("UPDATE users SET balance = balance + ? WHERE id = ?", (t['reward'], t['user_id']))
-            cur.execute("UPDATE tasks SET status = 'approved' WHERE id = ?", (db_task_id,))
-            cur.execute("UPDATE users SET tasks_completed = tasks_completed + 1 WHERE id = ?", (t['user_id'],))
-            cur.execute("SELECT referrer FROM users WHERE id = ?", (t['user_id'],))
-            r = cur.fetchone()
-            if r and r['referrer']:
-                refid = r['referrer']
-                cur.execute("UPDATE users SET balance = balance + ?, referral_earned = referral_earned + ? WHERE id = ?", (REFERRAL_BONUS_PER_TASK, REFERRAL_BONUS_PER_TASK, refid))
-            conn.commit()
-            cur.execute("SELECT balance FROM users WHERE id = ?", (t['user_id'],))
-            ur = cur.fetchone()
-            conn.close()
-
-        bot.answer_callback_query(call.id)
-        bot.send_message(t['user_id'], f"✅ Task approved! +{t['reward']} PKR")
-        bot.send_message(ADMIN_CHAT_ID, f"Approved task {t['task_id']} for {t['user_id']}")
-        return
-
-    # ADMIN: Reject task
-    if data.startswith("reject_task_") and caller == ADMIN_CHAT_ID:
-        parts = data.split("_")
-        try:
-            db_task_id = int(parts[2])
-        except Exception:
-            bot.answer_callback_query(call.id, "Invalid data.")
-            return
+# text / command handlers for help/menu
+@bot.message_handler(func=lambda m: m.text == "❓ Help")
+def button_help(message):
+    send_message(message.chat.id, HELP_TEXT)
+
+
+@bot.message_handler(func=lambda m: m.text == "📝 Tasks")
+def show_tasks(message):
+    ensure_user_db(message.chat.id)
+    send_message(message.chat.id, "Choose a task type:", reply_markup=tasks_menu())
+
+# ============================================================
+# ADMIN BROADCAST
+# ============================================================
+
+BROADCAST_USAGE = (
+    "/broadcast <text> — prepare a broadcast to all users\n"
+    "/broadcast start <id> — start sending it\n"
+    "/broadcast status [id] — progress (default: latest)\n"
+    "/broadcast cancel <id> — stop it"
+)
 
-        with DB_LOCK:
-            conn = get_db_conn()
-            cur = conn.cursor()
-            cur.execute("SELECT * FROM tasks WHERE id = ?", (db_task_id,))
-            t = cur.fetchone()
-            if not t:
-                conn.close()
-                bot.answer_callback_query(call.id, "Task not found.")
-                return
-            if t['status'] == 'rejected':
-                conn.close()
-                bot.answer_callback_query(call.id, "Already rejected.")
-                return
-            cur.execute("UPDATE tasks SET status = 'rejected' WHERE id = ?", (db_task_id,))
-            conn.commit()
-            conn.close()
 
-        bot.answer_callback_query(call.id)
-        bot.send_message(t['user_id'], f"❌ Task rejected.")
-        bot.send_message(ADMIN_CHAT_ID, f"Rejected task {t['task_id']} for {t['user_id']}")
+def _broadcast_send(chat_id, text, on_done):
+    send_message(chat_id, text, priority=PRIORITY_BROADCAST, on_done=on_done)
+
+
+def format_broadcast(b, rate=None):
+    handled = b['sent'] + b['blocked'] + b['failed']
+    total = max(b['total'], handled)
+    lines = [
+        f"📣 Broadcast #{b['id']}: {b['status']}",
+        f"Progress: {handled} / {total} users ({handled * 100 // total if total else 0}%)",
+        f"Sent {b['sent']}, blocked {b['blocked']}, failed {b['failed']}",
+    ]
+    if rate:
+        line = f"Rate: {rate:.1f} msg/s"
+        if b['status'] == 'running' and total > handled:
+            line += f", ETA {int((total - handled) / rate) // 60}m {int((total - handled) / rate) % 60}s"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def _report_broadcast(row, rate):
+    send_message(ADMIN_CHAT_ID, format_broadcast(row, rate), priority=PRIORITY_ADMIN)
+
+
+BROADCASTER = Broadcaster(
+    _broadcast_send, _report_broadcast,
+    rate=BROADCAST_RATE,
+    chunk_size=BROADCAST_CHUNK_SIZE,
+    report_every=BROADCAST_REPORT_SECONDS,
+    stale_after=BROADCAST_STALE_SECONDS,
+)
+
+
+@bot.message_handler(commands=['broadcast'])
+def cmd_broadcast(message):
+    if message.chat.id != ADMIN_CHAT_ID:
+        return
+    parts = (message.text or "").split(maxsplit=1)
+    text = parts[1].strip() if len(parts) > 1 else ""
+    args = text.split()
+    if not text:
+        send_message(ADMIN_CHAT_ID, BROADCAST_USAGE)
         return
 
-    # ADMIN: Approve withdraw
-    if data.startswith("approve_wd_") and caller == ADMIN_CHAT_ID:
-        parts = data.split("_")
-        try:
-            wd_id = int(parts[2])
-        except Exception:
-            bot.answer_callback_query(call.id, "Invalid data.")
+    if args[0] in ("start", "status", "cancel") and len(args) <= 2 and all(a.isdigit() for a in args[1:]):
+        action = args[0]
+        broadcast_id = int(args[1]) if len(args) > 1 else None
+        if action != "status" and broadcast_id is None:
+            send_message(ADMIN_CHAT_ID, BROADCAST_USAGE)
+        elif action == "start":
+            if BROADCASTER.start(broadcast_id):
+                send_message(ADMIN_CHAT_ID, f"📣 Broadcast #{broadcast_id} started.")
+            else:
+                send_message(ADMIN_CHAT_ID, f"Broadcast #{broadcast_id} is not a draft.")
+        elif action == "cancel":
+            with db_write() as cur:
+                cancelled = database.cancel_broadcast(cur, broadcast_id, time.time())
+            send_message(ADMIN_CHAT_ID, f"Broadcast #{broadcast_id} cancelled." if cancelled else f"Broadcast #{broadcast_id} is not running.")
+        else:
+            with db_read() as cur:
+                b = database.get_broadcast(cur, broadcast_id)
+            send_message(ADMIN_CHAT_ID, format_broadcast(b) if b else "No such broadcast.")
+        return
+
+    with db_write() as cur:
+        broadcast_id = database.create_broadcast(cur, text, int(time.time()))
+        users = database.get_stat(cur, 'users')
+    send_message(ADMIN_CHAT_ID, f"📣 Broadcast #{broadcast_id} to {users} users, preview below. Send /broadcast start {broadcast_id} to send it.")
+    send_message(ADMIN_CHAT_ID, text)
+
+# ============================================================
+# MAIN TEXT HANDLER
+# ============================================================
+# Menu texts are looked up in TEXT_ROUTES (dict on the lower-cased text);
+# anything else is routed by the sender's conversation state.
+
+def text_balance(uid, text, user_row):
+    msg = f"💼 Balance: {user_row['balance']} PKR\n🔒 Hold: {user_row['hold']} PKR"
+    send_message(uid, msg)
+
+
+def text_withdraw(uid, text, user_row):
+    users_state.pop(uid)
+    send_message(uid, "Select withdrawal method:", reply_markup=withdraw_methods_markup())
+
+
+def text_tasks(uid, text, user_row):
+    send_message(uid, "Choose a task:", reply_markup=tasks_menu())
+
+
+def text_referral(uid, text, user_row):
+    username = get_bot_username()
+    if username:
+        link = f"https://t.me/{username}?start={uid}"
+    else:
+        link = f"t.me/<bot_username>?start={uid}"
+    send_message(uid, f"Your Referral Link:\n{link}")
+
+
+def text_help(uid, text, user_row):
+    send_message(uid, HELP_TEXT)
+
+
+def state_withdraw_amount(uid, text, state, method):
+    try:
+        amt = float(text)
+    except:
+        send_message(uid, "❌ Invalid amount. Send a number (e.g. 500).")
+        return
+
+    if method == 'binance':
+        if amt < BINANCE_MIN_USD:
+            send_message(uid, f"Minimum is {BINANCE_MIN_USD} USD")
             return
-        with DB_LOCK:
-            conn = get_db_conn()
-            cur = conn.cursor()
-            cur.execute("SELECT * FROM withdraws WHERE id = ?", (wd_id,))
-            w = cur.fetchone()
-            if not w:
-                conn.close()
-                bot.answer_callback_query(call.id, "Withdraw not found.")
-                return
-            if w['status'] == 'approved':
-                conn.close()
-                bot.answer_callback_query(call.id, "Already approved.")
-                return
-            cur.execute("UPDATE withdraws SET status = 'approved' WHERE id = ?", (wd_id,))
-            p = w['pkr_amount'] if w['pkr_amount'] else 0
-            cur.execute("UPDATE users SET hold = hold - ? WHERE id = ?", (p, w['user_id']))
-            conn.commit()
-            conn.close()
-        bot.answer_callback_query(call.id)
-        bot.send_message(w['user_id'], f"✅ Withdraw approved: {w['pkr_amount']} PKR")
-        bot.send_message(ADMIN_CHAT_ID, f"Approved withdraw {wd_id} for {w['user_id']}")
-        return
-
-    # ADMIN: Reject withdraw
-    if data.startswith("reject_wd_") and caller == ADMIN_CHAT_ID:
-        parts = data.split("_")
-        try:
-            wd_id = int(parts[2])
-        except Exception:
-            bot.answer_callback_query(call.id, "Invalid data.")
+        required_pkr = int(amt * BINANCE_PKR_PER_USD)
+        user_row = get_user_db(uid)
+        if not user_row or user_row['balance'] < required_pkr:
+            send_message(uid, f"❌ Not enough balance. You need {required_pkr} PKR.")
             return
-        with DB_LOCK:
-            conn = get_db_conn()
-            cur = conn.cursor()
-            cur.execute("SELECT * FROM withdraws WHERE id = ?", (wd_id,))
-            w = cur.fetchone()
-            if not w:
-                conn.close()
-                bot.answer_callback_query(call.id, "Withdraw not found.")
-                return
-            if w['status'] == 'rejected':
-                conn.close()
-                bot.answer_callback_query(call.id, "Already rejected.")
-                return
-            p = w['pkr_amount'] if w['pkr_amount'] else 0
-            cur.execute("UPDATE users SET hold = hold - ?, balance = balance + ? WHERE id = ?", (p, p, w['user_id']))
-            cur.execute("UPDATE withdraws SET status = 'rejected' WHERE id = ?", (wd_id,))
-            conn.commit()
-            conn.close()
-        bot.answer_callback_query(call.id)
-        bot.send_message(w['user_id'], f"❌ Withdraw rejected. {p} PKR refunded.")
-        bot.send_message(ADMIN_CHAT_ID, f"Rejected withdraw {wd_id} for {w['user_id']}")
+        temp = {'method': method, 'usd_amount': amt, 'pkr_amount': required_pkr}
+    else:
+        if amt < WITHDRAW_MIN_PKR:
+            send_message(uid, f"Minimum is {WITHDRAW_MIN_PKR} PKR")
+            return
+        user_row = get_user_db(uid)
+        if not user_row or user_row['balance'] < amt:
+            send_message(uid, "❌ Insufficient balance.")
+            return
+        temp = {'method': method, 'pkr_amount': int(amt)}
+
+    users_state.set(uid, f"awaiting_account_name_{method}", temp)
+    send_message(uid, "✔ Send Account Holder Name:")
+
+
+def state_account_name(uid, text, state, method):
+    if 'temp' not in state:
+        send_message(uid, "❌ Error: No withdraw in progress. Start again.")
+        users_state.pop(uid)
         return
+    state['temp']['account_name'] = text
+    users_state.set(uid, f"awaiting_account_number_{method}", state['temp'])
+    send_message(uid, "✔ Now send Account Number:")
 
-    # default: just acknowledge
-    bot.answer_callback_query(call.id)
-@bot.message_handler(commands=['admin'])
-def admin_panel(message):
-    if message.chat.id != ADMIN_CHAT_ID:
-        bot.send_message(message.chat.id, "❌ You are not authorized.")
+
+def state_account_number(uid, text, state, method):
+    temp = state.get('temp')
+    if not temp:
+        send_message(uid, "❌ Error: No withdraw temp found. Start again.")
+        users_state.pop(uid)
+        return
+    temp['account_number'] = text
+
+    # create withdraw row in DB; balance check and hold in one transaction
+    wd_id = None
+    with user_lock(uid), db_write() as cur:
+        now = int(time.time())
+        pkr_hold = temp.get('pkr_amount', 0)
+        ur = database.get_user(cur, uid)
+        if ur and ur['balance'] >= pkr_hold:
+            wd_id = database.insert_withdraw(
+                cur, uid, temp.get('method'), temp.get('account_name'), temp.get('account_number'),
+                temp.get('pkr_amount'), temp.get('usd_amount'), now
+            )
+            ledger.post(cur, uid, -pkr_hold, pkr_hold, ledger.WITHDRAW_HOLD, wd_id)
+    USER_CACHE.invalidate(uid)
+    if wd_id is None:
+        send_message(uid, "❌ Unexpected error: insufficient balance.")
+        users_state.pop(uid)
         return
 
-    markup = telebot.types.ReplyKeyboardMarkup(resize_keyboard=True)
-    markup.add("👤 User Balance", "➕ Add Balance", "➖ Reduce Balance")
-    markup.add("📊 Total Users", "📁 Backup Data")
-    
-    bot.send_message(message.chat.id, "🔐 Admin Panel:", reply_markup=markup)
-@bot.message_handler(func=lambda m: m.text == "👤 User Balance")
-def ask_user_id(message):
-    if message.chat.id != ADMIN_CHAT_ID:
+    # notify admin
+    admin_markup = types.InlineKeyboardMarkup()
+    admin_markup.add(
+        types.InlineKeyboardButton("Approve", callback_data=encode_callback(CB_APPROVE_WD, wd_id)),
+        types.InlineKeyboardButton("Reject", callback_data=encode_callback(CB_REJECT_WD, wd_id))
+    )
+
+    admin_text = (
+        f"💸 *New Withdraw Request*\n"
+        f"WDID: `{wd_id}`\n"
+        f"User: `{uid}`\n"
+        f"Method: *{temp.get('method')}*\n"
+        f"Account Name: `{temp.get('account_name')}`\n"
+        f"Account Number: `{temp.get('account_number')}`\n"
+        f"Amount (PKR): `{temp.get('pkr_amount')}`\n"
+        f"Amount (USD): `{temp.get('usd_amount')}`\n"
+        f"Processing Time: {WITHDRAW_PROCESSING_HOURS} hours\n"
+    )
+
+    admin_notify(admin_text, admin_markup)
+    send_message(uid, f"⏳ Your withdraw request is under review. Processing time: {WITHDRAW_PROCESSING_HOURS} hours.")
+    users_state.pop(uid)
+
+
+# TASK INPUTS (own gmail / fb) - storing as draft then submit
+def state_own_gmail(uid, text, state, arg):
+    parts = text.split()
+    if len(parts) < 2:
+        send_message(uid, "Send: email password")
+        return
+    task_id = get_and_inc_next_task_id(uid)
+    now = int(time.time())
+    with db_write() as cur:
+        database.insert_task(cur, uid, task_id, 'own', OWN_TASK_REWARD, now, email=parts[0], password=' '.join(parts[1:]))
+
+    users_state.pop(uid)
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton("Done", callback_data=encode_callback(CB_DONE_TASK, uid, task_id)))
+    markup.add(types.InlineKeyboardButton("Cancel", callback_data=encode_callback(CB_CANCEL_TASK, uid, task_id)))
+    send_message(uid, "Credentials saved. Press *Done* when finished.", reply_markup=markup, parse_mode="Markdown")
+
+
+def state_fb_details(uid, text, state, arg):
+    parts = text.split()
+    if len(parts) < 4:
+        send_message(uid, "Send: fb_id fb_email fb_password 2fa")
         return
-    bot.send_message(message.chat.id, "Enter User ID:")
-    bot.register_next_step_handler(message, get_user_balance)
+    task_id = get_and_inc_next_task_id(uid)
+    now = int(time.time())
+    with db_write() as cur:
+        database.insert_task(
+            cur, uid, task_id, 'facebook', FB_TASK_REWARD, now,
+            fb_id=parts[0], email=parts[1], password=parts[2], twofa=parts[3]
+        )
+
+    users_state.pop(uid)
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton("Done", callback_data=encode_callback(CB_DONE_TASK, uid, task_id)))
+    markup.add(types.InlineKeyboardButton("Cancel", callback_data=encode_callback(CB_CANCEL_TASK, uid, task_id)))
+    send_message(uid, "Facebook info saved. Press *Done* when finished.", reply_markup=markup)
+
+
+TEXT_ROUTES = TextRouter()
+TEXT_ROUTES.command(text_balance, "💼 balance", "balance")
+TEXT_ROUTES.command(text_withdraw, "💰 withdraw", "withdraw")
+TEXT_ROUTES.command(text_tasks, "📝 tasks", "tasks")
+TEXT_ROUTES.command(text_referral, "🔗 referral link", "referral", "/referral")
+TEXT_ROUTES.command(text_help, "❓ help", "/help", "help")
+TEXT_ROUTES.state("awaiting_withdraw", state_withdraw_amount)
+TEXT_ROUTES.state("awaiting_account_name", state_account_name)
+TEXT_ROUTES.state("awaiting_account_number", state_account_number)
+TEXT_ROUTES.state("awaiting_own_gmail", state_own_gmail)
+TEXT_ROUTES.state("awaiting_fb_details", state_fb_details)
+TEXT_ROUTES.state("admin_balance", state_admin_balance)
+TEXT_ROUTES.state("admin_target", state_admin_target)
+TEXT_ROUTES.state("admin_amount", state_admin_amount)
+
+
+@bot.message_handler(func=lambda m: True)
+def handle_text(message):
+    uid = message.chat.id
+    ensure_user_db(uid)
+    user_row = get_user_db(uid)
+    text = (message.text or "").strip()
+
+    handler = TEXT_ROUTES.resolve_command(text)
+    if handler:
+        with ROUTE_SECONDS.time(handler.__name__):
+            handler(uid, text, user_row)
+        return
+
+    state = users_state.get(uid)
+    handler, arg = TEXT_ROUTES.resolve_state(state.get('state'))
+    if handler:
+        with ROUTE_SECONDS.time(handler.__name__):
+            handler(uid, text, state, arg)
+        return
+
+    # FALLBACK
+    send_message(uid, "Use menu options.", reply_markup=main_menu())
+
+# ============================================================
+# CALLBACKS: routed through CALLBACK_ROUTES
+# ============================================================
+# Static buttons match on their exact callback data; dynamic buttons use
+# the compact codec from router.py (encode_callback) and still accept the
+# legacy "<action>_<kind>_<ids>" data of buttons sent before the switch.
+
+# TASK menu (user asking for tasks)
+def cb_task_gen(call, caller):
+    uid = caller
+    ensure_user_db(uid)
+    email, password = generate_email()
+    task_id = get_and_inc_next_task_id(uid)
+    created_at = int(time.time())
+    with db_write() as cur:
+        database.insert_task(cur, uid, task_id, 'generated', GEN_TASK_REWARD, created_at, email=email, password=password)
+
+    text = (
+        "✅ *Generated Gmail Task*\n\n"
+        "Use the credentials below to create a Gmail account:\n\n"
+        f"📧 `{email}`\n"
+        f"🔐 `{password}`\n\n"
+        f"Reward: {GEN_TASK_REWARD} PKR\n\n"
+        "Press *Done* when you finish to submit this task for review."
+    )
+
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton("✅ Done Task", callback_data=encode_callback(CB_DONE_TASK, uid, task_id)))
+    markup.add(types.InlineKeyboardButton("❌ Cancel Task", callback_data=encode_callback(CB_CANCEL_TASK, uid, task_id)))
+    answer_callback(call)
+    send_message(uid, text, reply_markup=markup, parse_mode="Markdown")
+
+
+def cb_task_own(call, caller):
+    uid = caller
+    ensure_user_db(uid)
+    users_state.set(uid, 'awaiting_own_gmail')
+    answer_callback(call)
+    send_message(uid, "Send:\nemail password", parse_mode="Markdown")
+
 
-def get_user_balance(message):
-    uid = message.text.strip()
-    data = load_user_data(uid)
-    if data:
-        bot.send_message(message.chat.id, f"User {uid} Balance: {data['amount']} PKR")
+def cb_task_fb(call, caller):
+    uid = caller
+    ensure_user_db(uid)
+    users_state.set(uid, 'awaiting_fb_details')
+    answer_callback(call)
+    send_message(uid, "Send: fb_id fb_email fb_password 2fa_code", parse_mode="Markdown")
+
+
+def cb_help(call, caller):
+    answer_callback(call)
+    send_message(caller, HELP_TEXT)
+
+
+# USER selects withdraw method (callback data: wd_<method>)
+def cb_withdraw_method(call, caller, method):
+    users_state.set(caller, f'awaiting_withdraw_{method}')
+    answer_callback(call)
+    if method == 'binance':
+        send_message(caller, "Enter amount in USD:")
     else:
-        bot.send_message(message.chat.id, "User not found.")
-@bot.message_handler(func=lambda m: m.text == "➕ Add Balance")
-def ask_add_balance_id(message):
-    if message.chat.id != ADMIN_CHAT_ID:
+        send_message(caller, "Enter amount in PKR:")
+
+
+# USER: Done task -> change draft -> pending_admin and notify admin
+def cb_done_task(call, caller, target, task_id):
+    with db_write() as cur:
+        t2 = database.submit_draft_task(cur, target, task_id)
+    if not t2:
+        answer_callback(call, "Task not found or already submitted.")
         return
-    bot.send_message(message.chat.id, "Enter User ID to add balance:")
-    bot.register_next_step_handler(message, admin_add_amount)
 
-def admin_add_amount(message):
-    uid = message.text.strip()
-    bot.send_message(
-        message.chat.id, 
-        f"Enter amount to add to {uid}:"
+    answer_callback(call)
+    send_message(target, "⏳ Task submitted. Admin reviewing. You can do other tasks while this is pending.")
+
+    details = (
+        "📥 *New Task Submitted*\n"
+        f"👤 User: `{target}`\n"
+        f"💰 Reward: `{t2['reward']}` PKR\n"
+        f"📌 Type: *{t2['type']}*\n"
+        f"🔢 TaskID: `{t2['task_id']}`\n\n"
+    )
+    if t2['type'] in ('generated', 'own'):
+        details += f"Email: `{t2['email']}`\nPassword: `{t2['password']}`\n"
+    elif t2['type'] == 'facebook':
+        details += (
+            f"FB ID: `{t2['fb_id']}`\n"
+            f"Email: `{t2['email']}`\n"
+            f"Password: `{t2['password']}`\n"
+            f"2FA: `{t2['twofa']}`\n"
+        )
+
+    admin_markup = types.InlineKeyboardMarkup()
+    admin_markup.add(
+        types.InlineKeyboardButton("Approve", callback_data=encode_callback(CB_APPROVE_TASK, t2['id'])),
+        types.InlineKeyboardButton("Reject", callback_data=encode_callback(CB_REJECT_TASK, t2['id']))
     )
-    bot.register_next_step_handler(message, lambda m: add_amount(uid, m))
+    admin_notify(details, admin_markup)
+
+
+# USER: Cancel draft task
+def cb_cancel_task(call, caller, target, task_id):
+    with db_write() as cur:
+        database.delete_draft_task(cur, target, task_id)
+    answer_callback(call, "Canceled.")
+    send_message(target, "Task canceled.", reply_markup=main_menu())
+
+
+# ADMIN: page through /pending (edits the page message in place)
+def cb_pending_next(call, caller, kind, last_id):
+    show_pending_page(call, kind, after_id=last_id)
+
+
+def cb_pending_prev(call, caller, kind, first_id):
+    show_pending_page(call, kind, before_id=first_id)
+
+
+def show_pending_page(call, kind, after_id=0, before_id=None):
+    if kind not in PENDING_QUEUES or not call.message:
+        answer_callback(call, "Invalid data.")
+        return
+    text, markup = pending_page(kind, after_id, before_id)
+    answer_callback(call)
+    chat_id = call.message.chat.id
+    OUTBOUND.submit(chat_id, bot.edit_message_text, text, chat_id, call.message.message_id, reply_markup=markup)
+
+
+# ADMIN: Approve task
+def cb_approve_task(call, caller, db_task_id):
+    owner = task_owner(db_task_id)
+    error = missing_row_error("tasks", db_task_id) if owner is None else None
+    refid = None
+    if owner is not None:
+        with user_lock(owner), db_write() as cur:
+            t = database.get_task(cur, db_task_id)
+            if not t:
+                error = "Task not found."
+            elif t['status'] == 'approved':
+                error = "Already approved."
+            else:
+                ledger.post(cur, t['user_id'], t['reward'], 0, ledger.TASK_REWARD, db_task_id)
+                database.add_tasks_completed(cur, t['user_id'])
+                database.set_task_status(cur, db_task_id, 'approved')
+                r = database.get_user(cur, t['user_id'])
+                refid = r['referrer'] if r else None
+                if refid:
+                    ledger.post(cur, refid, REFERRAL_BONUS_PER_TASK, 0, ledger.REFERRAL_BONUS, db_task_id)
+                    database.add_referral_earned(cur, refid, REFERRAL_BONUS_PER_TASK)
+        USER_CACHE.invalidate(owner, refid)
+    if error:
+        answer_callback(call, error)
+        return
+
+    answer_callback(call)
+    send_message(t['user_id'], f"✅ Task approved! +{t['reward']} PKR")
+    admin_notify(f"Approved task {t['task_id']} for {t['user_id']}", parse_mode=None)
+
+
+# ADMIN: Reject task
+def cb_reject_task(call, caller, db_task_id):
+    owner = task_owner(db_task_id)
+    error = missing_row_error("tasks", db_task_id) if owner is None else None
+    if owner is not None:
+        with user_lock(owner), db_write() as cur:
+            t = database.get_task(cur, db_task_id)
+            if not t:
+                error = "Task not found."
+            elif t['status'] == 'rejected':
+                error = "Already rejected."
+            else:
+                database.set_task_status(cur, db_task_id, 'rejected')
+    if error:
+        answer_callback(call, error)
+        return
+
+    answer_callback(call)
+    send_message(t['user_id'], f"❌ Task rejected.")
+    admin_notify(f"Rejected task {t['task_id']} for {t['user_id']}", parse_mode=None)
+
+
+# ADMIN: Approve withdraw
+def cb_approve_wd(call, caller, wd_id):
+    owner = withdraw_owner(wd_id)
+    error = missing_row_error("withdraws", wd_id) if owner is None else None
+    if owner is not None:
+        with user_lock(owner), db_write() as cur:
+            w = database.get_withdraw(cur, wd_id)
+            if not w:
+                error = "Withdraw not found."
+            elif w['status'] == 'approved':
+                error = "Already approved."
+            else:
+                database.set_withdraw_status(cur, wd_id, 'approved')
+                p = w['pkr_amount'] if w['pkr_amount'] else 0
+                ledger.post(cur, w['user_id'], 0, -p, ledger.WITHDRAW_PAID, wd_id)
+        USER_CACHE.invalidate(owner)
+    if error:
+        answer_callback(call, error)
+        return
+    answer_callback(call)
+    send_message(w['user_id'], f"✅ Withdraw approved: {w['pkr_amount']} PKR")
+    admin_notify(f"Approved withdraw {wd_id} for {w['user_id']}", parse_mode=None)
+
+
+# ADMIN: Reject withdraw
+def cb_reject_wd(call, caller, wd_id):
+    owner = withdraw_owner(wd_id)
+    error = missing_row_error("withdraws", wd_id) if owner is None else None
+    if owner is not None:
+        with user_lock(owner), db_write() as cur:
+            w = database.get_withdraw(cur, wd_id)
+            if not w:
+                error = "Withdraw not found."
+            elif w['status'] == 'rejected':
+                error = "Already rejected."
+            else:
+                p = w['pkr_amount'] if w['pkr_amount'] else 0
+                ledger.post(cur, w['user_id'], p, -p, ledger.WITHDRAW_REFUND, wd_id)
+                database.set_withdraw_status(cur, wd_id, 'rejected')
+        USER_CACHE.invalidate(owner)
+    if error:
+        answer_callback(call, error)
+        return
+    answer_callback(call)
+    send_message(w['user_id'], f"❌ Withdraw rejected. {p} PKR refunded.")
+    admin_notify(f"Rejected withdraw {wd_id} for {w['user_id']}", parse_mode=None)
+
+
+CB_DONE_TASK = "dt"
+CB_CANCEL_TASK = "ct"
+CB_APPROVE_TASK = "at"
+CB_REJECT_TASK = "rt"
+CB_APPROVE_WD = "aw"
+CB_REJECT_WD = "rw"
+CB_PENDING_NEXT = "pn"
+CB_PENDING_PREV = "pp"
+
+CALLBACK_ROUTES = CallbackRouter()
+CALLBACK_ROUTES.exact("task_gen", cb_task_gen, "user")
+CALLBACK_ROUTES.exact("task_own", cb_task_own, "user")
+CALLBACK_ROUTES.exact("task_fb", cb_task_fb, "user")
+CALLBACK_ROUTES.exact("help", cb_help)
+for _method in WITHDRAW_METHODS:
+    CALLBACK_ROUTES.exact(f"wd_{_method}", cb_withdraw_method, "user", _method)
+CALLBACK_ROUTES.action(CB_DONE_TASK, cb_done_task, 2, legacy_prefix="done_task")
+CALLBACK_ROUTES.action(CB_CANCEL_TASK, cb_cancel_task, 2, legacy_prefix="cancel_task")
+CALLBACK_ROUTES.action(CB_APPROVE_TASK, cb_approve_task, 1, "admin", legacy_prefix="approve_task")
+CALLBACK_ROUTES.action(CB_REJECT_TASK, cb_reject_task, 1, "admin", legacy_prefix="reject_task")
+CALLBACK_ROUTES.action(CB_APPROVE_WD, cb_approve_wd, 1, "admin", legacy_prefix="approve_wd")
+CALLBACK_ROUTES.action(CB_REJECT_WD, cb_reject_wd, 1, "admin", legacy_prefix="reject_wd")
+CALLBACK_ROUTES.action(CB_PENDING_NEXT, cb_pending_next, 2, "admin")
+CALLBACK_ROUTES.action(CB_PENDING_PREV, cb_pending_prev, 2, "admin")
+
+
+def caller_allowed(who, caller):
+    if who == "admin":
+        return caller == ADMIN_CHAT_ID
+    if who == "user":
+        return caller is not None and caller != ADMIN_CHAT_ID
+    return True
+
+
+@bot.callback_query_handler(func=lambda call: True)
+def callback_query(call):
+    data = call.data or ""
+    caller = call.from_user.id if call.from_user else (call.message.chat.id if call.message else None)
 
-def add_amount(uid, message):
     try:
-        amount = int(message.text)
-        data = load_user_data(uid)
-        if not data:
-            bot.send_message(message.chat.id, "User not found.")
+        route = CALLBACK_ROUTES.resolve(data)
+    except ValueError:
+        answer_callback(call, "Invalid data.")
+        return
+
+    if route:
+        handler, who, args = route
+        if caller_allowed(who, caller):
+            with ROUTE_SECONDS.time(handler.__name__):
+                handler(call, caller, *args)
             return
-        data["amount"] += amount
-        save_user_data(uid, data)
-        bot.send_message(message.chat.id, f"Added {amount} PKR to {uid}.")
-    except:
-        bot.send_message(message.chat.id, "Invalid amount.")
+
+    # default: just acknowledge
+    answer_callback(call)
+
+# ============================================================
+# HANDLER METRICS
+# ============================================================
+# Runs after every handler is registered so each gets its own series.
+
+def _timed_handler(fn):
+    def wrapper(*args, **kwargs):
+        with HANDLER_SECONDS.time(fn.__name__):
+            return fn(*args, **kwargs)
+    wrapper.__name__ = fn.__name__
+    return wrapper
+
+
+for _h in bot.message_handlers + bot.callback_query_handlers:
+    _h['function'] = _timed_handler(_h['function'])
+
+metrics.Gauge("bot_users_state_entries", "Conversation states held in users_state", lambda: users_state.size())
+metrics.Gauge("bot_user_cache_entries", "Rows in the per-process user cache", lambda: USER_CACHE.stats()['size'])
+metrics.Gauge("bot_update_queue_depth", "Updates waiting for a worker", lambda: UPDATE_DISPATCHER.depth())
+metrics.Gauge("bot_outbound_pending", "Outbound Telegram calls queued or in flight", lambda: OUTBOUND.pending())
+metrics.Gauge("bot_scheduler_leader", "1 if this process runs the scheduled jobs", lambda: int(SCHEDULER.leader))
+
+# ============================================================
+# STARTUP TIME
+# ============================================================
+# Import of this module = worker start. With gunicorn --preload it runs once
+# in the master and workers inherit the result through fork (the DB pool is
+# emptied before forking, and threads start lazily per process).
+
+STARTUP_SECONDS = time.perf_counter() - _IMPORT_STARTED
+metrics.Gauge("bot_startup_seconds", "Time to import main (imports, schema check, handler setup)", lambda: STARTUP_SECONDS)
+metrics.Gauge("bot_startup_import_seconds", "Part of startup spent importing dependencies", lambda: IMPORT_SECONDS)
+metrics.Gauge("bot_startup_schema_seconds", "Part of startup spent checking/migrating the schema", lambda: SCHEMA_SECONDS)
+print(
+    f"Started in {STARTUP_SECONDS * 1000:.0f} ms (pid {os.getpid()}): imports {IMPORT_SECONDS * 1000:.0f} ms, "
+    f"schema {SCHEMA_SECONDS * 1000:.1f} ms "
+    + (f"({len(SCHEMA_MIGRATIONS_APPLIED)} migrations applied)" if SCHEMA_MIGRATIONS_APPLIED else "(current, no DDL)")
+)
 
 # ============================================================
 # RUN FLASK SERVER
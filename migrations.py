@@ -0,0 +1,509 @@
+# ============================================================
+# SCHEMA MIGRATIONS
+# ============================================================
+# The schema version lives in SQLite's PRAGMA user_version. Each entry in
+# MIGRATIONS runs once, in order, inside its own BEGIN IMMEDIATE
+# transaction, so concurrent workers starting together apply it only once.
+# Never edit a shipped migration; append a new one instead.
+
+# Full recount of the stats counters (migration 5 backfill, admin
+# "/stats rebuild"); must run inside a write transaction.
+STATS_RECOUNT = [
+    "DELETE FROM stats",
+    "INSERT INTO stats (key, value) SELECT 'users', COUNT(*) FROM users",
+    "INSERT INTO stats (key, value) SELECT 'referrals', COUNT(referrer) FROM users",
+    "INSERT INTO stats (key, value) SELECT 'balance_total', COALESCE(SUM(balance), 0) FROM users",
+    "INSERT INTO stats (key, value) SELECT 'hold_total', COALESCE(SUM(hold), 0) FROM users",
+    "INSERT INTO stats (key, value) SELECT 'tasks_' || status, COUNT(*) FROM tasks GROUP BY status",
+    "INSERT INTO stats (key, value) SELECT 'withdraws_' || status, COUNT(*) FROM withdraws GROUP BY status",
+    "INSERT INTO stats (key, value) SELECT 'withdraws_' || status || '_pkr', COALESCE(SUM(pkr_amount), 0) FROM withdraws GROUP BY status",
+]
+
+# Stats triggers on tasks / withdraws as of migration 5 (re-created by the
+# table rebuild in 6; migration 7 replaces the two delete triggers).
+STATS_TASK_TRIGGERS = [
+    '''
+    CREATE TRIGGER IF NOT EXISTS stats_tasks_insert AFTER INSERT ON tasks BEGIN
+        INSERT INTO stats (key, value) VALUES ('tasks_' || NEW.status, 1)
+        ON CONFLICT(key) DO UPDATE SET value = value + 1;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS stats_tasks_status AFTER UPDATE OF status ON tasks
+    WHEN NEW.status != OLD.status BEGIN
+        UPDATE stats SET value = value - 1 WHERE key = 'tasks_' || OLD.status;
+        INSERT INTO stats (key, value) VALUES ('tasks_' || NEW.status, 1)
+        ON CONFLICT(key) DO UPDATE SET value = value + 1;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS stats_tasks_delete AFTER DELETE ON tasks BEGIN
+        UPDATE stats SET value = value - 1 WHERE key = 'tasks_' || OLD.status;
+    END
+    ''',
+]
+
+STATS_WITHDRAW_TRIGGERS = [
+    '''
+    CREATE TRIGGER IF NOT EXISTS stats_withdraws_insert AFTER INSERT ON withdraws BEGIN
+        INSERT INTO stats (key, value)
+        VALUES ('withdraws_' || NEW.status, 1), ('withdraws_' || NEW.status || '_pkr', COALESCE(NEW.pkr_amount, 0))
+        ON CONFLICT(key) DO UPDATE SET value = value + excluded.value;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS stats_withdraws_status AFTER UPDATE OF status ON withdraws
+    WHEN NEW.status != OLD.status BEGIN
+        UPDATE stats SET value = value - CASE key WHEN 'withdraws_' || OLD.status THEN 1 ELSE COALESCE(OLD.pkr_amount, 0) END
+        WHERE key IN ('withdraws_' || OLD.status, 'withdraws_' || OLD.status || '_pkr');
+        INSERT INTO stats (key, value)
+        VALUES ('withdraws_' || NEW.status, 1), ('withdraws_' || NEW.status || '_pkr', COALESCE(NEW.pkr_amount, 0))
+        ON CONFLICT(key) DO UPDATE SET value = value + excluded.value;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS stats_withdraws_delete AFTER DELETE ON withdraws BEGIN
+        UPDATE stats SET value = value - CASE key WHEN 'withdraws_' || OLD.status THEN 1 ELSE COALESCE(OLD.pkr_amount, 0) END
+        WHERE key IN ('withdraws_' || OLD.status, 'withdraws_' || OLD.status || '_pkr');
+    END
+    ''',
+]
+
+# Per-day rollups (migration 6). Days are UTC days since the epoch; rows are
+# (day, metric, dim) with dim the task type or withdraw method.
+_TODAY = "CAST(strftime('%s', 'now') AS INTEGER) / 86400"
+
+ROLLUP_TASK_TRIGGERS = [
+    f'''
+    CREATE TRIGGER IF NOT EXISTS rollup_tasks_status AFTER UPDATE OF status ON tasks
+    WHEN NEW.status != OLD.status AND NEW.status IN ('pending_admin', 'approved', 'rejected') BEGIN
+        INSERT INTO daily_rollup (day, metric, dim, value)
+        VALUES ({_TODAY}, CASE NEW.status WHEN 'pending_admin' THEN 'tasks_submitted' ELSE 'tasks_' || NEW.status END, NEW.type, 1)
+        ON CONFLICT(day, metric, dim) DO UPDATE SET value = value + 1;
+        INSERT INTO daily_rollup (day, metric, dim, value)
+        SELECT {_TODAY}, 'rewards_paid', NEW.type, NEW.reward WHERE NEW.status = 'approved'
+        ON CONFLICT(day, metric, dim) DO UPDATE SET value = value + excluded.value;
+    END
+    ''',
+]
+
+ROLLUP_WITHDRAW_TRIGGERS = [
+    '''
+    CREATE TRIGGER IF NOT EXISTS rollup_withdraws_insert AFTER INSERT ON withdraws BEGIN
+        INSERT INTO daily_rollup (day, metric, dim, value)
+        VALUES (NEW.created_at / 86400, 'withdraws_requested', NEW.method, 1),
+               (NEW.created_at / 86400, 'withdraws_requested_pkr', NEW.method, COALESCE(NEW.pkr_amount, 0))
+        ON CONFLICT(day, metric, dim) DO UPDATE SET value = value + excluded.value;
+    END
+    ''',
+    f'''
+    CREATE TRIGGER IF NOT EXISTS rollup_withdraws_status AFTER UPDATE OF status ON withdraws
+    WHEN NEW.status != OLD.status AND NEW.status IN ('approved', 'rejected') BEGIN
+        INSERT INTO daily_rollup (day, metric, dim, value)
+        VALUES ({_TODAY}, 'withdraws_' || NEW.status, NEW.method, 1),
+               ({_TODAY}, 'withdraws_' || NEW.status || '_pkr', NEW.method, COALESCE(NEW.pkr_amount, 0))
+        ON CONFLICT(day, metric, dim) DO UPDATE SET value = value + excluded.value;
+    END
+    ''',
+]
+
+# Rebuild of daily_rollup from the tables (migration 6 backfill); request
+# days come from created_at, approval/rejection days from the ledger entry
+# that settled the row, else created_at. Run on an empty daily_rollup.
+ROLLUP_RECOUNT = [
+    "INSERT INTO daily_rollup SELECT created_at / 86400, 'tasks_submitted', type, COUNT(*) FROM tasks WHERE status != 'draft' GROUP BY 1, 3",
+    "INSERT INTO daily_rollup SELECT created_at / 86400, 'tasks_rejected', type, COUNT(*) FROM tasks WHERE status = 'rejected' GROUP BY 1, 3",
+    '''
+    INSERT INTO daily_rollup
+    SELECT COALESCE(l.at, t.created_at) / 86400 AS day, m.metric, t.type,
+           SUM(CASE m.metric WHEN 'tasks_approved' THEN 1 ELSE t.reward END)
+    FROM tasks t
+    LEFT JOIN (SELECT ref_id, MIN(created_at) AS at FROM ledger WHERE reason = 'task_reward' GROUP BY ref_id) l ON l.ref_id = t.id
+    CROSS JOIN (SELECT 'tasks_approved' AS metric UNION ALL SELECT 'rewards_paid') m
+    WHERE t.status = 'approved'
+    GROUP BY day, m.metric, t.type
+    ''',
+    '''
+    INSERT INTO daily_rollup
+    SELECT created_at / 86400 AS day, m.metric, method,
+           SUM(CASE m.metric WHEN 'withdraws_requested' THEN 1 ELSE COALESCE(pkr_amount, 0) END)
+    FROM withdraws
+    CROSS JOIN (SELECT 'withdraws_requested' AS metric UNION ALL SELECT 'withdraws_requested_pkr') m
+    GROUP BY day, m.metric, method
+    ''',
+    '''
+    INSERT INTO daily_rollup
+    SELECT COALESCE(l.at, w.created_at) / 86400 AS day, 'withdraws_' || w.status || m.suffix AS metric, w.method,
+           SUM(CASE m.suffix WHEN '' THEN 1 ELSE COALESCE(w.pkr_amount, 0) END)
+    FROM withdraws w
+    LEFT JOIN (SELECT ref_id, MIN(created_at) AS at FROM ledger
+               WHERE reason IN ('withdraw_paid', 'withdraw_refund') GROUP BY ref_id) l ON l.ref_id = w.id
+    CROSS JOIN (SELECT '' AS suffix UNION ALL SELECT '_pkr') m
+    WHERE w.status IN ('approved', 'rejected')
+    GROUP BY day, metric, w.method
+    ''',
+]
+
+# ISO-8601 text from datetime.isoformat() / datetime('now') -> epoch seconds
+_EPOCH = "COALESCE(CAST(strftime('%s', created_at) AS INTEGER), 0)"
+
+MIGRATIONS = [
+    (1, "initial schema", [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY,
+            balance INTEGER NOT NULL DEFAULT 0,
+            hold INTEGER NOT NULL DEFAULT 0,
+            tasks_completed INTEGER NOT NULL DEFAULT 0,
+            referrer INTEGER,
+            referrals_count INTEGER NOT NULL DEFAULT 0,
+            referral_earned INTEGER NOT NULL DEFAULT 0,
+            next_task_id INTEGER NOT NULL DEFAULT 1
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS tasks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            task_id INTEGER NOT NULL,
+            type TEXT NOT NULL,
+            email TEXT,
+            password TEXT,
+            fb_id TEXT,
+            twofa TEXT,
+            reward INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS withdraws (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            method TEXT NOT NULL,
+            account_name TEXT,
+            account_number TEXT,
+            pkr_amount INTEGER,
+            usd_amount REAL,
+            status TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+        ''',
+    ]),
+    (2, "indexes for hot lookups", [
+        # done_task / cancel_task: WHERE user_id = ? AND task_id = ? AND status = 'draft'
+        "CREATE INDEX IF NOT EXISTS idx_tasks_user_task_status ON tasks(user_id, task_id, status)",
+        # /pending: WHERE status = ? ORDER BY id
+        "CREATE INDEX IF NOT EXISTS idx_tasks_status_id ON tasks(status, id)",
+        "CREATE INDEX IF NOT EXISTS idx_withdraws_status_id ON withdraws(status, id)",
+        # referral lookups
+        "CREATE INDEX IF NOT EXISTS idx_users_referrer ON users(referrer)",
+        "ANALYZE",
+    ]),
+    (3, "shared conversation state", [
+        '''
+        CREATE TABLE IF NOT EXISTS user_state (
+            user_id INTEGER PRIMARY KEY,
+            state TEXT NOT NULL,
+            temp TEXT,
+            expires_at INTEGER NOT NULL
+        ) WITHOUT ROWID
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_user_state_expires ON user_state(expires_at)",
+    ]),
+    (4, "balance ledger", [
+        '''
+        CREATE TABLE IF NOT EXISTS ledger (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            delta_balance INTEGER NOT NULL DEFAULT 0,
+            delta_hold INTEGER NOT NULL DEFAULT 0,
+            reason TEXT NOT NULL,
+            ref_id INTEGER,
+            created_at INTEGER NOT NULL
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_ledger_user_id ON ledger(user_id, id)",
+        '''
+        CREATE TABLE IF NOT EXISTS ledger_snapshot (
+            user_id INTEGER PRIMARY KEY,
+            balance INTEGER NOT NULL,
+            hold INTEGER NOT NULL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS ledger_checkpoints (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            last_entry_id INTEGER NOT NULL,
+            entries INTEGER NOT NULL,
+            created_at INTEGER NOT NULL
+        )
+        ''',
+        # existing balances become opening entries so the ledger reconciles
+        '''
+        INSERT INTO ledger (user_id, delta_balance, delta_hold, reason, ref_id, created_at)
+        SELECT id, balance, hold, 'opening', NULL, CAST(strftime('%s', 'now') AS INTEGER)
+        FROM users WHERE balance != 0 OR hold != 0
+        ''',
+    ]),
+    (5, "admin statistics counters", [
+        "CREATE TABLE IF NOT EXISTS stats (key TEXT PRIMARY KEY, value INTEGER NOT NULL) WITHOUT ROWID",
+        # users / referrals / balance_total / hold_total always exist, so
+        # the users triggers can UPDATE; per-status keys are upserted
+        '''
+        CREATE TRIGGER IF NOT EXISTS stats_users_insert AFTER INSERT ON users BEGIN
+            UPDATE stats SET value = value + CASE key
+                WHEN 'users' THEN 1
+                WHEN 'referrals' THEN NEW.referrer IS NOT NULL
+                WHEN 'balance_total' THEN NEW.balance
+                ELSE NEW.hold END
+            WHERE key IN ('users', 'referrals', 'balance_total', 'hold_total');
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS stats_users_delete AFTER DELETE ON users BEGIN
+            UPDATE stats SET value = value - CASE key
+                WHEN 'users' THEN 1
+                WHEN 'referrals' THEN OLD.referrer IS NOT NULL
+                WHEN 'balance_total' THEN OLD.balance
+                ELSE OLD.hold END
+            WHERE key IN ('users', 'referrals', 'balance_total', 'hold_total');
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS stats_users_money AFTER UPDATE OF balance, hold ON users
+        WHEN NEW.balance != OLD.balance OR NEW.hold != OLD.hold BEGIN
+            UPDATE stats SET value = value + CASE key
+                WHEN 'balance_total' THEN NEW.balance - OLD.balance
+                ELSE NEW.hold - OLD.hold END
+            WHERE key IN ('balance_total', 'hold_total');
+        END
+        ''',
+    ] + STATS_TASK_TRIGGERS + STATS_WITHDRAW_TRIGGERS + STATS_RECOUNT),
+    (6, "integer created_at and daily rollups", [
+        # tasks / withdraws are rebuilt with created_at INTEGER (SQLite cannot
+        # change a column type in place). sqlite_sequence is carried over so
+        # AUTOINCREMENT never hands out an id of a deleted row again.
+        '''
+        CREATE TABLE tasks_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            task_id INTEGER NOT NULL,
+            type TEXT NOT NULL,
+            email TEXT,
+            password TEXT,
+            fb_id TEXT,
+            twofa TEXT,
+            reward INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            created_at INTEGER NOT NULL,
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+        ''',
+        "INSERT INTO sqlite_sequence (name, seq) SELECT 'tasks_new', seq FROM sqlite_sequence WHERE name = 'tasks'",
+        f"INSERT INTO tasks_new SELECT id, user_id, task_id, type, email, password, fb_id, twofa, reward, status, {_EPOCH} FROM tasks",
+        "DROP TABLE tasks",
+        "ALTER TABLE tasks_new RENAME TO tasks",
+        "CREATE INDEX idx_tasks_user_task_status ON tasks(user_id, task_id, status)",
+        "CREATE INDEX idx_tasks_status_id ON tasks(status, id)",
+        "CREATE INDEX idx_tasks_created_at ON tasks(created_at)",
+        '''
+        CREATE TABLE withdraws_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            method TEXT NOT NULL,
+            account_name TEXT,
+            account_number TEXT,
+            pkr_amount INTEGER,
+            usd_amount REAL,
+            status TEXT NOT NULL,
+            created_at INTEGER NOT NULL,
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+        ''',
+        "INSERT INTO sqlite_sequence (name, seq) SELECT 'withdraws_new', seq FROM sqlite_sequence WHERE name = 'withdraws'",
+        f"INSERT INTO withdraws_new SELECT id, user_id, method, account_name, account_number, pkr_amount, usd_amount, status, {_EPOCH} FROM withdraws",
+        "DROP TABLE withdraws",
+        "ALTER TABLE withdraws_new RENAME TO withdraws",
+        "CREATE INDEX idx_withdraws_status_id ON withdraws(status, id)",
+        "CREATE INDEX idx_withdraws_created_at ON withdraws(created_at)",
+        '''
+        CREATE TABLE IF NOT EXISTS daily_rollup (
+            day INTEGER NOT NULL,
+            metric TEXT NOT NULL,
+            dim TEXT NOT NULL,
+            value INTEGER NOT NULL,
+            PRIMARY KEY (day, metric, dim)
+        ) WITHOUT ROWID
+        ''',
+    ] + ROLLUP_RECOUNT + STATS_TASK_TRIGGERS + STATS_WITHDRAW_TRIGGERS + ROLLUP_TASK_TRIGGERS + ROLLUP_WITHDRAW_TRIGGERS + [
+        "ANALYZE tasks",
+        "ANALYZE withdraws",
+    ]),
+    (7, "keep archived rows in the stats counters", [
+        # finished (approved / rejected) rows only leave the hot tables when
+        # they are archived, and stay counted; drafts and pending rows that
+        # are deleted are uncounted as before
+        "DROP TRIGGER IF EXISTS stats_tasks_delete",
+        "DROP TRIGGER IF EXISTS stats_withdraws_delete",
+        '''
+        CREATE TRIGGER stats_tasks_delete AFTER DELETE ON tasks
+        WHEN OLD.status NOT IN ('approved', 'rejected') BEGIN
+            UPDATE stats SET value = value - 1 WHERE key = 'tasks_' || OLD.status;
+        END
+        ''',
+        '''
+        CREATE TRIGGER stats_withdraws_delete AFTER DELETE ON withdraws
+        WHEN OLD.status NOT IN ('approved', 'rejected') BEGIN
+            UPDATE stats SET value = value - CASE key WHEN 'withdraws_' || OLD.status THEN 1 ELSE COALESCE(OLD.pkr_amount, 0) END
+            WHERE key IN ('withdraws_' || OLD.status, 'withdraws_' || OLD.status || '_pkr');
+        END
+        ''',
+    ]),
+    (8, "scheduler lease and job runs", [
+        # one row: the worker process currently running scheduled jobs
+        '''
+        CREATE TABLE IF NOT EXISTS scheduler_lease (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            owner TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS scheduler_jobs (
+            name TEXT PRIMARY KEY,
+            last_started INTEGER NOT NULL,
+            last_seconds REAL NOT NULL,
+            last_rows INTEGER NOT NULL,
+            last_error TEXT,
+            runs INTEGER NOT NULL DEFAULT 0,
+            owner TEXT
+        ) WITHOUT ROWID
+        ''',
+        # stale draft cleanup: drafts by age
+        "CREATE INDEX IF NOT EXISTS idx_tasks_status_created ON tasks(status, created_at)",
+    ]),
+    (9, "broadcasts", [
+        # last_user_id is the checkpoint: every user up to it was handled
+        '''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'draft',
+            total INTEGER NOT NULL DEFAULT 0,
+            last_user_id INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            owner TEXT,
+            heartbeat_at REAL,
+            created_at INTEGER NOT NULL,
+            started_at INTEGER,
+            finished_at INTEGER
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS broadcast_failures (
+            broadcast_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            blocked INTEGER NOT NULL,
+            error TEXT,
+            PRIMARY KEY (broadcast_id, user_id)
+        ) WITHOUT ROWID
+        ''',
+    ]),
+    (10, "recent update_id window", [
+        # bitmap: one row per 32 consecutive update_ids (database.mark_update)
+        "CREATE TABLE IF NOT EXISTS update_window (block INTEGER PRIMARY KEY, bits INTEGER NOT NULL)",
+    ]),
+    (11, "restore generation", [
+        # bumped by /restore; workers drop their caches when it changes
+        "CREATE TABLE IF NOT EXISTS restore_generation (id INTEGER PRIMARY KEY CHECK (id = 1), value INTEGER NOT NULL)",
+        "INSERT OR IGNORE INTO restore_generation (id, value) VALUES (1, 0)",
+    ]),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+# The cold archive (ATTACHed as "archive" by database.py) has its own
+# user_version and migrations. Rows keep their hot-table ids.
+ARCHIVE_MIGRATIONS = [
+    (1, "archive tables", [
+        '''
+        CREATE TABLE IF NOT EXISTS archive.tasks (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            task_id INTEGER NOT NULL,
+            type TEXT NOT NULL,
+            email TEXT,
+            password TEXT,
+            fb_id TEXT,
+            twofa TEXT,
+            reward INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            created_at INTEGER NOT NULL,
+            archived_at INTEGER NOT NULL
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS archive.idx_archive_tasks_user ON tasks(user_id)",
+        '''
+        CREATE TABLE IF NOT EXISTS archive.withdraws (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            method TEXT NOT NULL,
+            account_name TEXT,
+            account_number TEXT,
+            pkr_amount INTEGER,
+            usd_amount REAL,
+            status TEXT NOT NULL,
+            created_at INTEGER NOT NULL,
+            archived_at INTEGER NOT NULL
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS archive.idx_archive_withdraws_user ON withdraws(user_id)",
+    ]),
+]
+
+
+def schema_version(conn, schema="main"):
+    return conn.execute(f"PRAGMA {schema}.user_version").fetchone()[0]
+
+
+def migrate(conn, migrations=MIGRATIONS, schema="main"):
+    """Bring `schema` up to its last migration; returns the versions applied."""
+    current = schema_version(conn, schema)
+    if current >= migrations[-1][0]:
+        # the usual worker start: one PRAGMA read, no DDL, no write lock
+        return []
+    applied = []
+    for version, name, statements in migrations:
+        if current >= version:
+            continue
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # another process may have applied it while we waited for the lock
+            current = schema_version(conn, schema)
+            if current >= version:
+                conn.rollback()
+                continue
+            for sql in statements:
+                conn.execute(sql)
+            conn.execute(f"PRAGMA {schema}.user_version = {version}")
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        current = version
+        applied.append((version, name))
+    return applied
+
+
+def explain_query_plan(conn, sql, params=()):
+    """Return the EXPLAIN QUERY PLAN detail lines for `sql`.
+
+    Lets tests assert a hot query uses an index, e.g.
+    assert any("idx_tasks_status_id" in d for d in explain_query_plan(...))
+    """
+    return [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
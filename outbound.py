@@ -0,0 +1,216 @@
+import heapq
+import itertools
+import os
+import threading
+import time
+from collections import deque
+
+from telebot.apihelper import ApiTelegramException
+
+# Priority lanes: lower value is sent first
+PRIORITY_CALLBACK = 0
+PRIORITY_USER = 1
+PRIORITY_ADMIN = 2
+PRIORITY_BROADCAST = 3
+
+
+class TokenBucket:
+    """Reservation-style token bucket.
+
+    reserve() always succeeds and returns how long the caller must wait
+    for its token, so callers that reserve in order are served in order.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def pause(self, seconds):
+        # after a 429, nothing goes out through this bucket for `seconds`
+        with self.lock:
+            self.tokens = min(self.tokens, 0.0) - seconds * self.rate
+            self.updated = time.monotonic()
+
+
+class OutboundDispatcher:
+    """Rate-limited, prioritised queue for outgoing Telegram API calls.
+
+    Handlers submit() a call and return immediately; sender threads pick
+    the highest-priority job, respect a global bucket plus one bucket per
+    chat, and retry 429 responses after the advertised retry_after.
+    `observer(fn, seconds, outcome)`, if given, is called after every API
+    call with outcome "ok", "retry" (429) or "error". A job's own
+    `on_done(error)` runs once it is finished, with the final exception or
+    None.
+
+    Calls for the same chat go out in submit order: each chat has at most
+    one job in the heaps at a time, later ones wait in that chat's FIFO
+    until it is finished (including its 429 retries).
+    """
+
+    def __init__(self, senders=4, global_rate=30, chat_rate=1, chat_burst=3, max_retries=3, max_chat_buckets=10000, observer=None):
+        self.senders = max(1, senders)
+        self.max_chat_buckets = max_chat_buckets
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.observer = observer
+        self._chat_buckets = {}
+        self._ready = []    # (priority, seq, job)
+        self._delayed = []  # (not_before, seq, priority, job)
+        self._chat_waiting = {}  # chat_id -> deque of (priority, job) behind the one in flight
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._unfinished = 0
+        self._pid = None
+
+    def _ensure_started(self):
+        # threads do not survive fork(), so (re)start lazily in each process
+        if self._pid == os.getpid():
+            return
+        with self._cond:
+            if self._pid == os.getpid():
+                return
+            for i in range(self.senders):
+                threading.Thread(target=self._run, name=f"outbound-{i}", daemon=True).start()
+            self._pid = os.getpid()
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= self.max_chat_buckets:
+                self._prune_chat_buckets()
+            bucket = self._chat_buckets.setdefault(chat_id, TokenBucket(self.chat_rate, self.chat_burst))
+        return bucket
+
+    def _prune_chat_buckets(self):
+        # a bucket idle long enough to have refilled is equivalent to a new one
+        idle = self.chat_burst / self.chat_rate
+        now = time.monotonic()
+        for chat_id, bucket in list(self._chat_buckets.items()):
+            if now - bucket.updated > idle:
+                self._chat_buckets.pop(chat_id, None)
+
+    def submit(self, chat_id, fn, *args, priority=PRIORITY_USER, on_done=None, **kwargs):
+        self._ensure_started()
+        job = {'chat_id': chat_id, 'fn': fn, 'args': args, 'kwargs': kwargs, 'attempt': 0, 'reserved': False, 'on_done': on_done}
+        with self._cond:
+            self._unfinished += 1
+            if chat_id is not None:
+                waiting = self._chat_waiting.get(chat_id)
+                if waiting is not None:
+                    waiting.append((priority, job))
+                    return
+                self._chat_waiting[chat_id] = deque()
+            heapq.heappush(self._ready, (priority, next(self._seq), job))
+            self._cond.notify()
+
+    def _push_delayed(self, job, priority, delay):
+        with self._cond:
+            heapq.heappush(self._delayed, (time.monotonic() + delay, next(self._seq), priority, job))
+            self._cond.notify()
+
+    def _next_job(self):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                while self._delayed and self._delayed[0][0] <= now:
+                    _, seq, priority, job = heapq.heappop(self._delayed)
+                    heapq.heappush(self._ready, (priority, seq, job))
+                if self._ready:
+                    priority, _, job = heapq.heappop(self._ready)
+                    return priority, job
+                timeout = self._delayed[0][0] - now if self._delayed else None
+                self._cond.wait(timeout)
+
+    def _done(self, job):
+        with self._cond:
+            chat_id = job['chat_id']
+            if chat_id is not None:
+                waiting = self._chat_waiting[chat_id]
+                if waiting:
+                    priority, nxt = waiting.popleft()
+                    heapq.heappush(self._ready, (priority, next(self._seq), nxt))
+                    # join() waits on the same condition; wake a sender too
+                    self._cond.notify_all()
+                else:
+                    del self._chat_waiting[chat_id]
+            self._unfinished -= 1
+            if self._unfinished == 0:
+                self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            priority, job = self._next_job()
+            chat_id = job['chat_id']
+            if chat_id is not None and not job['reserved']:
+                # park the job instead of holding a sender thread while a
+                # busy chat's bucket refills
+                job['reserved'] = True
+                wait = self._chat_bucket(chat_id).reserve()
+                if wait > 0:
+                    self._push_delayed(job, priority, wait)
+                    continue
+            wait = self.global_bucket.reserve()
+            if wait > 0:
+                time.sleep(wait)
+            started = time.perf_counter()
+            outcome = "ok"
+            error = None
+            try:
+                job['fn'](*job['args'], **job['kwargs'])
+            except ApiTelegramException as e:
+                outcome = "error"
+                error = e
+                if e.error_code == 429 and job['attempt'] < self.max_retries:
+                    self._observe(job, started, "retry")
+                    retry_after = (e.result_json or {}).get('parameters', {}).get('retry_after', 1)
+                    job['attempt'] += 1
+                    if chat_id is not None:
+                        self._chat_bucket(chat_id).pause(retry_after)
+                    else:
+                        self.global_bucket.pause(retry_after)
+                    self._push_delayed(job, priority, retry_after)
+                    continue
+                print("Telegram call failed:", e)
+            except Exception as e:
+                outcome = "error"
+                error = e
+                print("Telegram call failed:", e)
+            self._observe(job, started, outcome)
+            if job['on_done'] is not None:
+                try:
+                    job['on_done'](error)
+                except Exception as e:
+                    print("Outbound on_done failed:", e)
+            self._done(job)
+
+    def _observe(self, job, started, outcome):
+        if self.observer is not None:
+            try:
+                self.observer(job['fn'], time.perf_counter() - started, outcome)
+            except Exception as e:
+                print("Outbound observer failed:", e)
+
+    def pending(self):
+        with self._cond:
+            return self._unfinished
+
+    def join(self):
+        with self._cond:
+            while self._unfinished:
+                self._cond.wait()
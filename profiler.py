@@ -0,0 +1,158 @@
+import functools
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+# ============================================================
+# ON-DEMAND SAMPLING PROFILER
+# ============================================================
+# While enabled, a fraction (`sample_rate`) of updates is tracked: the
+# thread handling it is registered under a phase name ("webhook",
+# "update:message", "telegram", ...) and a sampler thread records that
+# thread's stack every `interval` seconds. Stacks are aggregated in memory
+# and can be dumped in the collapsed format used by flamegraph.pl and
+# speedscope ("phase;file:func;file:func <samples>").
+#
+# Disabled, callers only test `profiler.enabled` and no thread runs.
+# Like metrics, state is per process.
+
+
+class _Track:
+    __slots__ = ("profiler", "phase", "ident")
+
+    def __init__(self, profiler, phase):
+        self.profiler = profiler
+        self.phase = phase
+
+    def __enter__(self):
+        self.ident = threading.get_ident()
+        self.profiler._active[self.ident] = self.phase
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler._active.pop(self.ident, None)
+        self.profiler.tracked += 1
+
+
+class _NoTrack:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NO_TRACK = _NoTrack()
+
+
+class SamplingProfiler:
+    def __init__(self, interval=0.001, max_depth=64, max_stacks=50000):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.max_stacks = max_stacks
+        self.enabled = False
+        self.sample_rate = 0.0
+        self.samples = 0
+        self.tracked = 0
+        self.started_at = None
+        self._active = {}  # thread ident -> phase
+        self._stacks = Counter()
+        self._names = {}   # code object -> "file:func"
+        self._lock = threading.Lock()
+        self._control = threading.Lock()  # serialises start() / stop()
+        self._thread = None
+
+    def start(self, sample_rate):
+        with self._control:
+            self.sample_rate = min(max(sample_rate, 0.0), 1.0)
+            if self.enabled:
+                return
+            with self._lock:
+                self.enabled = True
+                self.started_at = time.time()
+            self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        # join the sampler so a quick stop -> start never leaves two running
+        with self._control:
+            with self._lock:
+                self.enabled = False
+                self._active.clear()
+            thread, self._thread = self._thread, None
+            if thread is not None:
+                thread.join()
+
+    def reset(self):
+        with self._lock:
+            self._stacks.clear()
+            self.samples = 0
+            self.tracked = 0
+            self.started_at = time.time() if self.enabled else None
+
+    def sample(self, phase):
+        """Context manager tracking the current thread for a sampled fraction of calls."""
+        if self.enabled and random.random() < self.sample_rate:
+            return _Track(self, phase)
+        return _NO_TRACK
+
+    def wrap(self, phase, fn):
+        # for calls that run on another thread, e.g. outbound sender jobs
+        @functools.wraps(fn)
+        def tracked(*args, **kwargs):
+            with self.sample(phase):
+                return fn(*args, **kwargs)
+        return tracked
+
+    def _name(self, code):
+        name = self._names.get(code)
+        if name is None:
+            name = self._names[code] = f"{os.path.basename(code.co_filename)}:{code.co_name}"
+        return name
+
+    def _run(self):
+        me = threading.get_ident()
+        while self.enabled:
+            time.sleep(self.interval)
+            if not self._active:
+                continue
+            frames = sys._current_frames()
+            for ident, phase in list(self._active.items()):
+                frame = frames.get(ident)
+                if frame is None or ident == me:
+                    continue
+                names = []
+                while frame is not None and len(names) < self.max_depth:
+                    names.append(self._name(frame.f_code))
+                    frame = frame.f_back
+                names.append(phase)
+                key = ";".join(reversed(names))
+                with self._lock:
+                    if key in self._stacks or len(self._stacks) < self.max_stacks:
+                        self._stacks[key] += 1
+                    self.samples += 1
+            # held frames keep their locals (open cursors...) alive
+            frames = frame = None
+
+    def collapsed(self):
+        with self._lock:
+            items = list(self._stacks.items())
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(items))
+
+    def top(self, n=15):
+        """[(function, self samples, total samples)] ordered by self samples."""
+        own = Counter()
+        total = Counter()
+        with self._lock:
+            items = list(self._stacks.items())
+        for stack, count in items:
+            names = stack.split(";")
+            own[names[-1]] += count
+            for name in set(names[1:]):
+                total[name] += count
+        return [(name, c, total[name]) for name, c in own.most_common(n)]
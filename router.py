@@ -0,0 +1,127 @@
+# ============================================================
+# CALLBACK DATA CODEC + ROUTING TABLE
+# ============================================================
+# Dynamic buttons carry compact, versioned callback data:
+#
+#     <version><action>:<int>.<int>...     e.g. "1dt:5.1f"
+#
+# where integers are base-36 (negative ids keep a leading "-"). Telegram
+# caps callback data at 64 bytes, so short codes also leave headroom.
+# Buttons already sent with the old "done_task_<uid>_<task_id>" style are
+# still understood through their legacy prefix.
+
+CODEC_VERSION = "1"
+_DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+
+def _b36(n):
+    if n < 0:
+        return "-" + _b36(-n)
+    if n < 36:
+        return _DIGITS[n]
+    out = []
+    while n:
+        n, r = divmod(n, 36)
+        out.append(_DIGITS[r])
+    return "".join(reversed(out))
+
+
+def encode_callback(action, *ints):
+    return f"{CODEC_VERSION}{action}:" + ".".join(_b36(i) for i in ints)
+
+
+def decode_callback(data):
+    """Return (action, ints) for codec data, or None if `data` is not codec data.
+
+    Raises ValueError for codec data whose integers do not parse.
+    """
+    head, sep, tail = data.partition(":")
+    if not sep or not head.startswith(CODEC_VERSION):
+        return None
+    ints = tuple(int(x, 36) for x in tail.split(".")) if tail else ()
+    return head[len(CODEC_VERSION):], ints
+
+
+class CallbackRouter:
+    """Constant-time callback dispatch.
+
+    resolve() tries, in order: an exact match on the whole callback data
+    (static buttons), the codec action, then the legacy "<word>_<word>_"
+    prefix. Each route is (handler, who, args); `who` is "any", "user" or
+    "admin" and is enforced by the caller.
+    """
+
+    def __init__(self):
+        self._exact = {}
+        self._actions = {}
+        self._legacy = {}
+
+    def exact(self, data, handler, who="any", *args):
+        self._exact[data] = (handler, who, args)
+
+    def action(self, action, handler, arity, who="any", legacy_prefix=None):
+        self._actions[action] = (handler, who, arity)
+        if legacy_prefix:
+            self._legacy[legacy_prefix] = action
+
+    def resolve(self, data):
+        """Return (handler, who, args) or None; ValueError on malformed ints."""
+        route = self._exact.get(data)
+        if route is not None:
+            return route
+
+        decoded = decode_callback(data)
+        if decoded is not None:
+            action, ints = decoded
+            route = self._actions.get(action)
+        else:
+            parts = data.split("_")
+            action = self._legacy.get(parts[0] + "_" + parts[1] if len(parts) > 1 else data)
+            if action is None:
+                return None
+            route = self._actions[action]
+            ints = tuple(map(int, parts[2:]))
+
+        if route is None:
+            return None
+        handler, who, arity = route
+        if len(ints) != arity:
+            raise ValueError(f"{data!r}: expected {arity} ints, got {len(ints)}")
+        return handler, who, ints
+
+
+class TextRouter:
+    """Dict-based routing for reply-keyboard texts and conversation states.
+
+    Commands are matched on the lower-cased message text. States are
+    matched exactly first ("awaiting_own_gmail"), then by the part before
+    the last underscore ("awaiting_withdraw" for "awaiting_withdraw_bank"),
+    which is handed to the handler as its argument.
+    """
+
+    def __init__(self):
+        self._commands = {}
+        self._states = {}
+
+    def command(self, handler, *texts):
+        for text in texts:
+            self._commands[text.lower()] = handler
+
+    def state(self, name, handler):
+        self._states[name] = handler
+
+    def resolve_command(self, text):
+        return self._commands.get(text.lower())
+
+    def resolve_state(self, state):
+        """Return (handler, suffix) for a state string, or (None, None)."""
+        if not state:
+            return None, None
+        handler = self._states.get(state)
+        if handler is not None:
+            return handler, None
+        head, _, suffix = state.rpartition("_")
+        handler = self._states.get(head)
+        if handler is not None:
+            return handler, suffix
+        return None, None
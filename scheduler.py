@@ -0,0 +1,108 @@
+import os
+import threading
+import time
+import uuid
+
+# ============================================================
+# BACKGROUND SCHEDULER
+# ============================================================
+# Periodic maintenance jobs. Every worker process runs a Scheduler thread,
+# but only the leader (the holder of a lease row renewed every tick) runs
+# jobs, so with N gunicorn workers each job still runs once per interval.
+# When the leader dies, another worker takes over once the lease expires
+# and continues from the recorded last runs. A job that outlives the
+# lease may briefly overlap with the next leader's run, so jobs must be
+# idempotent (batched deletes, conditional updates).
+
+
+class Job:
+    def __init__(self, name, interval, fn):
+        self.name = name
+        self.interval = interval
+        self.fn = fn  # fn() -> rows affected
+        self.next_run = 0.0
+
+
+class Scheduler:
+    """Runs registered jobs in the elected leader process.
+
+    Storage is left to the callbacks:
+      elect(owner) -> True if `owner` took or renewed the lease
+      last_runs() -> {job name: last start (epoch seconds)}
+      record(name, started, seconds, rows, error, owner)
+    `observer(name, seconds, rows, error)` is called after every run.
+    """
+
+    def __init__(self, elect, last_runs, record, tick=5.0, observer=None):
+        self.elect = elect
+        self.last_runs = last_runs
+        self.record = record
+        self.tick = tick
+        self.observer = observer
+        self.jobs = []
+        self.owner = None
+        self.leader = False
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def add(self, name, interval, fn):
+        self.jobs.append(Job(name, interval, fn))
+
+    def start(self):
+        # threads do not survive fork(), so start lazily in each process
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            # fresh token per process: a forked child never inherits the lease
+            self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+            self.leader = False
+            threading.Thread(target=self._loop, name="scheduler", daemon=True).start()
+            self._pid = os.getpid()
+
+    def _loop(self):
+        while True:
+            try:
+                self.run_pending()
+            except Exception as e:
+                print("Scheduler tick failed:", e)
+            time.sleep(self.tick)
+
+    def run_pending(self):
+        was_leader = self.leader
+        self.leader = self.elect(self.owner)
+        if not self.leader:
+            return
+        if not was_leader:
+            # pick up the previous leader's timetable
+            last = self.last_runs()
+            for job in self.jobs:
+                job.next_run = last.get(job.name, 0) + job.interval
+        for job in self.jobs:
+            if job.next_run > time.time():
+                continue
+            self.run(job)
+            self.leader = self.elect(self.owner)
+            if not self.leader:
+                return
+
+    def run(self, job):
+        """Run one job now; returns (rows, seconds, error)."""
+        started = time.time()
+        t = time.perf_counter()
+        rows, error = 0, None
+        try:
+            rows = job.fn() or 0
+        except Exception as e:
+            error = str(e) or type(e).__name__
+            print(f"Job {job.name} failed:", e)
+        seconds = time.perf_counter() - t
+        job.next_run = started + job.interval
+        if self.observer:
+            self.observer(job.name, seconds, rows, error)
+        try:
+            self.record(job.name, int(started), seconds, rows, error, self.owner)
+        except Exception as e:
+            print(f"Recording job {job.name} failed:", e)
+        return rows, seconds, error
@@ -0,0 +1,125 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+import database
+
+# ============================================================
+# CONVERSATION STATE STORES
+# ============================================================
+# Both stores expose the same small interface:
+#   get(uid) -> {'state': str[, 'temp': dict]} or {}
+#   set(uid, state, temp=None), pop(uid), expire() -> rows removed, size()
+# Entries expire `ttl` seconds after their last set(), and the stores
+# never grow past `max_entries` (oldest entries are evicted first).
+
+
+def _entry(state, temp):
+    entry = {'state': state}
+    if temp:
+        entry['temp'] = temp
+    return entry
+
+
+class MemoryStateStore:
+    """Per-process store; only correct with a single worker process."""
+
+    def __init__(self, ttl=3600, max_entries=100000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._data = OrderedDict()  # uid -> (expires_at, state, temp)
+        self._lock = threading.Lock()
+
+    def get(self, uid):
+        with self._lock:
+            entry = self._data.get(uid)
+            if entry is None:
+                return {}
+            if entry[0] <= time.time():
+                del self._data[uid]
+                return {}
+            return _entry(entry[1], dict(entry[2]) if entry[2] else None)
+
+    def set(self, uid, state, temp=None):
+        with self._lock:
+            self._data.pop(uid, None)
+            self._data[uid] = (time.time() + self.ttl, state, temp or None)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def pop(self, uid):
+        with self._lock:
+            self._data.pop(uid, None)
+
+    def expire(self):
+        now = time.time()
+        with self._lock:
+            # insertion order == expiry order because set() re-inserts
+            removed = 0
+            while self._data:
+                uid, entry = next(iter(self._data.items()))
+                if entry[0] > now:
+                    break
+                del self._data[uid]
+                removed += 1
+            return removed
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def size(self):
+        with self._lock:
+            return len(self._data)
+
+
+class SQLiteStateStore:
+    """Store backed by the user_state table, shared by all worker processes.
+
+    `connect` returns a pooled connection (database.get_db_conn); each call
+    runs one of database.py's user_state queries and commits, so no
+    cross-call locking is needed.
+    """
+
+    def __init__(self, connect, ttl=3600, max_entries=100000, expire_every=500):
+        self.connect = connect
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.expire_every = expire_every
+        self._writes = 0
+
+    def _run(self, query, *args):
+        conn = self.connect()
+        try:
+            cur = conn.cursor()
+            result = query(cur, *args)
+            cur.close()
+            conn.commit()
+            return result
+        finally:
+            conn.close()
+
+    def get(self, uid):
+        row = self._run(database.get_state, uid, int(time.time()))
+        if not row:
+            return {}
+        state, temp = row[0], row[1]
+        return _entry(state, json.loads(temp) if temp else None)
+
+    def set(self, uid, state, temp=None):
+        payload = json.dumps(temp, separators=(',', ':')) if temp else None
+        self._run(database.set_state, uid, state, payload, int(time.time() + self.ttl))
+        self._writes += 1
+        if self._writes % self.expire_every == 0:
+            self.expire()
+
+    def pop(self, uid):
+        self._run(database.delete_state, uid)
+
+    def expire(self):
+        removed = self._run(database.expire_states, int(time.time()))
+        return removed + self._run(database.trim_states, self.max_entries)
+
+    def size(self):
+        return self._run(database.count_states)
@@ -0,0 +1,118 @@
+import itertools
+import json
+import os
+import sys
+import tempfile
+
+import pytest
+from telebot import apihelper
+
+# main.py reads its configuration at import time
+_TMP = tempfile.mkdtemp(prefix="bot-tests-")
+os.environ.setdefault("BOT_TOKEN", "123:TEST")
+os.environ.setdefault("WEBHOOK_URL", "http://localhost/")
+os.environ.setdefault("ADMIN_CHAT_ID", "999")
+os.environ.setdefault("SQLITE_DB", os.path.join(_TMP, "bot.sqlite"))
+os.environ.setdefault("BACKUP_DIR", os.path.join(_TMP, "backups"))
+os.environ.setdefault("BOT_USERNAME", "testbot")
+os.environ.setdefault("OUTBOUND_CHAT_RATE", "1000")
+os.environ.setdefault("OUTBOUND_GLOBAL_RATE", "10000")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# Telegram API calls made by the bot under test: (method, params)
+API_CALLS = []
+
+
+class _Response:
+    status_code = 200
+    reason = "OK"
+
+    def __init__(self, result):
+        self._body = {'ok': True, 'result': result}
+        self.text = json.dumps(self._body)
+
+    def json(self):
+        return self._body
+
+
+def _fake_api(method, url, **kwargs):
+    name = url.rsplit("/", 1)[1]
+    params = dict(kwargs.get("params") or {})
+    API_CALLS.append((name, params))
+    if name == "getMe":
+        return _Response({'id': 1, 'is_bot': True, 'first_name': "Test", 'username': "fetchedbot"})
+    if name in ("sendMessage", "sendDocument"):
+        chat = {'id': int(params.get('chat_id', 0)), 'type': "private"}
+        return _Response({'message_id': 1, 'date': 0, 'chat': chat, 'text': params.get('text', "")})
+    return _Response(True)
+
+
+apihelper.CUSTOM_REQUEST_SENDER = _fake_api
+
+
+@pytest.fixture
+def api_calls():
+    API_CALLS.clear()
+    return API_CALLS
+
+
+@pytest.fixture
+def bot_main():
+    import main
+    yield main
+    main.UPDATE_DISPATCHER.join()
+    main.OUTBOUND.join()
+
+
+class FakeTelegram:
+    """Posts updates to the webhook the way Telegram does."""
+
+    _update_ids = itertools.count(1)
+
+    def __init__(self, main):
+        self.main = main
+        self.client = main.app.test_client()
+
+    def post(self, update):
+        update['update_id'] = next(self._update_ids)
+        r = self.client.post(f"/webhook/{self.main.BOT_TOKEN}", data=json.dumps(update))
+        assert r.status_code == 200, r.status_code
+        self.settle()
+
+    def message(self, uid, text):
+        message = {
+            'message_id': 1, 'date': 0, 'text': text,
+            'chat': {'id': uid, 'type': "private"},
+            'from': {'id': uid, 'is_bot': False, 'first_name': "u"},
+        }
+        if text.startswith("/"):
+            message['entities'] = [{'type': "bot_command", 'offset': 0, 'length': len(text.split()[0])}]
+        self.post({'message': message})
+
+    def callback(self, uid, data):
+        self.post({'callback_query': {
+            'id': "1", 'chat_instance': "x", 'data': data,
+            'from': {'id': uid, 'is_bot': False, 'first_name': "u"},
+            'message': {'message_id': 1, 'date': 0, 'text': "t", 'chat': {'id': uid, 'type': "private"}},
+        }})
+
+    def settle(self):
+        self.main.UPDATE_DISPATCHER.join()
+        self.main.OUTBOUND.join()
+        self.main.UPDATE_DISPATCHER.join()
+
+    def texts(self, chat_id):
+        return [p.get('text') for name, p in API_CALLS if name == "sendMessage" and int(p['chat_id']) == chat_id]
+
+    def buttons(self, chat_id):
+        """callback_data of the inline buttons last sent to `chat_id`."""
+        for name, p in reversed(API_CALLS):
+            if name == "sendMessage" and int(p['chat_id']) == chat_id and "inline_keyboard" in (p.get('reply_markup') or ""):
+                return [b['callback_data'] for row in json.loads(p['reply_markup'])['inline_keyboard'] for b in row]
+        return []
+
+
+@pytest.fixture
+def telegram(bot_main, api_calls):
+    return FakeTelegram(bot_main)
@@ -0,0 +1,98 @@
+import gzip
+import os
+import shutil
+import sqlite3
+import time
+
+import pytest
+
+import backup
+import database
+from database import db_read, db_write
+from migrations import SCHEMA_VERSION
+
+
+def test_restore_brings_back_archived_rows(bot_main):
+    with db_write() as cur:
+        task_id = database.insert_task(cur, 4343, 1, 'own', 40, int(time.time()) - 10 * 86400, status='approved')
+    bot_main.archive_finished(1)
+    with db_read() as cur:
+        assert database.get_archived(cur, 'tasks', task_id) is not None
+
+    r = backup.run_backup(database.DB_PATH, bot_main.BACKUP_DIR, archive_db_path=database.ARCHIVE_DB_PATH)
+    assert r['archive_path'] == backup.archive_backup_path(r['path'])
+    assert os.path.basename(r['path']) in backup.list_backups(bot_main.BACKUP_DIR)
+    assert os.path.basename(r['archive_path']) not in backup.list_backups(bot_main.BACKUP_DIR)
+
+    with db_write() as cur:
+        cur.execute("DELETE FROM archive.tasks WHERE id = ?", (task_id,))
+
+    r = backup.restore_backup(r['path'], database.DB_PATH, archive_db_path=database.ARCHIVE_DB_PATH)
+    assert r['archive']
+    with db_read() as cur:
+        row = database.get_archived(cur, 'tasks', task_id)
+    assert row is not None and row['status'] == 'approved'
+
+
+def _rewrite_backup(path, sql):
+    raw = path + ".raw"
+    with gzip.open(path, "rb") as f_in, open(raw, "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    conn = sqlite3.connect(raw, isolation_level=None)
+    conn.executescript(sql)
+    conn.close()
+    with open(raw, "rb") as f_in, gzip.open(path, "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(raw)
+
+
+def test_restore_rejects_a_newer_schema(bot_main):
+    r = backup.run_backup(database.DB_PATH, bot_main.BACKUP_DIR)
+    _rewrite_backup(r['path'], f"PRAGMA user_version = {SCHEMA_VERSION + 1}")
+    with pytest.raises(ValueError, match="newer"):
+        backup.restore_backup(r['path'], database.DB_PATH)
+    with db_read() as cur:
+        assert cur.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION
+
+
+def test_restore_migrates_an_older_schema(bot_main):
+    r = backup.run_backup(database.DB_PATH, bot_main.BACKUP_DIR)
+    # as taken before migration 10 (update_window)
+    _rewrite_backup(r['path'], "DROP TABLE update_window; PRAGMA user_version = 9")
+    r = backup.restore_backup(r['path'], database.DB_PATH)
+    assert [v for v, _ in r['migrations']] == list(range(10, SCHEMA_VERSION + 1))
+    with db_read() as cur:
+        assert cur.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION
+        assert database.update_seen(cur, 1) is False
+
+
+def test_restore_generation_drops_the_caches_of_other_workers(bot_main, monkeypatch):
+    monkeypatch.setitem(bot_main._restore_generation, 'value', None)
+    monkeypatch.setitem(bot_main._restore_generation, 'checked', 0.0)
+    assert not bot_main.check_restore_generation()
+    bot_main.ensure_user_db(4444)
+    bot_main.get_user_db(4444)
+    assert bot_main.USER_CACHE.stats()['size'] > 0
+
+    # another worker ran /restore
+    with db_write() as cur:
+        database.set_restore_generation(cur, database.restore_generation(cur) + 1)
+    assert not bot_main.check_restore_generation()  # checked moments ago
+    monkeypatch.setitem(bot_main._restore_generation, 'checked', 0.0)
+    assert bot_main.check_restore_generation()
+    assert bot_main.USER_CACHE.stats()['size'] == 0
+
+
+def test_restore_job_serves_restored_balances(bot_main):
+    bot_main.ensure_user_db(4545)
+    r = backup.run_backup(database.DB_PATH, bot_main.BACKUP_DIR)
+    before = bot_main.get_user_db(4545)['balance']
+    bot_main.update_user_balance(4545, 100)
+    assert bot_main.get_user_db(4545)['balance'] == before + 100
+    with db_read() as cur:
+        generation = database.restore_generation(cur)
+
+    bot_main._run_restore_job(os.path.basename(r['path']))
+    assert bot_main.get_user_db(4545)['balance'] == before
+    with db_read() as cur:
+        assert database.restore_generation(cur) == generation + 1
@@ -0,0 +1,64 @@
+import threading
+import time
+
+import pytest
+
+
+@pytest.fixture
+def unconfigured(bot_main, monkeypatch):
+    monkeypatch.setattr(bot_main, "BOT_USERNAME", None)
+    monkeypatch.setattr(bot_main, "_bot_username", {'value': None, 'fetched_at': None, 'refreshing': False, 'pid': None})
+    return bot_main
+
+
+def wait_for_refresh(bot_main):
+    deadline = time.monotonic() + 5
+    while bot_main._bot_username['refreshing'] and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def get_me_threads(monkeypatch, bot_main, fail=False):
+    threads = []
+    real = bot_main.bot.get_me
+
+    def get_me():
+        threads.append(threading.current_thread())
+        if fail:
+            raise ConnectionError("Bot API is down")
+        return real()
+    monkeypatch.setattr(bot_main.bot, "get_me", get_me)
+    return threads
+
+
+def test_configured_username_never_calls_get_me(bot_main, api_calls, monkeypatch):
+    monkeypatch.setattr(bot_main, "BOT_USERNAME", "configuredbot")
+    monkeypatch.setattr(bot_main, "BOT_INFO_REFRESH_SECONDS", 0)
+    bot_main.start_background_jobs()
+    for _ in range(3):
+        assert bot_main.get_bot_username() == "configuredbot"
+    assert not [name for name, _ in api_calls if name == "getMe"]
+
+
+def test_username_is_fetched_at_startup(unconfigured, api_calls, monkeypatch):
+    threads = get_me_threads(monkeypatch, unconfigured)
+    unconfigured.start_bot_identity()
+    wait_for_refresh(unconfigured)
+    assert unconfigured.get_bot_username() == "fetchedbot"
+    assert unconfigured.get_bot_username() == "fetchedbot"
+    assert len(threads) == 1 and threads[0] is not threading.current_thread()
+
+
+def test_failed_fetch_serves_the_fallback_without_calling_get_me(unconfigured, api_calls, monkeypatch):
+    threads = get_me_threads(monkeypatch, unconfigured, fail=True)
+    unconfigured.start_bot_identity()
+    wait_for_refresh(unconfigured)
+    for _ in range(5):
+        assert unconfigured.get_bot_username() is None
+    wait_for_refresh(unconfigured)
+    assert len(threads) == 1 and threads[0] is not threading.current_thread()
+
+    # retried in the background once BOT_INFO_REFRESH_SECONDS have passed
+    monkeypatch.setattr(unconfigured, "BOT_INFO_REFRESH_SECONDS", 0)
+    assert unconfigured.get_bot_username() is None
+    wait_for_refresh(unconfigured)
+    assert len(threads) == 2
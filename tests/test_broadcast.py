@@ -0,0 +1,63 @@
+import threading
+import time
+
+import database
+from broadcast import Broadcaster
+from database import db_read, db_write
+
+
+class Crash(Exception):
+    pass
+
+
+def recorder(sent, crash_after=None):
+    def send(chat_id, text, on_done):
+        if crash_after is not None and len(sent) == crash_after:
+            raise Crash("worker killed")
+        sent.append(chat_id)
+        on_done(None)
+    return send
+
+
+def test_resume_after_a_crash_skips_nobody(bot_main):
+    for uid in range(8001, 8046):
+        bot_main.ensure_user_db(uid)
+    with db_read() as cur:
+        everyone = database.user_ids_after(cur, 0, 100000)
+    with db_write() as cur:
+        broadcast_id = database.create_broadcast(cur, "hello", time.time())
+
+    chunk = 10
+    first = []
+    crashed = Broadcaster(recorder(first, crash_after=25), report=lambda row, rate: None, chunk_size=chunk, rate=100000, stale_after=0.05)
+    owner = crashed.owner()
+    with db_write() as cur:
+        assert database.start_broadcast(cur, broadcast_id, owner, time.time())
+    try:
+        crashed.run(broadcast_id, owner)
+    except Crash:
+        pass
+    with db_read() as cur:
+        checkpointed = database.get_broadcast(cur, broadcast_id)['last_user_id']
+    assert checkpointed == everyone[19]
+
+    time.sleep(0.1)
+    second, third = [], []
+    done = threading.Event()
+    resumers = [
+        Broadcaster(recorder(sent), report=lambda row, rate: done.set(), chunk_size=chunk, rate=100000, stale_after=0.05)
+        for sent in (second, third)
+    ]
+    claimed = [r.resume_stale() for r in resumers]
+    assert sorted(claimed) == [0, 1]
+    assert done.wait(10)
+
+    resent = second or third
+    # the resumer starts after the last checkpoint, so only the chunk in
+    # flight at the crash is sent twice
+    assert not (second and third)
+    assert sorted(first + resent) == sorted(everyone + everyone[20:25])
+    assert len(resent) == len(set(resent))
+    with db_read() as cur:
+        row = database.get_broadcast(cur, broadcast_id)
+    assert (row['status'], row['sent']) == ('done', len(everyone))
@@ -0,0 +1,62 @@
+import time
+
+import database
+import ledger
+from database import db_read, db_write
+
+ADMIN = 999
+
+
+def hold_withdraw(uid, amount, method="easypaisa"):
+    # what the withdraw flow does once the account number is entered
+    with db_write() as cur:
+        wd_id = database.insert_withdraw(cur, uid, method, "Ali", "0300", amount, None, int(time.time()))
+        ledger.post(cur, uid, -amount, amount, ledger.WITHDRAW_HOLD, wd_id)
+    return wd_id
+
+
+def user(uid):
+    with db_read() as cur:
+        u = database.get_user(cur, uid)
+        return u['balance'], u['hold'], ledger.recompute(cur, uid) == (u['balance'], u['hold'])
+
+
+def withdraw_entries(uid):
+    with db_read() as cur:
+        return sorted(
+            (e['ref_id'], e['reason'], e['delta_balance'], e['delta_hold'])
+            for e in ledger.history(cur, uid, limit=100) if e['reason'] != ledger.ADJUSTMENT
+        )
+
+
+def test_bulk_settlement_releases_each_hold_once(bot_main, telegram):
+    a, b = 6101, 6102
+    for uid in (a, b):
+        bot_main.ensure_user_db(uid)
+        bot_main.update_user_balance(uid, 1000)
+    a1, a2 = hold_withdraw(a, 200), hold_withdraw(a, 300, "jazzcash")
+    b1, b2 = hold_withdraw(b, 250), hold_withdraw(b, 400)
+    # settled one at a time before the bulk command
+    telegram.callback(ADMIN, bot_main.encode_callback(bot_main.CB_APPROVE_WD, b2))
+    assert user(b) == (350, 250, True)
+
+    telegram.message(ADMIN, f"/bulkwd approve {a1} {b1} {b2}")
+    assert user(a) == (500, 300, True)
+    assert user(b) == (350, 0, True)
+    telegram.message(ADMIN, f"/bulkwd reject {a1} {a2} {b2}")
+    assert user(a) == (800, 0, True)
+    assert user(b) == (350, 0, True)
+    # nothing is pending any more
+    telegram.message(ADMIN, f"/bulkwd approve {a1} {a2} {b1} {b2}")
+    assert telegram.texts(ADMIN)[-1].startswith("Approved 0 withdraws")
+
+    with db_read() as cur:
+        assert [database.get_withdraw(cur, i)['status'] for i in (a1, a2, b1, b2)] == ['approved', 'rejected', 'approved', 'approved']
+    assert withdraw_entries(a) == sorted([
+        (a1, ledger.WITHDRAW_HOLD, -200, 200), (a1, ledger.WITHDRAW_PAID, 0, -200),
+        (a2, ledger.WITHDRAW_HOLD, -300, 300), (a2, ledger.WITHDRAW_REFUND, 300, -300),
+    ])
+    assert withdraw_entries(b) == sorted([
+        (b1, ledger.WITHDRAW_HOLD, -250, 250), (b1, ledger.WITHDRAW_PAID, 0, -250),
+        (b2, ledger.WITHDRAW_HOLD, -400, 400), (b2, ledger.WITHDRAW_PAID, 0, -400),
+    ])
@@ -0,0 +1,32 @@
+import threading
+
+from cache import LRUCache
+
+
+def test_fill_started_before_invalidate_is_dropped():
+    cache = LRUCache(maxsize=10, ttl=60)
+    loading, invalidated = threading.Event(), threading.Event()
+
+    def slow_loader(key):
+        loading.set()
+        invalidated.wait(5)
+        return {'balance': 100}  # read before the writer committed
+
+    reader = threading.Thread(target=cache.get_or_load, args=(1, slow_loader))
+    reader.start()
+    loading.wait(5)
+    cache.invalidate(1)  # the writer commits balance 150 and invalidates
+    invalidated.set()
+    reader.join()
+
+    assert cache.get(1) is None
+    assert cache.get_or_load(1, lambda key: {'balance': 150}) == {'balance': 150}
+    assert cache.get(1) == {'balance': 150}
+
+
+def test_fill_without_a_racing_invalidate_is_kept():
+    cache = LRUCache(maxsize=2, ttl=60)
+    for key in (1, 2, 3):
+        cache.get_or_load(key, lambda key: key * 10)
+    # least recently used entry evicted
+    assert (cache.get(1), cache.get(2), cache.get(3)) == (None, 20, 30)
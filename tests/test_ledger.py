@@ -0,0 +1,102 @@
+import pytest
+
+import database
+import ledger
+from database import db_read, db_write
+
+ADMIN = 999
+
+
+def ledger_matches(uid):
+    with db_read() as cur:
+        u = database.get_user(cur, uid)
+        return ledger.recompute(cur, uid) == (u['balance'], u['hold'])
+
+
+def reasons(uid):
+    with db_read() as cur:
+        return [e['reason'] for e in reversed(ledger.history(cur, uid, limit=100))]
+
+
+def balance(uid):
+    with db_read() as cur:
+        u = database.get_user(cur, uid)
+        return u['balance'], u['hold']
+
+
+def request_withdraw(telegram, uid, amount):
+    telegram.message(uid, "💰 Withdraw")
+    telegram.callback(uid, "wd_easypaisa")
+    telegram.message(uid, str(amount))
+    telegram.message(uid, "Ali")
+    telegram.message(uid, "03001234567")
+
+
+def test_every_balance_change_posts_a_ledger_entry(bot_main, telegram):
+    referrer, uid = 5101, 5102
+    telegram.message(referrer, "/start")
+    telegram.message(uid, f"/start {referrer}")
+
+    telegram.callback(uid, "task_gen")
+    telegram.callback(uid, telegram.buttons(uid)[0])  # Done
+    telegram.callback(ADMIN, telegram.buttons(ADMIN)[0])  # approve
+    assert balance(uid) == (bot_main.GEN_TASK_REWARD, 0)
+    assert balance(referrer) == (bot_main.REFERRAL_BONUS_PER_TASK, 0)
+
+    bot_main.update_user_balance(uid, 1000)
+    assert bot_main.adjust_user_balance(uid, -10) is not None
+
+    request_withdraw(telegram, uid, 300)
+    assert balance(uid) == (bot_main.GEN_TASK_REWARD + 690, 300)
+    telegram.callback(ADMIN, telegram.buttons(ADMIN)[0])  # approve
+    assert balance(uid) == (bot_main.GEN_TASK_REWARD + 690, 0)
+
+    request_withdraw(telegram, uid, 400)
+    telegram.callback(ADMIN, telegram.buttons(ADMIN)[1])  # reject
+    assert balance(uid) == (bot_main.GEN_TASK_REWARD + 690, 0)
+
+    assert reasons(uid) == [
+        ledger.TASK_REWARD, ledger.ADJUSTMENT, ledger.ADJUSTMENT,
+        ledger.WITHDRAW_HOLD, ledger.WITHDRAW_PAID, ledger.WITHDRAW_HOLD, ledger.WITHDRAW_REFUND,
+    ]
+    assert reasons(referrer) == [ledger.REFERRAL_BONUS]
+    assert ledger_matches(uid) and ledger_matches(referrer)
+
+
+def test_entry_and_balance_change_share_the_transaction(bot_main):
+    bot_main.ensure_user_db(5201)
+    with pytest.raises(RuntimeError):
+        with db_write() as cur:
+            ledger.post(cur, 5201, 50, 0, ledger.ADJUSTMENT)
+            raise RuntimeError("handler failed")
+    assert balance(5201) == (0, 0)
+    assert reasons(5201) == []
+
+
+def test_recompute_replays_only_entries_after_the_checkpoint(bot_main):
+    bot_main.ensure_user_db(5301)
+    bot_main.update_user_balance(5301, 70, 30)
+    with db_write() as cur:
+        _, upto = ledger.checkpoint(cur)
+        assert ledger.entries_since_checkpoint(cur) == 0
+    bot_main.update_user_balance(5301, -30, 30)
+    with db_write() as cur:
+        # entries up to the checkpoint must come from the snapshot only
+        cur.execute("UPDATE ledger SET delta_balance = delta_balance + 1000 WHERE id <= ?", (upto,))
+        assert ledger.entries_since_checkpoint(cur) == 1
+        assert ledger.recompute(cur, 5301) == (40, 60)
+        cur.execute("UPDATE ledger SET delta_balance = delta_balance - 1000 WHERE id <= ?", (upto,))
+
+
+def test_mismatches_flags_a_hand_edited_balance(bot_main):
+    bot_main.ensure_user_db(5401)
+    bot_main.update_user_balance(5401, 25)
+    with db_read() as cur:
+        assert 5401 not in [r['id'] for r in ledger.mismatches(cur, limit=1000)]
+    with db_write() as cur:
+        cur.execute("UPDATE users SET balance = balance + 1 WHERE id = 5401")
+    with db_read() as cur:
+        bad = {r['id']: r for r in ledger.mismatches(cur, limit=1000)}
+    assert (bad[5401]['balance'], bad[5401]['ledger_balance']) == (26, 25)
+    with db_write() as cur:
+        cur.execute("UPDATE users SET balance = balance - 1 WHERE id = 5401")
@@ -0,0 +1,44 @@
+import sqlite3
+
+import pytest
+
+import database
+from migrations import MIGRATIONS, SCHEMA_VERSION, explain_query_plan, migrate, schema_version
+
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(":memory:", isolation_level=None)
+    migrate(conn)
+    yield conn
+    conn.close()
+
+
+def test_migrations_are_numbered_up_to_schema_version(conn):
+    assert [m[0] for m in MIGRATIONS] == list(range(1, SCHEMA_VERSION + 1))
+    assert schema_version(conn) == SCHEMA_VERSION
+    assert migrate(conn) == []
+
+
+HOT_QUERIES = [
+    # /pending pages (keyset pagination)
+    (database.PENDING_SQL['tasks']['after'], ('pending_admin', 0, 31)),
+    (database.PENDING_SQL['tasks']['before'], ('pending_admin', 100, 31)),
+    (database.PENDING_SQL['tasks']['any_upto'], ('pending_admin', 100)),
+    (database.PENDING_SQL['tasks']['any_after'], ('pending_admin', 100)),
+    (database.PENDING_SQL['withdraws']['after'], ('pending', 0, 31)),
+    (database.PENDING_SQL['withdraws']['before'], ('pending', 100, 31)),
+    # done / cancel draft
+    ("SELECT * FROM tasks WHERE user_id = ? AND task_id = ? AND status = 'draft'", (1, 1)),
+    # referral lookups (there is no leaderboard query; this is the users-side one)
+    ("SELECT id FROM users WHERE referrer = ?", (1,)),
+    # stale draft cleanup
+    ("SELECT id FROM tasks WHERE status = 'draft' AND created_at < ? ORDER BY created_at LIMIT ?", (0, 500)),
+]
+
+
+@pytest.mark.parametrize("sql, params", HOT_QUERIES)
+def test_hot_queries_use_an_index(conn, sql, params):
+    plan = explain_query_plan(conn, sql, params)
+    assert any("USING INDEX" in d or "USING COVERING INDEX" in d for d in plan), plan
+    assert not any(d.startswith("SCAN") or "TEMP B-TREE" in d for d in plan), plan
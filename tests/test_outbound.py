@@ -0,0 +1,46 @@
+import random
+import threading
+import time
+
+from telebot.apihelper import ApiTelegramException
+
+from outbound import OutboundDispatcher, PRIORITY_ADMIN, PRIORITY_USER
+
+
+def test_same_chat_is_delivered_in_submit_order():
+    sent = []
+    lock = threading.Lock()
+
+    def send(chat_id, n):
+        # jitter so a shared-heap dispatcher would reorder
+        time.sleep(random.uniform(0, 0.002))
+        with lock:
+            sent.append((chat_id, n))
+
+    d = OutboundDispatcher(senders=8, global_rate=100000, chat_rate=100000, chat_burst=100000)
+    for n in range(200):
+        for chat_id in (1, 2, 3):
+            d.submit(chat_id, send, chat_id, n, priority=PRIORITY_ADMIN if n % 2 else PRIORITY_USER)
+    d.join()
+
+    for chat_id in (1, 2, 3):
+        assert [n for c, n in sent if c == chat_id] == list(range(200))
+
+
+def test_retry_keeps_later_messages_of_the_chat_behind_it():
+    sent = []
+    failed = []
+
+    def send(n):
+        if n == 0 and not failed:
+            failed.append(n)
+            raise ApiTelegramException("sendMessage", None, {
+                'error_code': 429, 'description': "Too Many Requests", 'parameters': {'retry_after': 0.05},
+            })
+        sent.append(n)
+
+    d = OutboundDispatcher(senders=4, global_rate=100000, chat_rate=100000, chat_burst=100000)
+    for n in range(5):
+        d.submit(7, send, n)
+    d.join()
+    assert sent == [0, 1, 2, 3, 4]
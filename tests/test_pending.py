@@ -0,0 +1,28 @@
+import time
+
+import database
+from database import db_write
+
+
+def buttons(markup):
+    return [b.text for row in markup.keyboard for b in row]
+
+
+def test_backward_page_has_no_next_once_later_rows_are_settled(bot_main, monkeypatch):
+    monkeypatch.setattr(bot_main, "PENDING_PAGE_SIZE", 3)
+    with db_write() as cur:
+        cur.execute("UPDATE tasks SET status = 'rejected' WHERE status = 'pending_admin'")
+        ids = [database.insert_task(cur, 4242, n, 'own', 40, int(time.time()), status='pending_admin') for n in range(4)]
+
+    text, markup = bot_main.pending_page(bot_main.PENDING_TASKS)
+    assert text.startswith("📌 Pending Tasks: 4")
+    assert buttons(markup) == ["Next ▶"]
+
+    text, markup = bot_main.pending_page(bot_main.PENDING_TASKS, after_id=ids[2])
+    assert buttons(markup) == ["◀ Prev"]
+
+    with db_write() as cur:
+        database.set_task_status(cur, ids[3], 'approved')
+    text, markup = bot_main.pending_page(bot_main.PENDING_TASKS, before_id=ids[3])
+    assert text.startswith("📌 Pending Tasks: 3")
+    assert buttons(markup) == []
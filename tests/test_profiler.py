@@ -0,0 +1,35 @@
+import threading
+import time
+
+from profiler import SamplingProfiler
+
+
+def sampler_threads():
+    return [t for t in threading.enumerate() if t.name == "profiler"]
+
+
+def test_stop_then_start_leaves_one_sampler():
+    p = SamplingProfiler(interval=0.05)
+    for _ in range(5):
+        p.start(1.0)
+        p.stop()
+    p.start(1.0)
+    try:
+        assert len(sampler_threads()) == 1
+    finally:
+        p.stop()
+    assert sampler_threads() == []
+
+
+def test_samples_tracked_thread():
+    p = SamplingProfiler(interval=0.001)
+    p.start(1.0)
+    try:
+        with p.sample("work"):
+            deadline = time.time() + 0.1
+            while time.time() < deadline:
+                pass
+    finally:
+        p.stop()
+    assert p.samples > 0
+    assert all(stack.startswith("work;") for stack in p.collapsed().splitlines())
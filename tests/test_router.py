@@ -0,0 +1,35 @@
+import pytest
+
+from router import CallbackRouter, decode_callback, encode_callback
+
+
+def handler(*args):
+    return args
+
+
+@pytest.fixture
+def router():
+    r = CallbackRouter()
+    r.exact("task_gen", handler, "user")
+    r.action("dt", handler, 2, "user", legacy_prefix="done_task")
+    return r
+
+
+def test_codec_round_trip():
+    for ints in [(0,), (35, 36), (123456789, -42)]:
+        assert decode_callback(encode_callback("dt", *ints)) == ("dt", ints)
+    assert decode_callback("task_gen") is None
+
+
+def test_resolve_exact_codec_and_legacy(router):
+    assert router.resolve("task_gen") == (handler, "user", ())
+    assert router.resolve(encode_callback("dt", 5, 71)) == (handler, "user", (5, 71))
+    assert router.resolve("done_task_5_71") == (handler, "user", (5, 71))
+    assert router.resolve(encode_callback("zz", 1)) is None
+
+
+def test_resolve_rejects_malformed_codec_data(router):
+    with pytest.raises(ValueError):
+        router.resolve("1dt:5")
+    with pytest.raises(ValueError):
+        router.resolve("1dt:5.!")
@@ -0,0 +1,82 @@
+import sqlite3
+
+import pytest
+
+import database
+import scheduler
+from migrations import migrate
+from scheduler import Scheduler
+
+LEASE_SECONDS = 15
+
+
+class SharedDB:
+    """One database standing in for the one all worker processes share."""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.conn = sqlite3.connect(":memory:", isolation_level=None, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        migrate(self.conn)
+
+    def write(self, fn, *args):
+        cur = self.conn.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        result = fn(cur, *args)
+        cur.execute("COMMIT")
+        return result
+
+    def elect(self, owner):
+        return self.write(database.acquire_lease, owner, self.clock.now, LEASE_SECONDS)
+
+    def last_runs(self):
+        return {r['name']: r['last_started'] for r in database.job_runs(self.conn.cursor())}
+
+    def record(self, name, started, seconds, rows, error, owner):
+        self.write(database.record_job_run, name, started, seconds, rows, error, owner)
+
+
+class Clock:
+    now = 1_000_000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(scheduler.time, "time", clock.time)
+    return clock
+
+
+def worker(db, owner, runs):
+    s = Scheduler(db.elect, db.last_runs, db.record)
+    s.owner = owner
+    s.add("cleanup", 60, lambda: runs.append(owner))
+    return s
+
+
+def test_only_the_lease_holder_runs_jobs(clock):
+    db = SharedDB(clock)
+    runs = []
+    a, b = worker(db, "a", runs), worker(db, "b", runs)
+
+    a.run_pending()
+    b.run_pending()
+    assert (a.leader, b.leader, runs) == (True, False, ["a"])
+
+    # a dies; b waits out the lease
+    clock.now += LEASE_SECONDS - 1
+    b.run_pending()
+    assert not b.leader
+
+    clock.now += 2
+    b.run_pending()
+    # b took over with a's timetable: the job is not due again yet
+    assert b.leader and runs == ["a"]
+
+    clock.now += 60
+    b.run_pending()
+    a.run_pending()  # a comes back but b renewed the lease
+    assert (a.leader, b.leader, runs) == (False, True, ["a", "b"])
@@ -0,0 +1,62 @@
+import sqlite3
+
+import pytest
+
+import state_store
+from migrations import migrate
+from state_store import MemoryStateStore, SQLiteStateStore
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(state_store.time, "time", clock.time)
+    return clock
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def make_store(request, tmp_path):
+    if request.param == "memory":
+        return MemoryStateStore
+    path = str(tmp_path / "state.sqlite")
+    conn = sqlite3.connect(path, isolation_level=None)
+    migrate(conn)
+    conn.close()
+    return lambda **kw: SQLiteStateStore(lambda: sqlite3.connect(path), **kw)
+
+
+def test_entries_expire_after_ttl(make_store, clock):
+    store = make_store(ttl=60, max_entries=100)
+    store.set(1, 'awaiting_amount', {'method': "bank"})
+    clock.now += 30
+    store.set(2, 'awaiting_name')
+    assert store.get(1) == {'state': 'awaiting_amount', 'temp': {'method': "bank"}}
+
+    clock.now += 31
+    assert store.get(1) == {}
+    assert store.get(2) == {'state': 'awaiting_name'}
+    store.set(2, 'awaiting_number')  # set() restarts the TTL
+    clock.now += 59
+    assert store.get(2) == {'state': 'awaiting_number'}
+
+    store.expire()
+    assert store.size() == 1
+
+
+def test_store_is_trimmed_to_max_entries(make_store, clock):
+    store = make_store(ttl=60, max_entries=3)
+    for uid in range(1, 6):
+        store.set(uid, 'awaiting_amount')
+        clock.now += 1
+    store.expire()
+    assert store.size() == 3
+    # the oldest entries go first
+    assert [store.get(uid) != {} for uid in range(1, 6)] == [False, False, True, True, True]
@@ -0,0 +1,119 @@
+import threading
+
+import database
+from database import db_read, db_write
+from update_queue import UpdateWindow
+
+
+class SharedWindow:
+    def __init__(self):
+        self.seen = set()
+        self.lookups = []
+        self.batches = []
+
+    def lookup(self, update_id):
+        self.lookups.append(update_id)
+        return update_id in self.seen
+
+    def persist(self, update_ids):
+        self.batches.append(update_ids)
+        claimed = set(update_ids) - self.seen
+        self.seen |= claimed
+        return claimed
+
+
+def test_redelivery_is_dropped_in_memory():
+    shared = SharedWindow()
+    w = UpdateWindow(1000, shared.lookup, shared.persist)
+    assert [w.first_delivery(i) for i in (1, 2, 3)] == [True, True, True]
+    assert [w.first_delivery(i) for i in (1, 2, 3)] == [False, False, False]
+    assert shared.lookups == [1, 2, 3]
+    assert shared.batches == []
+
+
+def test_ids_claimed_by_another_worker_are_dropped():
+    shared = SharedWindow()
+    shared.seen.add(7)
+    w = UpdateWindow(1000, shared.lookup, shared.persist)
+    assert not w.first_delivery(7)
+    assert w.first_delivery(8)
+    assert w.claim(8)
+    assert not w.claim(8)
+
+
+def test_forgotten_ids_are_processed_again():
+    shared = SharedWindow()
+    w = UpdateWindow(1000, shared.lookup, shared.persist)
+    assert w.first_delivery(1)
+    w.forget(1)
+    assert w.first_delivery(1)
+    assert shared.batches == []
+
+
+def test_failed_flush_does_not_drop_updates():
+    def persist(update_ids):
+        raise RuntimeError("database is locked")
+
+    w = UpdateWindow(1000, lambda update_id: False, persist)
+    assert w.claim(1)
+
+
+def _sqlite_window():
+    def lookup(update_id):
+        with db_read() as cur:
+            return database.update_seen(cur, update_id)
+
+    def persist(update_ids):
+        with db_write() as cur:
+            claimed = {u for u in update_ids if database.mark_update(cur, u)}
+            database.prune_update_window(cur, update_ids[-1], 1000)
+        return claimed
+
+    return UpdateWindow(1000, lookup, persist)
+
+
+def test_duplicate_delivered_to_two_windows_is_handled_once(bot_main):
+    # two workers with their own in-memory windows over one SQLite file
+    a, b = _sqlite_window(), _sqlite_window()
+    update_id = 10 ** 9 + 12345
+    # both take it before either claimed it
+    assert a.first_delivery(update_id)
+    assert b.first_delivery(update_id)
+
+    results = []
+    threads = [threading.Thread(target=lambda w=w: results.append(w.claim(update_id))) for w in (a, b)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sorted(results) == [False, True]
+
+    # a later redelivery is dropped by either window, even one that never saw it
+    c = _sqlite_window()
+    assert not a.first_delivery(update_id)
+    assert not c.first_delivery(update_id)
+
+
+def test_window_is_pruned_whatever_ids_arrive(bot_main):
+    w = _sqlite_window()
+    base = 2 * 10 ** 9 + 1
+    # ids never at the start of a 32-id block
+    for update_id in range(base, base + 3000, 7):
+        if update_id % 32 == 0:
+            continue
+        assert w.claim(update_id)
+    with db_read() as cur:
+        assert not database.update_seen(cur, base)
+        assert database.update_seen(cur, base + 2996)
+        cur.execute("SELECT MIN(block), MAX(block) FROM update_window")
+        low, high = cur.fetchone()
+    assert high - low <= 2 * (1000 >> database.UPDATE_BLOCK_SHIFT)
+
+
+def test_webhook_window_is_persisted_to_sqlite(bot_main):
+    w = bot_main.UPDATE_WINDOW
+    update_id = 10 ** 9 + 54321
+    assert w.first_delivery(update_id)
+    assert w.claim(update_id)
+    with db_read() as cur:
+        assert database.update_seen(cur, update_id)
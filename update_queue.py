@@ -0,0 +1,181 @@
+import os
+import queue
+import threading
+
+
+class QueueFull(Exception):
+    pass
+
+
+class UpdateDispatcher:
+    """Bounded worker pool that processes updates off the request thread.
+
+    Each chat is pinned to one worker (chat_id % workers), so updates for the
+    same chat run strictly in arrival order while different chats proceed in
+    parallel. Every worker owns a bounded queue; when it is full, submit()
+    either waits up to `block_timeout` seconds ("block") or fails at once
+    ("reject") by raising QueueFull, letting the webhook answer 503 so
+    Telegram redelivers later instead of us buffering without limit.
+    """
+
+    def __init__(self, handler, workers=4, queue_size=1000, overflow="block", block_timeout=2.0):
+        if overflow not in ("block", "reject"):
+            raise ValueError(f"unknown overflow policy: {overflow}")
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self._queues = []
+        self._threads = []
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_started(self):
+        # threads do not survive fork(), so (re)start lazily in each process
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._queues = [queue.Queue(maxsize=self.queue_size) for _ in range(self.workers)]
+            self._threads = []
+            for i, q in enumerate(self._queues):
+                t = threading.Thread(target=self._run, args=(q,), name=f"update-worker-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+            self._pid = os.getpid()
+
+    def _run(self, q):
+        while True:
+            item = q.get()
+            try:
+                self.handler(item)
+            except Exception as e:
+                print("Update handler failed:", e)
+            finally:
+                q.task_done()
+
+    def submit(self, chat_id, item):
+        self._ensure_started()
+        q = self._queues[(chat_id or 0) % self.workers]
+        try:
+            if self.overflow == "block":
+                q.put(item, timeout=self.block_timeout)
+            else:
+                q.put_nowait(item)
+        except queue.Full:
+            raise QueueFull(f"update queue full for chat {chat_id}")
+
+    def depth(self):
+        return sum(q.qsize() for q in self._queues)
+
+    def join(self):
+        # wait until everything queued so far has been processed
+        for q in self._queues:
+            q.join()
+
+
+class UpdateWindow:
+    """Recently seen update_ids: an in-memory check at ingress and a
+    durable, batched claim before the handlers run.
+
+    first_delivery() runs on the webhook request. It checks the process's
+    own bitmap of the last `window` ids (one int per 32 ids, as in the
+    update_window table), then `lookup(update_id)`, a plain read of the
+    shared window for ids another worker already claimed. Neither takes
+    the write lock.
+
+    claim() runs on the update worker before any handler. Claims from all
+    worker threads are handed to one flusher thread, which passes every id
+    waiting at that moment to `persist(update_ids)` in one write
+    transaction; it returns the ids newly marked there. Only the worker
+    whose transaction marked an id gets True, so an update delivered to
+    two workers at once is still handled once. If `persist` fails, the
+    updates are handled rather than dropped.
+    """
+
+    BLOCK_SHIFT = 5
+
+    def __init__(self, window, lookup, persist):
+        self.window = window
+        self.lookup = lookup
+        self.persist = persist
+        self._blocks = {}
+        self._pending = []  # (update_id, result slot)
+        self._cond = threading.Condition()
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def _bit(self, update_id):
+        return update_id >> self.BLOCK_SHIFT, 1 << (update_id & ((1 << self.BLOCK_SHIFT) - 1))
+
+    def _ensure_started(self):
+        # threads do not survive fork(), so start lazily in each process
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            threading.Thread(target=self._run, name="update-window", daemon=True).start()
+            self._pid = os.getpid()
+
+    def first_delivery(self, update_id):
+        """False if `update_id` was already seen (a redelivery)."""
+        block, bit = self._bit(update_id)
+        with self._cond:
+            if self._blocks.get(block, 0) & bit:
+                return False
+        seen = self.lookup(update_id)
+        with self._cond:
+            if self._blocks.get(block, 0) & bit:
+                return False
+            self._set(block, bit)
+        return not seen
+
+    def _set(self, block, bit):
+        if block not in self._blocks:
+            span = self.window >> self.BLOCK_SHIFT
+            for b in [b for b in self._blocks if abs(b - block) > span]:
+                del self._blocks[b]
+        self._blocks[block] = self._blocks.get(block, 0) | bit
+
+    def forget(self, update_id):
+        """Forget an update that was not queued, so its redelivery is processed."""
+        block, bit = self._bit(update_id)
+        with self._cond:
+            if block in self._blocks:
+                self._blocks[block] &= ~bit
+
+    def claim(self, update_id):
+        """Mark `update_id` in the shared window; False if another worker did first."""
+        self._ensure_started()
+        slot = []
+        with self._cond:
+            self._pending.append((update_id, slot))
+            self._cond.notify_all()
+            while not slot:
+                self._cond.wait()
+        return slot[0]
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                batch, self._pending = self._pending, []
+            try:
+                claimed = self.persist(sorted({update_id for update_id, _ in batch}))
+            except Exception as e:
+                print("Update window flush failed:", e)
+                claimed = {update_id for update_id, _ in batch}
+            with self._cond:
+                for update_id, slot in batch:
+                    slot.append(update_id in claimed)
+                    claimed.discard(update_id)
+                self._cond.notify_all()
+
+    def reset(self):
+        """Drop the in-memory bitmap (after a restore replaced the window)."""
+        with self._cond:
+            self._blocks = {}